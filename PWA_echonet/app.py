@@ -1,10 +1,16 @@
 import time
 import json
+import os
+import sys
+import heapq
 import socket
-import subprocess
 import threading
-from zeroconf import Zeroconf, ServiceInfo, ServiceBrowser
-from flask import Flask, jsonify, send_from_directory
+from zeroconf import Zeroconf, ServiceBrowser
+from flask import Flask, Response, jsonify, send_from_directory
+
+# echonet_discovery.py lives in the repo root; a copy next to this file also works
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from echonet_discovery import ADVERTISE_CHECK, NODE_TTL, SERVICE_TYPE, Advertiser, MetricsSampler, decode_txt, get_local_ip
 
 # ----------------------------
 # DEVICE CONFIG
@@ -16,45 +22,10 @@ MAX_LOAD = 5
 current_load = 0
 # ----------------------------
 
-DISCOVERED_NODES = {}   # shared table for all discovered devices
-
 app = Flask(__name__, static_folder="static", static_url_path="")
 
-# ----------------------------
-# UTILS
-# ----------------------------
-def get_local_ip():
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    try:
-        s.connect(("8.8.8.8", 80))
-        ip = s.getsockname()[0]
-    except:
-        ip = "127.0.0.1"
-    finally:
-        s.close()
-    return ip
-
-
-def get_battery():
-    try:
-        out = subprocess.check_output(["termux-battery-status"])
-        data = json.loads(out.decode())
-        return data.get("percentage")
-    except:
-        return None
-
-
-def get_cpu():
-    try:
-        out = subprocess.check_output("top -bn1 | head -n 5", shell=True)
-        text = out.decode().lower()
-        for line in text.splitlines():
-            if "%cpu" in line:
-                num = "".join(ch for ch in line if ch.isdigit() or ch == '.')
-                return float(num) if num else 0.0
-        return 0.0
-    except:
-        return 0.0
+
+SAMPLER = MetricsSampler()
 
 
 def compute_health(cpu, battery, load):
@@ -72,8 +43,9 @@ def compute_health(cpu, battery, load):
 
 
 def get_node_metrics():
-    cpu = get_cpu()
-    battery = get_battery()
+    # cached by SAMPLER; no subprocess on this path
+    cpu = round(SAMPLER.cpu or 0.0, 1)
+    battery = SAMPLER.battery
     health = compute_health(cpu, battery, current_load)
     return {
         "cpu": cpu,
@@ -84,6 +56,81 @@ def get_node_metrics():
     }
 
 
+# ----------------------------
+# NODE TABLE
+# ----------------------------
+class NodeTable:
+    """Discovered devices, written by the zeroconf thread and read by Flask.
+
+    Every change publishes a new immutable snapshot (already JSON-encoded), so
+    /nodes never takes the lock or walks the table. Expiry is driven by a heap
+    of deadlines: entries superseded by a later update are skipped when popped.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._nodes = {}        # node_id -> node dict
+        self._deadlines = {}    # node_id -> current expiry deadline
+        self._heap = []         # (deadline, node_id), may hold stale entries
+        self._names = {}        # zeroconf service name -> node_id
+        self._cond = threading.Condition()
+        self._publish()
+
+    def _publish(self):
+        # callers hold the lock (or are __init__)
+        nodes = tuple(self._nodes.values())
+        self._snapshot = (nodes, json.dumps(nodes))
+
+    def upsert(self, name, node):
+        deadline = time.monotonic() + self.ttl
+        with self._cond:
+            is_new = node["id"] not in self._nodes
+            self._nodes[node["id"]] = node
+            self._names[name] = node["id"]
+            self._deadlines[node["id"]] = deadline
+            heapq.heappush(self._heap, (deadline, node["id"]))
+            self._publish()
+            self._cond.notify()
+        return is_new
+
+    def remove(self, name):
+        with self._cond:
+            node_id = self._names.pop(name, None)
+            if node_id is None or self._nodes.pop(node_id, None) is None:
+                return None
+            del self._deadlines[node_id]
+            self._publish()
+        return node_id
+
+    def run_expiry(self):
+        """Sleep until the earliest deadline, then drop the nodes that are still stale."""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                expired = False
+                while self._heap and self._heap[0][0] <= now:
+                    deadline, node_id = heapq.heappop(self._heap)
+                    if self._deadlines.get(node_id) == deadline:
+                        del self._deadlines[node_id]
+                        del self._nodes[node_id]
+                        for name in [n for n, i in self._names.items() if i == node_id]:
+                            del self._names[name]
+                        expired = True
+                        print(f"\n💤 NODE EXPIRED → {node_id}")
+                if expired:
+                    self._publish()
+                self._cond.wait(self._heap[0][0] - now if self._heap else None)
+
+    def snapshot(self):
+        return self._snapshot[0]
+
+    def snapshot_json(self):
+        return self._snapshot[1]
+
+
+DISCOVERED_NODES = NodeTable(NODE_TTL)   # shared table for all discovered devices
+
+
 # ----------------------------
 # ZEROCONF LISTENER
 # ----------------------------
@@ -92,57 +139,48 @@ class DiscoveryListener:
         info = zc.get_service_info(service_type, name)
         if not info: return
 
-        node_id = info.properties[b"id"].decode()
-        if node_id == NODE_ID:
+        try:
+            node = decode_txt(info.properties)
+        except ValueError as e:
+            print(f"\n⚠️  ignoring {name}: {e}")
+            return
+        if node["id"] == NODE_ID:
             return
 
-        skills = json.loads(info.properties[b"skills"].decode())
-        metrics = json.loads(info.properties[b"metrics"].decode())
         node_ip = socket.inet_ntoa(info.addresses[0])
 
-        DISCOVERED_NODES[node_id] = {
-            "id": node_id,
+        is_new = DISCOVERED_NODES.upsert(name, {
+            "id": node["id"],
             "ip": node_ip,
             "port": info.port,
-            "skills": skills,
-            "metrics": metrics,
+            "url": node["url"],
+            "skills": node["skills"],
+            "metrics": node["metrics"],
             "timestamp": time.time()
-        }
+        })
 
-        print(f"\n✨ FOUND NODE → {node_id} @ {node_ip}:{info.port}")
+        if is_new:
+            print(f"\n✨ FOUND NODE → {node['id']} @ {node_ip}:{info.port}")
 
-    def update_service(self, *args): pass
-    def remove_service(self, *args): pass
+    # a metrics refresh arrives as an update of the same service
+    update_service = add_service
+
+    def remove_service(self, zc, service_type, name):
+        node_id = DISCOVERED_NODES.remove(name)
+        if node_id:
+            print(f"\n👋 NODE LEFT → {node_id}")
 
 
 # ----------------------------
 # ZEROCONF ADVERTISER THREAD
 # ----------------------------
-def advertiser_thread():
-    zc = Zeroconf(ip_version=4)
-    ip = get_local_ip()
-
-    props = {
-        "id": NODE_ID,
-        "skills": json.dumps(SKILLS),
-        "metrics": json.dumps(get_node_metrics()),
-    }
+ADVERTISER = None   # set by advertiser_thread, read by /info
 
-    info = ServiceInfo(
-        "_echotest._tcp.local.",
-        f"{NODE_ID}._echotest._tcp.local.",
-        addresses=[socket.inet_aton(ip)],
-        port=PORT,
-        properties=props,
-    )
-
-    zc.register_service(info)
 
-    while True:
-        # update metrics without re-registering
-        info.properties[b"metrics"] = json.dumps(get_node_metrics()).encode()
-        zc.update_service(info)
-        time.sleep(3)
+def advertiser_thread():
+    global ADVERTISER
+    ADVERTISER = Advertiser(Zeroconf(ip_version=4), NODE_ID, get_local_ip(), PORT, SKILLS, get_node_metrics)
+    ADVERTISER.run(ADVERTISE_CHECK)
 
 
 # ----------------------------
@@ -154,17 +192,17 @@ def serve_index():
 
 @app.get("/info")
 def info():
-    return jsonify(get_node_metrics())
+    metrics = get_node_metrics()
+    metrics["sampler"] = SAMPLER.stats()
+    if ADVERTISER is not None:
+        metrics["advertiser"] = ADVERTISER.stats
+    return jsonify(metrics)
 
 
 @app.get("/nodes")
 def get_nodes():
-    # remove stale nodes older than 10s
-    now = time.time()
-    dead = [k for k,v in DISCOVERED_NODES.items() if now - v["timestamp"] > 10]
-    for k in dead: del DISCOVERED_NODES[k]
-
-    return jsonify(list(DISCOVERED_NODES.values()))
+    # stale nodes are dropped by the expiry thread; just serve the last snapshot
+    return Response(DISCOVERED_NODES.snapshot_json(), mimetype="application/json")
 
 
 @app.route("/<path:path>")
@@ -176,8 +214,10 @@ def serve_static(path):
 # MAIN
 # ----------------------------
 if __name__ == "__main__":
-    # Start advertiser first
+    # Start the metrics sampler and advertiser first
+    SAMPLER.start()
     threading.Thread(target=advertiser_thread, daemon=True).start()
+    threading.Thread(target=DISCOVERED_NODES.run_expiry, daemon=True).start()
 
     # Start Flask
     flask_thread = threading.Thread(
@@ -190,7 +230,7 @@ if __name__ == "__main__":
 
     # Start Zeroconf browser LAST
     zc = Zeroconf(ip_version=4)
-    ServiceBrowser(zc, "_echotest._tcp.local.", DiscoveryListener())
+    ServiceBrowser(zc, SERVICE_TYPE, DiscoveryListener())
 
     print("\n🔥 All systems running...\n")
 
@@ -1,11 +1,15 @@
 import time
-import json
+import os
+import sys
 import socket
-import subprocess
 import threading
-from zeroconf import Zeroconf, ServiceInfo, ServiceBrowser
+from zeroconf import Zeroconf, ServiceBrowser
 from flask import Flask, jsonify
 
+# echonet_discovery.py lives in the repo root; a copy next to this file also works
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from echonet_discovery import ADVERTISE_CHECK, NODE_TTL, SERVICE_TYPE, Advertiser, MetricsSampler, decode_txt, get_local_ip
+
 # ----------------------------
 # CHANGE THIS PER DEVICE
 # ----------------------------
@@ -19,43 +23,7 @@ current_load = 0
 DISCOVERED_NODES = {}   # <--- NEW: shared node table
 
 
-def get_local_ip():
-    """Get LAN IP address."""
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    try:
-        s.connect(("8.8.8.8", 80))
-        ip = s.getsockname()[0]
-    except:
-        ip = "127.0.0.1"
-    finally:
-        s.close()
-    return ip
-
-
-# ----- SAFE BATTERY IN TERMUX -----
-def get_battery():
-    """Get battery level using Termux API."""
-    try:
-        out = subprocess.check_output(["termux-battery-status"])
-        data = json.loads(out.decode())
-        return data.get("percentage")
-    except:
-        return None
-
-
-# ----- SAFE CPU IN TERMUX -----
-def get_cpu():
-    """Termux cannot access psutil CPU. Use /proc/stat safely."""
-    try:
-        out = subprocess.check_output("top -bn1 | head -n 5", shell=True)
-        text = out.decode().lower()
-        for line in text.splitlines():
-            if "%cpu" in line:
-                num = "".join(ch for ch in line if ch.isdigit() or ch == '.')
-                return float(num) if num else 0.0
-        return 0.0
-    except:
-        return 0.0
+SAMPLER = MetricsSampler()
 
 
 def compute_health(cpu, battery, load):
@@ -74,8 +42,9 @@ def compute_health(cpu, battery, load):
 
 
 def get_node_metrics():
-    cpu = get_cpu()
-    battery = get_battery()
+    # cached by SAMPLER; no subprocess on this path
+    cpu = round(SAMPLER.cpu or 0.0, 1)
+    battery = SAMPLER.battery
     health = compute_health(cpu, battery, current_load)
 
     return {
@@ -93,60 +62,50 @@ class DiscoveryListener:
         if not info:
             return
 
-        node_id = info.properties[b"id"].decode()
+        try:
+            node = decode_txt(info.properties)
+        except ValueError as e:
+            print(f"\n⚠️  ignoring {name}: {e}")
+            return
+        node_id, metrics = node["id"], node["metrics"]
         if node_id == NODE_ID:
             return  # ignore ourselves
 
-        skills = json.loads(info.properties[b"skills"].decode())
-        metrics = json.loads(info.properties[b"metrics"].decode())
         node_ip = socket.inet_ntoa(info.addresses[0])
+        is_new = node_id not in DISCOVERED_NODES
 
         # store in global table
         DISCOVERED_NODES[node_id] = {
             "id": node_id,
             "ip": node_ip,
             "port": info.port,
-            "skills": skills,
+            "url": node["url"],
+            "skills": node["skills"],
             "metrics": metrics,
             "timestamp": time.time()
         }
 
+        if not is_new:
+            return
         print(f"\n✨ FOUND NODE → {node_id} @ {node_ip}:{info.port}")
-        print(f"   skills:  {skills}")
-        print(f"   cpu:     {metrics['cpu']}")
-        print(f"   battery: {metrics['battery']}")
-        print(f"   load:    {metrics['load']}/{metrics['max_load']}")
-        print(f"   health:  {metrics['health']:.2f}")
+        print(f"   skills:  {node['skills']}")
+        if metrics:
+            print(f"   cpu:     {metrics.get('cpu')}")
+            print(f"   battery: {metrics.get('battery')}")
+            print(f"   load:    {metrics.get('load')}/{metrics.get('max_load')}")
+            print(f"   health:  {metrics.get('health', 0):.2f}")
+
+    # metric changes and heartbeats arrive as updates; they refresh the timestamp
+    update_service = add_service
 
-    def update_service(self, *a): pass
     def remove_service(self, *a): pass
 
 
 def advertiser_thread():
-    """Advertise updated metrics every ~3 seconds."""
+    """Register once, then re-announce only on metric changes or the heartbeat."""
     zc = Zeroconf(ip_version=4)
-    ip = get_local_ip()
-
-    while True:
-        metrics = get_node_metrics()
-
-        props = {
-            "id": NODE_ID,
-            "skills": json.dumps(SKILLS),
-            "metrics": json.dumps(metrics),
-        }
-
-        info = ServiceInfo(
-            "_echotest._tcp.local.",
-            f"{NODE_ID}._echotest._tcp.local.",
-            addresses=[socket.inet_aton(ip)],
-            port=PORT,
-            properties=props,
-        )
-
-        zc.register_service(info)
-        time.sleep(3)
-        zc.unregister_service(info)
+    adv = Advertiser(zc, NODE_ID, get_local_ip(), PORT, SKILLS, get_node_metrics)
+    adv.run(ADVERTISE_CHECK, on_announce=lambda a: print(f"📡 announced → {a.stats}"))
 
 
 # ----------------------------
@@ -156,9 +115,9 @@ app = Flask(__name__)
 
 @app.get("/nodes")
 def get_nodes():
-    # remove stale nodes after 10 sec
+    # remove nodes that missed their heartbeat
     now = time.time()
-    dead = [k for k,v in DISCOVERED_NODES.items() if now - v["timestamp"] > 10]
+    dead = [k for k,v in DISCOVERED_NODES.items() if now - v["timestamp"] > NODE_TTL]
     for k in dead: del DISCOVERED_NODES[k]
 
     return jsonify(list(DISCOVERED_NODES.values()))
@@ -168,12 +127,13 @@ def get_nodes():
 #       MAIN ENTRY
 # ----------------------------
 if __name__ == "__main__":
-    # advertiser
+    # metrics sampler, then advertiser
+    SAMPLER.start()
     threading.Thread(target=advertiser_thread, daemon=True).start()
 
     # browser
     zc = Zeroconf(ip_version=4)
-    ServiceBrowser(zc, "_echotest._tcp.local.", DiscoveryListener())
+    ServiceBrowser(zc, SERVICE_TYPE, DiscoveryListener())
 
     print("\n🔥 Node running... Zeroconf + API online...\n")
 
@@ -0,0 +1,240 @@
+"""
+本地假 OpenAI 服务（只实现 POST /v1/chat/completions），用于压测时不消耗真实额度。
+
+延迟模型：首 token 延迟（ttft）按指定分布抽样，之后按 token_rate（token/秒）逐个输出；
+非流式请求等整段生成完再返回。支持 stream_options.include_usage，并按提示词类型返回
+能被节点解析的内容（写诗 / 翻译 / 批量翻译 JSON / /analyze 拆分 JSON）。
+
+单独运行：
+    python bench/fake_openai.py --port 5799 --ttft-ms 300 --ttft-dist lognormal --token-rate 40
+然后让节点使用：OPENAI_BASE_URL=http://127.0.0.1:5799/v1 OPENAI_API_KEY=sk-bench
+"""
+
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class LatencyModel:
+    def __init__(self, ttft_ms=200.0, ttft_dist="fixed", jitter=0.5, token_rate=50.0, tokens=40, error_rate=0.0):
+        self.ttft_ms = ttft_ms
+        self.ttft_dist = ttft_dist
+        self.jitter = jitter
+        self.token_rate = token_rate
+        self.tokens = tokens
+        self.error_rate = error_rate
+
+    def ttft(self):
+        """首 token 延迟（秒）；jitter 控制分布的离散程度"""
+        mean = self.ttft_ms / 1000.0
+        if self.ttft_dist == "uniform":
+            return random.uniform(mean * (1 - self.jitter), mean * (1 + self.jitter))
+        if self.ttft_dist == "exp":
+            return random.expovariate(1.0 / mean) if mean > 0 else 0.0
+        if self.ttft_dist == "lognormal":
+            # 均值保持为 ttft_ms，jitter 作为 sigma，长尾明显
+            sigma = self.jitter
+            return random.lognormvariate(math.log(mean) - sigma * sigma / 2, sigma) if mean > 0 else 0.0
+        return mean
+
+    def token_interval(self):
+        return 1.0 / self.token_rate if self.token_rate > 0 else 0.0
+
+
+def _reply_text(prompt, model):
+    """根据提示词返回节点能正确解析的内容"""
+    m = re.search(r"(\d+) 首英文诗", prompt)
+    if m:
+        n = int(m.group(1))
+        return json.dumps({"translations": [f"译文{i + 1}：月光洒满庭院" for i in range(n)]}, ensure_ascii=False)
+    if "splits a user's high-level command" in prompt:
+        command = prompt.rsplit("User command:", 1)[-1].strip()
+        return json.dumps({"tasks": [
+            {"id": "t1", "op": "generate_poem_en", "params": {"prompt": command}},
+            {"id": "t2", "op": "translate_zh", "params": {}, "depends_on": ["t1"]},
+        ]})
+    if prompt.startswith("翻译成中文诗"):
+        return "月光 洒满 庭院 ， 风 轻轻 吹过 心间 。"
+    # 不同提示词得到不同的诗，避免下游翻译全部命中缓存
+    seed = sum(prompt.encode("utf-8")) % 100000
+    return f"poem{seed} " + " ".join(f"word{i}" for i in range(12))
+
+
+class RateWindow:
+    """每分钟请求数上限（滑动 60 秒窗口），超出时返回 429，模拟 OpenAI 的 RPM 限制"""
+
+    def __init__(self, rpm):
+        self.rpm = rpm
+        self._times = []
+        self._lock = threading.Lock()
+
+    def admit(self):
+        """返回 (是否放行, 剩余请求数, 最早一个请求离开窗口的秒数)"""
+        with self._lock:
+            now = time.monotonic()
+            self._times = [t for t in self._times if now - t < 60.0]
+            reset = 60.0 - (now - self._times[0]) if self._times else 0.0
+            if len(self._times) >= self.rpm:
+                return False, 0, reset
+            self._times.append(now)
+            return True, self.rpm - len(self._times), reset
+
+
+def _split_tokens(text, n):
+    """把回复切成大约 n 个片段，模拟逐 token 输出"""
+    if not text:
+        return []
+    size = max(1, math.ceil(len(text) / max(n, 1)))
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class FakeOpenAI:
+    def __init__(self, model, host="127.0.0.1", port=5799, rpm=0):
+        self.model = model
+        self.window = RateWindow(rpm) if rpm > 0 else None
+        self.stats = {"requests": 0, "stream_requests": 0, "errors": 0, "rate_limited": 0, "completion_tokens": 0}
+        self._lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self._json(404, {"error": {"message": "not found"}})
+                    return
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                fake._handle(self, body)
+
+            def _json(self, status, obj, headers=None):
+                data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake-openai", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def _count(self, **inc):
+        with self._lock:
+            for k, v in inc.items():
+                self.stats[k] += v
+
+    def _handle(self, handler, body):
+        model = body.get("model", "gpt-4o-mini")
+        prompt = "".join(str(m.get("content", "")) for m in body.get("messages", []))
+        stream = bool(body.get("stream"))
+        self._count(requests=1, stream_requests=int(stream))
+        headers = {}
+        if self.window is not None:
+            ok, remaining, reset = self.window.admit()
+            headers = {"x-ratelimit-limit-requests": str(self.window.rpm),
+                       "x-ratelimit-remaining-requests": str(remaining),
+                       "x-ratelimit-reset-requests": f"{reset:.3f}s"}
+            if not ok:
+                self._count(rate_limited=1)
+                handler._json(429, {"error": {"message": "Rate limit reached for requests", "type": "requests"}},
+                              dict(headers, **{"retry-after-ms": str(int(reset * 1000))}))
+                return
+
+        time.sleep(self.model.ttft())
+        if random.random() < self.model.error_rate:
+            self._count(errors=1)
+            handler._json(500, {"error": {"message": "fake upstream error", "type": "server_error"}})
+            return
+
+        pieces = _split_tokens(_reply_text(prompt, model), self.model.tokens)
+        usage = {"prompt_tokens": max(1, len(prompt) // 4), "completion_tokens": len(pieces),
+                 "total_tokens": max(1, len(prompt) // 4) + len(pieces)}
+        self._count(completion_tokens=len(pieces))
+        cid = "chatcmpl-" + uuid.uuid4().hex[:24]
+        created = int(time.time())
+        interval = self.model.token_interval()
+
+        if not stream:
+            time.sleep(interval * max(len(pieces) - 1, 0))
+            handler._json(200, {
+                "id": cid, "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": "".join(pieces)}}],
+                "usage": usage,
+            }, headers)
+            return
+
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Cache-Control", "no-cache")
+        handler.send_header("Connection", "close")
+        for k, v in headers.items():
+            handler.send_header(k, v)
+        handler.end_headers()
+        handler.close_connection = True
+
+        def send(obj):
+            handler.wfile.write(b"data: " + json.dumps(obj, ensure_ascii=False).encode("utf-8") + b"\n\n")
+            handler.wfile.flush()
+
+        base = {"id": cid, "object": "chat.completion.chunk", "created": created, "model": model}
+        for i, piece in enumerate(pieces):
+            if i:
+                time.sleep(interval)
+            send(dict(base, choices=[{"index": 0, "delta": {"content": piece}, "finish_reason": None}]))
+        send(dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+        if (body.get("stream_options") or {}).get("include_usage"):
+            send(dict(base, choices=[], usage=usage))
+        handler.wfile.write(b"data: [DONE]\n\n")
+        handler.wfile.flush()
+
+
+def add_latency_args(parser):
+    parser.add_argument("--ttft-ms", type=float, default=200.0, help="平均首 token 延迟（毫秒）")
+    parser.add_argument("--ttft-dist", choices=["fixed", "uniform", "exp", "lognormal"], default="fixed")
+    parser.add_argument("--jitter", type=float, default=0.5, help="uniform 的相对幅度 / lognormal 的 sigma")
+    parser.add_argument("--token-rate", type=float, default=50.0, help="每秒输出的 token 数")
+    parser.add_argument("--tokens", type=int, default=40, help="每个回复大约切成多少个 token")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 500 的概率")
+    parser.add_argument("--rpm", type=int, default=0, help="每分钟请求数上限，超出返回 429（0 = 不限）")
+
+
+def latency_model_from_args(args):
+    return LatencyModel(args.ttft_ms, args.ttft_dist, args.jitter, args.token_rate, args.tokens, args.error_rate)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible chat completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5799)
+    add_latency_args(parser)
+    args = parser.parse_args()
+    fake = FakeOpenAI(latency_model_from_args(args), args.host, args.port, args.rpm).start()
+    print("fake OpenAI listening on", fake.url)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        fake.stop()
@@ -0,0 +1,270 @@
+"""
+本机多节点压测：启动假 OpenAI 服务 + N 个 net.py 节点进程（每个节点一个临时目录和生成的 nodes.json，
+相当于自动化的 instance2/ 拷贝），按指定并发驱动 /task 与 /analyze，输出 JSON 报告。
+
+示例：
+    python bench/run_bench.py --nodes 3 --topology split --requests 200 --concurrency 16 --out report.json
+    python bench/run_bench.py --nodes 3 --node-env STEP_HEDGING=1 --ttft-dist lognormal --baseline report.json
+
+报告包含吞吐量、端到端延迟 p50/p95/p99，以及从 /trace/<task_id> 抽样统计的每一跳（span）耗时；
+传入 --baseline 时附带与旧报告的对比，方便做回归比较。
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_openai import FakeOpenAI, add_latency_args, latency_model_from_args  # noqa: E402
+
+NET_PY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "net.py")
+HEADERS = {"X-User-Token": "testtoken123"}
+SKILLS = ["generate_poem_en", "translate_zh"]
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def summarize(values):
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 2),
+        "p50": round(percentile(values, 50), 2),
+        "p95": round(percentile(values, 95), 2),
+        "p99": round(percentile(values, 99), 2),
+        "max": round(max(values), 2),
+    }
+
+
+def node_skills(i, n, topology):
+    """replicated：每个节点都有全部技能；split：偶数节点写诗、奇数节点翻译（单节点时两个都有）"""
+    if topology == "replicated" or n == 1:
+        return list(SKILLS)
+    return [SKILLS[i % 2]]
+
+
+class Cluster:
+    def __init__(self, n, topology, base_port, openai_url, node_env, keep_dir=None):
+        self.base_dir = keep_dir or tempfile.mkdtemp(prefix="echonet-bench-")
+        self.keep = keep_dir is not None
+        self.nodes = [{"id": f"bench{i}", "url": f"http://127.0.0.1:{base_port + i}",
+                       "skills": node_skills(i, n, topology)} for i in range(n)]
+        self.procs = []
+        self.openai_url = openai_url
+        self.node_env = node_env
+
+    def start(self, timeout=60):
+        for i, node in enumerate(self.nodes):
+            node_dir = os.path.join(self.base_dir, node["id"])
+            os.makedirs(node_dir, exist_ok=True)
+            with open(os.path.join(node_dir, "nodes.json"), "w", encoding="utf-8") as f:
+                json.dump({"self_id": node["id"], "self_url": node["url"], "nodes": self.nodes}, f, indent=2)
+            env = dict(os.environ, OPENAI_API_KEY="sk-bench", OPENAI_BASE_URL=self.openai_url,
+                       PORT=node["url"].rsplit(":", 1)[1], PYTHONUNBUFFERED="1",
+                       NODE_TOKEN="bench-cluster")  # --forward 需要节点间共享的 token
+            env.update(self.node_env)
+            log = open(os.path.join(node_dir, "node.log"), "w", encoding="utf-8")
+            self.procs.append(subprocess.Popen([sys.executable, NET_PY], cwd=node_dir, env=env,
+                                               stdout=log, stderr=subprocess.STDOUT))
+        deadline = time.time() + timeout
+        for node, proc in zip(self.nodes, self.procs):
+            while True:
+                if proc.poll() is not None:
+                    raise RuntimeError(f"{node['id']} exited early, see {self.base_dir}/{node['id']}/node.log")
+                try:
+                    if requests.get(node["url"] + "/info", timeout=1).status_code == 200:
+                        break
+                except requests.RequestException:
+                    pass
+                if time.time() > deadline:
+                    raise RuntimeError(f"{node['id']} did not become ready in {timeout}s")
+                time.sleep(0.2)
+        return self
+
+    def stop(self):
+        for proc in self.procs:
+            proc.terminate()
+        for proc in self.procs:
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        if not self.keep:
+            shutil.rmtree(self.base_dir, ignore_errors=True)
+
+
+def run_task(session, base, i, args):
+    prompt = f"Write a short poem about the sea, variation {i % args.distinct if args.distinct else i}."
+    body = {"pipeline": [{"op": "generate_poem_en", "params": {"prompt": prompt}}, {"op": "translate_zh"}]}
+    if args.forward:
+        body["forward"] = True
+    started = time.perf_counter()
+    resp = session.post(base + "/task", json=body, headers=HEADERS, timeout=30)
+    if resp.status_code != 202:
+        return {"ok": False, "status": resp.status_code, "latency_ms": (time.perf_counter() - started) * 1000}
+    task_id = resp.json()["task_id"]
+    deadline = started + args.task_timeout
+    while time.perf_counter() < deadline:
+        r = session.get(base + "/result/" + task_id, headers=HEADERS, timeout=30).json()
+        if r["status"] in ("done", "error"):
+            return {"ok": r["status"] == "done", "status": r["status"], "task_id": task_id, "base": base,
+                    "latency_ms": (time.perf_counter() - started) * 1000}
+        time.sleep(args.poll_ms / 1000.0)
+    return {"ok": False, "status": "timeout", "task_id": task_id, "base": base,
+            "latency_ms": (time.perf_counter() - started) * 1000}
+
+
+def run_analyze(session, base, i, args):
+    command = f"write a poem about the sea number {i % args.distinct if args.distinct else i} and translate it to chinese"
+    started = time.perf_counter()
+    resp = session.post(base + "/analyze", json={"command": command}, headers=HEADERS, timeout=60)
+    return {"ok": resp.status_code == 200, "status": resp.status_code,
+            "latency_ms": (time.perf_counter() - started) * 1000}
+
+
+def drive(kind, cluster, args):
+    """以固定并发发送 args.requests 个请求，返回结果列表与总耗时"""
+    fn = run_task if kind == "task" else run_analyze
+    entries = [cluster.nodes[0]["url"]] if args.entry == "first" else [n["url"] for n in cluster.nodes]
+    sessions = {}
+
+    def one(i):
+        # 每个线程一个 Session，保持 keep-alive
+        s = sessions.setdefault(threading.get_ident(), requests.Session())
+        try:
+            return fn(s, entries[i % len(entries)], i, args)
+        except Exception as e:
+            return {"ok": False, "status": f"exception: {e}", "latency_ms": None}
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(one, range(-args.warmup, 0)))
+        started = time.perf_counter()
+        results = list(pool.map(one, range(args.requests)))
+        elapsed = time.perf_counter() - started
+    return results, elapsed
+
+
+def hop_breakdown(results, sample):
+    """从抽样任务的 /trace 统计每种 span 的耗时（按 名称[:op] 分组）"""
+    durations = {}
+    traced = [r for r in results if r.get("ok") and r.get("task_id")][:sample]
+    for r in traced:
+        try:
+            trace = requests.get(f"{r['base']}/trace/{r['task_id']}", headers=HEADERS, timeout=10).json()
+        except Exception:
+            continue
+        for sp in trace.get("spans", []):
+            key = sp["name"]
+            if sp.get("attrs", {}).get("op"):
+                key += ":" + sp["attrs"]["op"]
+            durations.setdefault(key, []).append(sp["duration_ms"])
+    return {k: summarize(v) for k, v in sorted(durations.items())}
+
+
+def report_for(kind, results, elapsed, args):
+    ok = [r for r in results if r["ok"]]
+    errors = {}
+    for r in results:
+        if not r["ok"]:
+            errors[str(r["status"])] = errors.get(str(r["status"]), 0) + 1
+    out = {
+        "requests": len(results),
+        "ok": len(ok),
+        "errors": errors,
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(len(ok) / elapsed, 2) if elapsed else None,
+        "latency_ms": summarize([r["latency_ms"] for r in ok]),
+    }
+    if kind == "task" and args.trace_sample:
+        out["hops_ms"] = hop_breakdown(results, args.trace_sample)
+    return out
+
+
+def compare(report, baseline):
+    """与旧报告对比吞吐量和延迟分位数（正数 = 变大）"""
+    diff = {}
+    for kind in ("task", "analyze"):
+        cur, old = report.get(kind), baseline.get(kind)
+        if not cur or not old:
+            continue
+        d = {}
+        if cur.get("throughput_rps") and old.get("throughput_rps"):
+            d["throughput_rps_pct"] = round((cur["throughput_rps"] / old["throughput_rps"] - 1) * 100, 1)
+        for p in ("p50", "p95", "p99"):
+            a, b = cur["latency_ms"].get(p), old["latency_ms"].get(p)
+            if a is not None and b:
+                d[f"latency_{p}_pct"] = round((a / b - 1) * 100, 1)
+        diff[kind] = d
+    return diff
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local multi-node benchmark for net.py")
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--topology", choices=["split", "replicated"], default="split")
+    parser.add_argument("--mode", choices=["task", "analyze", "both"], default="task")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=0, help="正式计时前先发送的请求数")
+    parser.add_argument("--distinct", type=int, default=0,
+                        help="不同提示词/命令的个数（0 = 每个请求都不同，不命中缓存）")
+    parser.add_argument("--forward", action="store_true", help="/task 使用逐跳转发模式")
+    parser.add_argument("--entry", choices=["first", "all"], default="first", help="请求发给第一个节点还是轮流发给所有节点")
+    parser.add_argument("--poll-ms", type=float, default=10)
+    parser.add_argument("--task-timeout", type=float, default=120)
+    parser.add_argument("--trace-sample", type=int, default=20, help="抽样多少个任务统计每跳耗时（0 关闭）")
+    parser.add_argument("--base-port", type=int, default=5800)
+    parser.add_argument("--fake-port", type=int, default=5799)
+    parser.add_argument("--node-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="传给每个节点进程的环境变量，可重复")
+    parser.add_argument("--keep-dir", help="保留节点目录与日志到该路径")
+    parser.add_argument("--out", help="报告写入的文件（默认只打印）")
+    parser.add_argument("--baseline", help="旧报告，用于对比")
+    add_latency_args(parser)
+    args = parser.parse_args()
+
+    node_env = dict(kv.split("=", 1) for kv in args.node_env)
+    fake = FakeOpenAI(latency_model_from_args(args), port=args.fake_port, rpm=args.rpm).start()
+    cluster = Cluster(args.nodes, args.topology, args.base_port, fake.url, node_env, args.keep_dir)
+    report = {"config": {k: v for k, v in vars(args).items() if k not in ("out", "baseline")},
+              "started_at": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    try:
+        cluster.start()
+        for kind in (("task", "analyze") if args.mode == "both" else (args.mode,)):
+            results, elapsed = drive(kind, cluster, args)
+            report[kind] = report_for(kind, results, elapsed, args)
+        report["fake_openai"] = dict(fake.stats)
+    finally:
+        cluster.stop()
+        fake.stop()
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            report["vs_baseline"] = compare(report, json.load(f))
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
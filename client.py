@@ -1,3 +1,4 @@
+import time
 import requests
 
 if __name__ == "__main__":
@@ -18,8 +19,23 @@ if __name__ == "__main__":
     }
 
     # 修改为任意一个节点 URL（nodeA 或 nodeB）
-    target = "http://127.0.0.1:5000/task"
-    print("Sending task to", target)
-    resp = requests.post(target, json=task, timeout=120)
+    base = "http://127.0.0.1:5000"
+    headers = {"X-User-Token": "testtoken123"}
+    print("Sending task to", base + "/task")
+    resp = requests.post(base + "/task", json=task, headers=headers, timeout=10)
     print(resp.status_code)
     print(resp.text)
+    if resp.status_code != 202:
+        raise SystemExit(1)
+
+    # /task 立即返回 task_id，之后轮询 /result 查看每一步进度
+    task_id = resp.json()["task_id"]
+    while True:
+        r = requests.get(base + "/result/" + task_id, headers=headers, timeout=10)
+        result = r.json()
+        steps = ", ".join(f"{s['op']}={s['status']}" for s in result.get("steps", []))
+        print(f"[{result.get('status')}] {steps}")
+        if result.get("status") in ("done", "error"):
+            print(result)
+            break
+        time.sleep(1)
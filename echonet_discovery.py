@@ -0,0 +1,309 @@
+"""
+mDNS pieces shared by every Echonet node: net.py, echonet_node.py and the
+device scripts (node_test.py, node_termux_test.py, PWA_echonet/).
+
+- encode_txt / decode_txt: the TXT record format
+- Advertiser: republishes a node only when its metrics move, plus a heartbeat
+- MetricsSampler: CPU / battery probed on a background thread, read from cache
+
+zeroconf is only needed by Advertiser, psutil is an optional probe.
+"""
+
+import json
+import os
+import random
+import socket
+import subprocess
+import threading
+import time
+
+try:
+    from zeroconf import ServiceInfo
+except ImportError:
+    ServiceInfo = None
+
+try:
+    # optional: used when /proc/stat is not readable
+    import psutil
+except ImportError:
+    psutil = None
+
+SERVICE_TYPE = "_echotest._tcp.local."
+
+# Advertisement: republish only when a metric moves at least this far from the
+# last advertised value, or after ADVERTISE_HEARTBEAT seconds (+/- 10% jitter so
+# devices don't announce in lockstep). Listeners drop nodes after NODE_TTL,
+# i.e. 2.5 missed heartbeats.
+ADVERTISE_CHECK = 3
+ADVERTISE_HEARTBEAT = 30
+ADVERTISE_THRESHOLDS = {"cpu": 15.0, "battery": 5, "load": 1, "health": 0.1}
+NODE_TTL = 75
+
+
+def get_local_ip():
+    """LAN address of this machine (the one used to reach the internet)."""
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.connect(("8.8.8.8", 80))
+        return s.getsockname()[0]
+    except OSError:
+        return "127.0.0.1"
+    finally:
+        s.close()
+
+
+# ----- TXT RECORD -----
+# v2 is compact: skills as a comma list in "s", metrics as one CSV field
+#   m = cpu,battery,load,max_load,health   (battery empty when unknown)
+# plus an optional "url" for nodes whose API is not at http://<address>:<port>.
+# Nodes without metrics (echonet_node.py) send v2 without "m".
+# v1 (older nodes) carries JSON in "skills" and "metrics"; both are accepted.
+def encode_txt(node_id, skills, metrics=None, url=None):
+    props = {"id": node_id, "v": "2", "s": ",".join(sorted(skills))}
+    if url:
+        props["url"] = url
+    if metrics is not None:
+        battery = metrics["battery"]
+        props["m"] = "%d,%s,%d,%d,%.2f" % (round(metrics["cpu"]), "" if battery is None else round(battery),
+                                           metrics["load"], metrics["max_load"], metrics["health"])
+    return props
+
+
+def _decode_metrics(props):
+    if props.get("m"):
+        cpu, battery, load, max_load, health = props["m"].split(",")
+        return {
+            "cpu": float(cpu),
+            "battery": int(battery) if battery else None,
+            "load": int(load),
+            "max_load": int(max_load),
+            "health": float(health),
+        }
+    if props.get("metrics"):
+        metrics = json.loads(props["metrics"])
+        if not isinstance(metrics, dict):
+            raise ValueError("metrics is not an object")
+        return metrics
+    return None
+
+
+def decode_txt(properties):
+    """Parse a v1 or v2 TXT record into {"id", "skills", "metrics", "url"}.
+
+    metrics and url are None when the node does not send them. Raises
+    ValueError for a record that cannot be used (no id, unreadable skills or
+    metrics), so listeners can skip that one service and keep running.
+    """
+    props = {}
+    for k, v in (properties or {}).items():
+        key = k.decode() if isinstance(k, bytes) else k
+        props[key] = v.decode() if isinstance(v, bytes) else (v or "")
+    node_id = props.get("id")
+    if not node_id:
+        raise ValueError("TXT record has no id")
+    if "s" in props:
+        skills = [op for op in props["s"].split(",") if op]
+    elif props.get("skills"):
+        skills = json.loads(props["skills"])
+        if not isinstance(skills, list):
+            raise ValueError("skills is not a list")
+    else:
+        skills = []
+    return {"id": node_id, "skills": skills, "metrics": _decode_metrics(props), "url": props.get("url") or None}
+
+
+# ----- ADVERTISER -----
+class Advertiser:
+    """Publishes a node over mDNS only when its metrics change meaningfully.
+
+    Call tick() every ADVERTISE_CHECK seconds. get_metrics may be None for a
+    node without metrics; it is then re-announced on the heartbeat only, which
+    keeps it from expiring on listeners.
+
+    `packets_est` is an estimate, not a count of sent packets: with zeroconf's
+    defaults a registration is 3 probes + 3 announcements and an update is 3
+    announcements.
+    """
+
+    def __init__(self, zc, node_id, ip, port, skills, get_metrics=None, url=None,
+                 heartbeat=ADVERTISE_HEARTBEAT, thresholds=ADVERTISE_THRESHOLDS):
+        if ServiceInfo is None:
+            raise RuntimeError("zeroconf is not installed (pip install zeroconf)")
+        self.zc = zc
+        self.node_id = node_id
+        self.ip = ip
+        self.port = port
+        self.skills = list(skills)
+        self.get_metrics = get_metrics
+        self.url = url
+        self.heartbeat = heartbeat
+        self.thresholds = thresholds
+        self.info = None
+        self.last = None
+        self.next_heartbeat = 0.0
+        self.stats = {"announcements": 0, "heartbeats": 0, "suppressed": 0, "packets_est": 0, "txt_bytes": 0}
+
+    def _changed(self, metrics):
+        if metrics is None or self.last is None:
+            return False
+        for key, threshold in self.thresholds.items():
+            new, old = metrics.get(key), self.last.get(key)
+            if (new is None) != (old is None):
+                return True
+            if new is not None and abs(new - old) >= threshold:
+                return True
+        return False
+
+    def tick(self):
+        """Publish if needed; True when an announcement went out."""
+        metrics = self.get_metrics() if self.get_metrics else None
+        now = time.monotonic()
+        if self.info is not None and not self._changed(metrics):
+            if now < self.next_heartbeat:
+                self.stats["suppressed"] += 1
+                return False
+            self.stats["heartbeats"] += 1
+        self.publish(metrics)
+        self.next_heartbeat = now + self.heartbeat * random.uniform(0.9, 1.1)
+        return True
+
+    def publish(self, metrics):
+        info = ServiceInfo(
+            SERVICE_TYPE,
+            f"{self.node_id}.{SERVICE_TYPE}",
+            addresses=[socket.inet_aton(self.ip)],
+            port=self.port,
+            properties=encode_txt(self.node_id, self.skills, metrics, self.url),
+            # update_service (unlike register_service) does not fill in the host name
+            server=f"{self.node_id}.local.",
+        )
+        if self.info is None:
+            self.zc.register_service(info)
+            self.stats["packets_est"] += 6
+        else:
+            # a new ServiceInfo under the same name; mutating info.properties
+            # does not change the record zeroconf sends
+            self.zc.update_service(info)
+            self.stats["packets_est"] += 3
+        self.info = info
+        self.last = metrics
+        self.stats["announcements"] += 1
+        self.stats["txt_bytes"] = len(info.text)
+
+    def run(self, interval=ADVERTISE_CHECK, on_announce=None):
+        """Tick forever (run on a daemon thread)."""
+        while True:
+            if self.tick() and on_announce is not None:
+                on_announce(self)
+            time.sleep(interval)
+
+
+# ----- METRICS SAMPLER -----
+# get_node_metrics() runs on every /info request and advertiser tick, so it
+# only reads the cached values; probing happens on a background thread.
+CPU_SAMPLE_INTERVAL = 2         # seconds between CPU samples
+BATTERY_SAMPLE_INTERVAL = 60    # termux-battery-status is slow and battery moves slowly
+CPU_EWMA_ALPHA = 0.3            # weight of the newest CPU sample
+
+
+def battery_from_termux():
+    """Battery level via the Termux API (spawns a process: ~100s of ms)."""
+    out = subprocess.check_output(["termux-battery-status"], timeout=10)
+    return json.loads(out.decode()).get("percentage")
+
+
+def battery_from_psutil():
+    bat = psutil.sensors_battery()
+    return bat.percent if bat else None
+
+
+def cpu_from_top():
+    """Last resort: parse `top` output (spawns a shell)."""
+    out = subprocess.check_output("top -bn1 | head -n 5", shell=True, timeout=10)
+    text = out.decode().lower()
+    for line in text.splitlines():
+        if "%cpu" in line:
+            num = "".join(ch for ch in line if ch.isdigit() or ch == '.')
+            return float(num) if num else 0.0
+    return 0.0
+
+
+class MetricsSampler:
+    """Samples CPU and battery in the background into a cached snapshot.
+
+    CPU falls back /proc/stat deltas -> psutil -> load average -> top; Android 8+
+    hides /proc/stat from apps, so a source that is missing or not permitted is
+    dropped for good.
+    Battery tries termux-battery-status, then psutil.
+    """
+
+    def __init__(self, cpu_interval=CPU_SAMPLE_INTERVAL, battery_interval=BATTERY_SAMPLE_INTERVAL,
+                 alpha=CPU_EWMA_ALPHA):
+        self.cpu_interval = cpu_interval
+        self.battery_interval = battery_interval
+        self.alpha = alpha
+        self.cpu_sources = [("proc", self._cpu_from_proc), ("psutil", self._cpu_from_psutil),
+                            ("loadavg", self._cpu_from_loadavg), ("top", cpu_from_top)]
+        self.battery_sources = [("termux", battery_from_termux), ("psutil", battery_from_psutil)]
+        self.cpu = None
+        self.battery = None
+        self.samples = 0
+        self._prev_stat = None
+        self._next_battery = 0.0
+        self._started = False
+
+    def _cpu_from_proc(self):
+        with open("/proc/stat") as f:
+            values = [int(v) for v in f.readline().split()[1:9]]
+        idle = values[3] + values[4]            # idle + iowait
+        busy, total = sum(values) - idle, sum(values)
+        prev, self._prev_stat = self._prev_stat, (busy, total)
+        if prev is None or total == prev[1]:
+            return None                         # need two readings for a delta
+        return (busy - prev[0]) * 100.0 / (total - prev[1])
+
+    def _cpu_from_psutil(self):
+        return psutil.cpu_percent(interval=None)
+
+    def _cpu_from_loadavg(self):
+        return min(os.getloadavg()[0] / (os.cpu_count() or 1) * 100.0, 100.0)
+
+    def _first_working(self, sources):
+        for name, probe in list(sources):
+            try:
+                return name, probe()
+            except subprocess.SubprocessError:
+                continue                        # slow or failed this time; keep it
+            except Exception:
+                sources.remove((name, probe))   # missing / not permitted on this device
+        return None, None
+
+    def sample(self):
+        _, cpu = self._first_working(self.cpu_sources)
+        if cpu is not None:
+            self.cpu = cpu if self.cpu is None else self.alpha * cpu + (1 - self.alpha) * self.cpu
+            self.samples += 1
+        now = time.monotonic()
+        if now >= self._next_battery:
+            self._next_battery = now + self.battery_interval
+            _, self.battery = self._first_working(self.battery_sources)
+
+    def run(self):
+        while True:
+            time.sleep(self.cpu_interval)
+            self.sample()
+
+    def start(self):
+        """Prime /proc/stat, read the battery once and start the sampling thread (once)."""
+        if self._started:
+            return
+        self._started = True
+        self.sample()
+        threading.Thread(target=self.run, name="metrics-sampler", daemon=True).start()
+
+    def stats(self):
+        return {
+            "cpu_source": self.cpu_sources[0][0] if self.cpu_sources else None,
+            "battery_source": self.battery_sources[0][0] if self.battery_sources else None,
+            "samples": self.samples,
+        }
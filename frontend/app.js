@@ -119,7 +119,7 @@ dispatchAllBtn.addEventListener('click', async () => {
     // 优先使用当初 AI 返回并保存在 data-task 的完整任务对象（包含 target_node）
     try {
       const t = JSON.parse(card.dataset.task || '{}');
-      return { op: t.op, params: t.params || {}, target_node: t.target_node };
+      return { id: t.id, op: t.op, params: t.params || {}, target_node: t.target_node, depends_on: t.depends_on };
     } catch(e) {
       // 兜底：从 DOM 恢复
       const opText = card.querySelector('.task-header').textContent || '';
@@ -138,13 +138,17 @@ dispatchAllBtn.addEventListener('click', async () => {
 
   log('提交 pipeline 给后端 /task');
   try {
-    const r = await fetch('/task', { method: 'POST', headers, body: JSON.stringify({ pipeline: tasks }) });
-    const js = await r.json();
+    // 用 SSE 显示进度时声明 stream，后端才会逐 token 推送生成中的文字
+    const stream = !!window.EventSource;
+    const r = await fetch('/task', { method: 'POST', headers, body: JSON.stringify({ pipeline: tasks, stream }) });
+    let js = await r.json();
     if (!r.ok) throw new Error(JSON.stringify(js));
     log('提交成功，task_id=' + js.task_id);
-    alert('提交成功，task_id=' + js.task_id);
-    // 显示 final_state（如果后端同步返回）
-    if (js.final_state) {
+    // 后端异步执行：优先用 SSE 实时显示进度和生成中的文字，不支持时退回轮询 /result
+    js = stream ? await streamResult(js.task_id, token, headers) : await pollResult(js.task_id, headers);
+    if (js.status === 'error') throw new Error(js.error);
+    // 流式过程中已显示的扇出结果（自定义 output_var）不要被 '(无)' 覆盖
+    if (js.final_state && (js.final_state.english_poem || js.final_state.chinese_poem)) {
       const en = js.final_state.english_poem || '(无)';
       const zh = js.final_state.chinese_poem || '(无)';
       document.getElementById('englishPoem').textContent = en;
@@ -157,6 +161,59 @@ dispatchAllBtn.addEventListener('click', async () => {
   }
 });
 
+function streamResult(taskId, token, headers) {
+  // 按步骤累积 token；generate_poem_en 的输出显示在英文区域，translate_zh 的显示在中文区域
+  const texts = {};
+  const targets = { generate_poem_en: 'englishPoem', translate_zh: 'chinesePoem' };
+  const render = (op) => {
+    const el = document.getElementById(targets[op]);
+    if (!el) return;
+    el.textContent = Object.values(texts).filter(t => t.op === op).map(t => t.text).join('\n\n');
+  };
+  return new Promise((resolve, reject) => {
+    const url = `/task/${encodeURIComponent(taskId)}/stream` + (token ? `?token=${encodeURIComponent(token)}` : '');
+    const es = new EventSource(url);
+    es.addEventListener('step_started', e => {
+      const d = JSON.parse(e.data);
+      texts[d.step] = { op: d.op, text: '' };
+      log(`步骤 ${d.step} (${d.op}) 开始，节点 ${d.node}`);
+    });
+    es.addEventListener('token', e => {
+      const d = JSON.parse(e.data);
+      if (!texts[d.step]) texts[d.step] = { op: d.op, text: '' };
+      texts[d.step].text += d.text;
+      render(d.op);
+    });
+    es.addEventListener('step_finished', e => {
+      const d = JSON.parse(e.data);
+      log(`步骤 ${d.step} (${d.op}) ${d.status === 'done' ? '完成' : '失败：' + d.error}`);
+    });
+    es.addEventListener('task_finished', e => {
+      es.close();
+      resolve(JSON.parse(e.data));
+    });
+    es.onerror = () => {
+      // 连接中断（代理超时、网络切换等）不等于任务失败：改为轮询 /result 直到任务结束
+      es.close();
+      log('SSE 连接中断，改为轮询结果');
+      pollResult(taskId, headers).then(resolve, reject);
+    };
+  });
+}
+
+async function pollResult(taskId, headers) {
+  let lastSteps = '';
+  while (true) {
+    const r = await fetch('/result/' + taskId, { headers });
+    const js = await r.json();
+    if (!r.ok) throw new Error(JSON.stringify(js));
+    const steps = (js.steps || []).map(s => `${s.op}:${s.status}`).join(', ');
+    if (steps !== lastSteps) { log(`任务进度 [${js.status}] ${steps}`); lastSteps = steps; }
+    if (js.status === 'done' || js.status === 'error') return js;
+    await new Promise(res => setTimeout(res, 1000));
+  }
+}
+
 function mockAnalyze(command) {
   // 返回示例结构：两个任务：生成英文诗（本地 nodeA），翻译成中文（nodeB）
   return {
@@ -5,15 +5,40 @@ Copy of echonet_node.py for instance2
 # NOTE: this file is a copy of the main echonet_node implementation and
 # expects a nodes.json and .env to be present in the same directory.
 
+import atexit
 import json
 import logging
 import os
-from typing import Any, Dict, Optional
+import random
+import socket
+import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 from flask import Flask, request, jsonify
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import APIConnectionError, APIStatusError, OpenAI, RateLimitError
+
+try:
+    # optional: pip install "httpx[http2]" and set PEER_HTTP2=1 for HTTP/2 between nodes
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    # optional: pip install zeroconf to discover peers on the LAN (_echotest._tcp.local.)
+    from zeroconf import ServiceBrowser, Zeroconf
+except ImportError:
+    Zeroconf = None
+
+# the shared mDNS helpers (echonet_discovery.py) live in the repo root, one level up
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from echonet_discovery import ADVERTISE_CHECK, NODE_TTL, SERVICE_TYPE, Advertiser, decode_txt, get_local_ip
 
 # 加载 .env（如果存在）
 load_dotenv()
@@ -34,7 +59,6 @@ with open(CONFIG_PATH, "r", encoding="utf-8") as f:
 
 SELF_ID = CONFIG.get("self_id")
 SELF_URL = CONFIG.get("self_url")
-NODES = CONFIG.get("nodes", [])
 
 if not SELF_ID or not SELF_URL:
     logger.error("nodes.json must contain self_id and self_url fields.")
@@ -46,10 +70,213 @@ if not OPENAI_API_KEY:
     logger.warning("OPENAI_API_KEY not set. GPT calls will fail until you set the key in env or .env file.")
     client: Optional[OpenAI] = None
 else:
+    # 重试由 _call_openai_chat 负责（限速 + 带抖动的退避），客户端自身不再重试
     try:
-        client = OpenAI(api_key=OPENAI_API_KEY)
+        client = OpenAI(api_key=OPENAI_API_KEY, max_retries=0)
     except Exception:
-        client = OpenAI()
+        client = OpenAI(max_retries=0)
+
+
+# ====== 节点间连接池 ======
+PEER_POOL_SIZE = int(os.getenv("PEER_POOL_SIZE", "16"))
+PEER_CONNECT_TIMEOUT = float(os.getenv("PEER_CONNECT_TIMEOUT", "3"))
+PEER_READ_TIMEOUT = float(os.getenv("PEER_READ_TIMEOUT", "60"))
+PEER_HTTP2 = os.getenv("PEER_HTTP2", "0") == "1"
+
+
+class PeerPool:
+    """One keep-alive client per peer base url, shared by all request threads."""
+
+    def __init__(self, pool_size: int, connect_timeout: float, read_timeout: float, http2: bool = False):
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.http2 = http2 and httpx is not None
+        if http2 and httpx is None:
+            logger.warning("PEER_HTTP2=1 but httpx is not installed; falling back to HTTP/1.1 keep-alive")
+        self._clients: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+        self._h2_counts: Dict[str, Dict[str, int]] = {}
+
+    def _client(self, base_url: str) -> Any:
+        client = self._clients.get(base_url)
+        if client is not None:
+            return client
+        with self._lock:
+            client = self._clients.get(base_url)
+            if client is None:
+                if self.http2:
+                    client = httpx.Client(
+                        http2=True,
+                        limits=httpx.Limits(max_connections=self.pool_size,
+                                            max_keepalive_connections=self.pool_size),
+                    )
+                    self._h2_counts[base_url] = {"requests": 0, "connections_opened": 0}
+                else:
+                    client = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=False)
+                    client.mount("http://", adapter)
+                    client.mount("https://", adapter)
+                self._clients[base_url] = client
+        return client
+
+    def post(self, base_url: str, path: str, json: Any = None, timeout: Any = None) -> Any:
+        base_url = base_url.rstrip("/")
+        client = self._client(base_url)
+        timeout = timeout or self.timeout
+        if not self.http2:
+            return client.post(base_url + path, json=json, timeout=timeout)
+
+        counts = self._h2_counts[base_url]
+
+        def trace(event: str, info: Any) -> None:
+            if event == "connection.connect_tcp.complete":
+                counts["connections_opened"] += 1
+
+        counts["requests"] += 1
+        return client.post(
+            base_url + path, json=json,
+            timeout=httpx.Timeout(timeout[1], connect=timeout[0]),
+            extensions={"trace": trace},
+        )
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        out = {}
+        for base_url, client in list(self._clients.items()):
+            if self.http2:
+                c = self._h2_counts[base_url]
+                opened, total = c["connections_opened"], c["requests"]
+            else:
+                opened = total = 0
+                # the same adapter is mounted for http:// and https://
+                adapters = {id(a): a for a in client.adapters.values()}
+                for adapter in adapters.values():
+                    pools = adapter.poolmanager.pools
+                    for key in pools.keys():
+                        pool = pools.get(key)
+                        if pool is not None:
+                            opened += pool.num_connections
+                            total += pool.num_requests
+            out[base_url] = {
+                "requests": total,
+                "connections_opened": opened,
+                "connections_reused": max(total - opened, 0),
+            }
+        return out
+
+
+PEER_POOL = PeerPool(PEER_POOL_SIZE, PEER_CONNECT_TIMEOUT, PEER_READ_TIMEOUT, http2=PEER_HTTP2)
+
+
+# ====== 上游限速：按 OpenAI 的 RPM / TPM 额度排队，429 / 5xx 带抖动退避重试 ======
+# 为 0 时先不限速，从响应头 x-ratelimit-limit-* 学到额度后自动生效
+OPENAI_RPM = float(os.getenv("OPENAI_RPM", "0"))
+OPENAI_TPM = float(os.getenv("OPENAI_TPM", "0"))
+OPENAI_RATE_HEADROOM = float(os.getenv("OPENAI_RATE_HEADROOM", "0.9"))
+OPENAI_RATE_BURST_S = float(os.getenv("OPENAI_RATE_BURST_S", "5"))
+OPENAI_EST_COMPLETION_TOKENS = int(os.getenv("OPENAI_EST_COMPLETION_TOKENS", "256"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "4"))
+OPENAI_BACKOFF_BASE = float(os.getenv("OPENAI_BACKOFF_BASE", "0.5"))
+OPENAI_BACKOFF_MAX = float(os.getenv("OPENAI_BACKOFF_MAX", "20"))
+
+
+class TokenBucketLimiter:
+    """Request and token buckets refilled at the per-minute limits.
+
+    reserve() deducts up front and returns how long the caller must sleep; a negative
+    level makes later callers wait longer, so waiting threads are served in order.
+    """
+
+    def __init__(self, rpm: float, tpm: float, headroom: float, burst_seconds: float):
+        self.headroom = headroom
+        self.burst_seconds = burst_seconds
+        self._configured = {"requests": rpm > 0, "tokens": tpm > 0}
+        self._buckets: Dict[str, Dict[str, float]] = {"requests": {"level": 0.0}, "tokens": {"level": 0.0}}
+        self._set_limit("requests", rpm, fill=True)
+        self._set_limit("tokens", tpm, fill=True)
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _set_limit(self, name: str, per_minute: float, fill: bool = False) -> None:
+        b = self._buckets[name]
+        b["limit"] = per_minute
+        b["rate"] = per_minute * self.headroom / 60.0
+        b["capacity"] = max(b["rate"] * self.burst_seconds, 1.0)
+        b["level"] = b["capacity"] if fill else min(b["level"], b["capacity"])
+        b["ts"] = time.monotonic()
+
+    def _refill(self, b: Dict[str, float], now: float) -> None:
+        if b["rate"]:
+            b["level"] = min(b["capacity"], b["level"] + (now - b["ts"]) * b["rate"])
+        b["ts"] = now
+
+    def reserve(self, tokens: int) -> float:
+        with self._lock:
+            now = time.monotonic()
+            wait = max(self._paused_until - now, 0.0)
+            for name, need in (("requests", 1), ("tokens", tokens)):
+                b = self._buckets[name]
+                if b["rate"]:
+                    self._refill(b, now)
+                    wait = max(wait, (need - b["level"]) / b["rate"])
+                    b["level"] -= need
+            return max(wait, 0.0)
+
+    def settle(self, estimated: int, actual: int) -> None:
+        with self._lock:
+            b = self._buckets["tokens"]
+            if b["rate"]:
+                b["level"] = min(b["capacity"], b["level"] + estimated - actual)
+
+    def observe(self, headers: Any) -> None:
+        """Learn limits from x-ratelimit-* and never assume more than the server says is left."""
+        with self._lock:
+            now = time.monotonic()
+            for name in ("requests", "tokens"):
+                try:
+                    limit = float(headers.get(f"x-ratelimit-limit-{name}") or 0)
+                    remaining = headers.get(f"x-ratelimit-remaining-{name}")
+                    remaining = float(remaining) if remaining is not None else None
+                except ValueError:
+                    continue
+                b = self._buckets[name]
+                if limit and not self._configured[name] and limit != b["limit"]:
+                    self._set_limit(name, limit, fill=b["limit"] == 0)
+                if remaining is not None and b["rate"]:
+                    self._refill(b, now)
+                    b["level"] = min(b["level"], remaining - b["limit"] * (1 - self.headroom))
+
+    def penalize(self, seconds: float) -> None:
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+OPENAI_LIMITER = TokenBucketLimiter(OPENAI_RPM, OPENAI_TPM, OPENAI_RATE_HEADROOM, OPENAI_RATE_BURST_S)
+
+
+def _retry_delay(e: Exception, attempt: int) -> Optional[float]:
+    """Seconds to wait before retrying a 429 / 5xx / connection error, or None if it is not retryable."""
+    if isinstance(e, APIStatusError):
+        if not (isinstance(e, RateLimitError) or e.status_code >= 500):
+            return None
+    elif not isinstance(e, APIConnectionError):
+        return None
+    if attempt >= OPENAI_MAX_RETRIES:
+        return None
+    # full jitter, but never sooner than the server's Retry-After
+    delay = random.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** attempt))
+    response = getattr(e, "response", None)
+    if response is not None:
+        try:
+            if response.headers.get("retry-after-ms"):
+                delay = max(delay, float(response.headers["retry-after-ms"]) / 1000.0)
+            elif response.headers.get("retry-after"):
+                delay = max(delay, float(response.headers["retry-after"]))
+        except ValueError:
+            pass
+        OPENAI_LIMITER.observe(response.headers)
+    if isinstance(e, RateLimitError):
+        OPENAI_LIMITER.penalize(delay)
+    return delay
 
 
 # ====== 技能实现 ======
@@ -57,10 +284,32 @@ def _call_openai_chat(prompt: str, model: str = "gpt-4o-mini") -> str:
     if not client:
         raise RuntimeError("OpenAI client not configured (OPENAI_API_KEY missing)")
 
-    resp = client.chat.completions.create(
-        model=model,
-        messages=[{"role": "user", "content": prompt}],
-    )
+    # 粗略估算：约 3 个字符一个 token，加上输出
+    estimate = len(prompt) // 3 + OPENAI_EST_COMPLETION_TOKENS
+    attempt = 0
+    while True:
+        wait = OPENAI_LIMITER.reserve(estimate)
+        if wait > 0:
+            time.sleep(wait)
+        try:
+            raw = client.chat.completions.with_raw_response.create(
+                model=model,
+                messages=[{"role": "user", "content": prompt}],
+            )
+            break
+        except Exception as e:
+            OPENAI_LIMITER.settle(estimate, 0)
+            delay = _retry_delay(e, attempt)
+            if delay is None:
+                raise
+            attempt += 1
+            logger.warning("OpenAI call failed (%s), retry %d in %.1fs", e, attempt, delay)
+            time.sleep(delay)
+    OPENAI_LIMITER.observe(raw.headers)
+    resp = raw.parse()
+    usage = getattr(resp, "usage", None)
+    if usage is not None and usage.total_tokens:
+        OPENAI_LIMITER.settle(estimate, usage.total_tokens)
 
     try:
         return resp.choices[0].message.content
@@ -73,19 +322,20 @@ def skill_generate_poem_en(state: Dict[str, Any], params: Dict[str, Any]) -> Dic
     logger.info("Generating english poem with prompt: %s", prompt)
     poem = _call_openai_chat(prompt, model=params.get("model", "gpt-4o-mini"))
     s = dict(state)
-    s["english_poem"] = poem
+    s[params.get("output_var", "english_poem")] = poem
     return s
 
 
 def skill_translate_zh(state: Dict[str, Any], params: Dict[str, Any]) -> Dict[str, Any]:
-    text = state.get("english_poem", "")
+    text_var = params.get("text_var", "english_poem")
+    text = state.get(text_var, "")
     if not text:
-        raise ValueError("state missing english_poem for translate_zh")
+        raise ValueError(f"state missing {text_var} for translate_zh")
     prompt = f"请把下面的英文诗翻译为中文诗（保留诗意）：\n\n{text}"
     logger.info("Translating english poem to Chinese")
     zh = _call_openai_chat(prompt, model=params.get("model", "gpt-4o-mini"))
     s = dict(state)
-    s["chinese_poem"] = zh
+    s[params.get("output_var", "chinese_poem")] = zh
     return s
 
 
@@ -94,23 +344,434 @@ SKILL_IMPL = {
     "translate_zh": skill_translate_zh,
 }
 
+# 技能读/写的 state key，用于推断 pipeline 中步骤之间的依赖；
+# params 中的 text_var / output_var 会替换默认的输入/输出 key
+SKILL_IO = {
+    "generate_poem_en": {"reads": [], "writes": ["english_poem"]},
+    "translate_zh": {"reads": ["english_poem"], "writes": ["chinese_poem"]},
+}
+
+STEP_WORKERS = int(os.getenv("STEP_WORKERS", "16"))
+STEP_EXECUTOR = ThreadPoolExecutor(max_workers=STEP_WORKERS, thread_name_prefix="step-worker")
+
+
+def _step_reads(op: str, params: Dict[str, Any]) -> Optional[Set[str]]:
+    io = SKILL_IO.get(op)
+    if io is None:
+        return None
+    reads = list(io["reads"])
+    if reads and params.get("text_var"):
+        reads[0] = params["text_var"]
+    return set(reads)
+
+
+def _step_writes(op: str, params: Dict[str, Any]) -> Optional[Set[str]]:
+    io = SKILL_IO.get(op)
+    if io is None:
+        return None
+    writes = list(io["writes"])
+    if writes and params.get("output_var"):
+        writes[0] = params["output_var"]
+    return set(writes)
+
+
+# ====== 节点注册表：nodes.json 作为种子，mDNS 发现的节点动态加入 / 离开 ======
+class RegistryView:
+    """Immutable membership snapshot with the op -> replicas index precomputed."""
+
+    def __init__(self, nodes: List[Dict[str, Any]], version: int):
+        self.version = version
+        self.nodes = tuple(nodes)
+        self.by_id = {n["id"]: n for n in self.nodes}
+        by_op: Dict[str, List[Dict[str, Any]]] = {}
+        for n in self.nodes:
+            for op in n.get("skills", []):
+                by_op.setdefault(op, []).append(n)
+        self.by_op = {op: tuple(replicas) for op, replicas in by_op.items()}
+
+
+class NodeRegistry:
+    """Seed nodes from nodes.json plus nodes discovered over mDNS.
+
+    A discovered node overrides the seed entry with the same id and falls back to it
+    when it leaves or is not heard from for ``ttl`` seconds. Readers use ``view``
+    without locking; writers swap in a new view.
+    """
+
+    def __init__(self, seed: List[Dict[str, Any]], ttl: float):
+        self.ttl = ttl
+        self._seed = {n["id"]: n for n in seed if n.get("id")}
+        self._discovered: Dict[str, Tuple[Dict[str, Any], float]] = {}  # node_id -> (node, last_seen)
+        self._lock = threading.Lock()
+        self._stats = {"joined": 0, "left": 0, "expired": 0}
+        self.view = RegistryView(list(self._seed.values()), 0)
+
+    def _rebuild(self) -> None:
+        merged = dict(self._seed)
+        for node_id, (node, _) in self._discovered.items():
+            merged[node_id] = node
+        self.view = RegistryView(list(merged.values()), self.view.version + 1)
+
+    def upsert(self, node: Dict[str, Any]) -> bool:
+        """Record a node (and refresh its last_seen); True when the view changed."""
+        with self._lock:
+            old = self._discovered.get(node["id"])
+            self._discovered[node["id"]] = (node, time.monotonic())
+            if old is not None and (old[0]["url"], sorted(old[0]["skills"])) == (node["url"], sorted(node["skills"])):
+                return False
+            if old is None:
+                self._stats["joined"] += 1
+            self._rebuild()
+            return True
+
+    def remove(self, node_id: str, expired: bool = False) -> bool:
+        with self._lock:
+            if self._discovered.pop(node_id, None) is None:
+                return False
+            self._stats["expired" if expired else "left"] += 1
+            self._rebuild()
+            return True
+
+    def expire(self) -> List[str]:
+        """Drop discovered nodes that vanished without a goodbye packet."""
+        now = time.monotonic()
+        stale = [node_id for node_id, (_, seen) in list(self._discovered.items()) if now - seen > self.ttl]
+        return [node_id for node_id in stale if self.remove(node_id, expired=True)]
+
+    def stats(self) -> Dict[str, Any]:
+        view = self.view
+        return dict(self._stats, version=view.version, nodes=len(view.nodes), discovered=len(self._discovered),
+                    ops={op: [n["id"] for n in replicas] for op, replicas in view.by_op.items()})
+
+
+# devices re-advertise at least every 30 s; a node silent for 2.5 heartbeats is gone
+DISCOVERY_TTL = float(os.getenv("DISCOVERY_TTL", str(NODE_TTL)))
+REGISTRY = NodeRegistry(CONFIG.get("nodes", []), DISCOVERY_TTL)
+
 
 def get_self_skills() -> set:
-    for n in NODES:
-        if n.get("id") == SELF_ID:
-            return set(n.get("skills", []))
-    return set()
+    node = REGISTRY.view.by_id.get(SELF_ID)
+    return set(node.get("skills", [])) if node else set()
 
 
 SELF_SKILL_SET = get_self_skills()
 logger.info("Node %s (%s) skills: %s", SELF_ID, SELF_URL, sorted(SELF_SKILL_SET))
 
 
+# node_id -> {"health", "load", "ts"} from the node's mDNS advert
+PEER_METRICS: Dict[str, Dict[str, float]] = {}
+# steps this node has dispatched to each node (itself included) and not yet seen return
+INFLIGHT: Dict[str, int] = {}
+_INFLIGHT_LOCK = threading.Lock()
+
+
+def _track_inflight(node_id: str, delta: int) -> None:
+    with _INFLIGHT_LOCK:
+        INFLIGHT[node_id] = INFLIGHT.get(node_id, 0) + delta
+
+
+def _node_load(node_id: str) -> Tuple[float, int]:
+    """(health, load): advertised load plus our own in-flight steps on that node."""
+    inflight = INFLIGHT.get(node_id, 0)
+    if node_id == SELF_ID:
+        return 1.0, inflight
+    m = PEER_METRICS.get(node_id)
+    if m is None or time.time() - m["ts"] > DISCOVERY_TTL:
+        # unknown or stale metrics: treat as middling so known-healthy replicas win
+        return 0.5, inflight
+    return m["health"], int(m["load"]) + inflight
+
+
 def find_node_for_op(op: str) -> Optional[Dict[str, Any]]:
-    for n in NODES:
-        if op in n.get("skills", []):
-            return n
-    return None
+    """Power-of-two-choices over the replicas, like net.py: sample two weighted by
+    health and take the one with the lower load / health."""
+    replicas = REGISTRY.view.by_op.get(op)
+    if not replicas:
+        return None
+    if len(replicas) == 1:
+        return replicas[0]
+    loads = {n["id"]: _node_load(n["id"]) for n in replicas}
+    first = random.choices(replicas, weights=[loads[n["id"]][0] + 0.05 for n in replicas])[0]
+    rest = [n for n in replicas if n is not first]
+    second = random.choices(rest, weights=[loads[n["id"]][0] + 0.05 for n in rest])[0]
+
+    def cost(n: Dict[str, Any]) -> float:
+        health, load = loads[n["id"]]
+        return (load + 1) / max(health, 0.05)
+
+    return min((first, second), key=cost)
+
+
+# ====== mDNS 发现（与 net.py / PWA_echonet 相同的服务类型） ======
+DISCOVERY = os.getenv("DISCOVERY", "1") == "1"
+DISCOVERY_ADVERTISE = os.getenv("DISCOVERY_ADVERTISE", "1") == "1"
+DISCOVERY_SERVICE = SERVICE_TYPE
+# {"advertiser": Advertiser} once this process has registered its service
+ADVERTISER: Dict[str, Any] = {}
+
+
+def _node_from_service(info: Any) -> Tuple[Dict[str, Any], Optional[Dict[str, float]]]:
+    """(node, metrics) from a service; raises ValueError for an unusable TXT record."""
+    rec = decode_txt(info.properties)
+    url = rec["url"]
+    if not url:
+        addresses = info.parsed_addresses()
+        if not addresses:
+            raise ValueError("service has no address")
+        url = f"http://{addresses[0]}:{info.port}"
+    node = {"id": rec["id"], "url": url.rstrip("/"), "skills": list(rec["skills"])}
+    m = rec["metrics"]
+    try:
+        metrics = {"health": float(m.get("health", 1.0)), "load": float(m.get("load", 0) or 0)} if m else None
+    except (TypeError, ValueError):
+        metrics = None
+    return node, metrics
+
+
+class DiscoveryListener:
+    def __init__(self) -> None:
+        self._names: Dict[str, str] = {}
+
+    def add_service(self, zc: Any, service_type: str, name: str) -> None:
+        info = zc.get_service_info(service_type, name)
+        if not info:
+            return
+        try:
+            node, metrics = _node_from_service(info)
+        except ValueError as e:
+            logger.warning("Ignoring mDNS service %s: %s", name, e)
+            return
+        if node["id"] == SELF_ID:
+            return
+        self._names[name] = node["id"]
+        if REGISTRY.upsert(node):
+            logger.info("Discovered node %s @ %s skills=%s", node["id"], node["url"], node["skills"])
+        if metrics is not None:
+            PEER_METRICS[node["id"]] = dict(metrics, ts=time.time())
+
+    update_service = add_service
+
+    def remove_service(self, zc: Any, service_type: str, name: str) -> None:
+        node_id = self._names.pop(name, None)
+        if node_id and REGISTRY.remove(node_id):
+            PEER_METRICS.pop(node_id, None)
+            logger.info("Node %s left", node_id)
+
+
+def _expire_nodes() -> None:
+    while True:
+        time.sleep(max(1.0, DISCOVERY_TTL / 5))
+        for node_id in REGISTRY.expire():
+            PEER_METRICS.pop(node_id, None)
+            logger.info("Node %s expired (no advert for %.0fs)", node_id, DISCOVERY_TTL)
+
+
+def _advertise_self(zc: Any) -> None:
+    """Advertise through the shared Advertiser. This node has no metrics, so it is
+    re-announced every ADVERTISE_HEARTBEAT seconds to stay within peers' NODE_TTL."""
+    parsed = urllib.parse.urlsplit(SELF_URL)
+    host = parsed.hostname or "127.0.0.1"
+    port = parsed.port or 80
+    url = SELF_URL
+    if host in ("127.0.0.1", "localhost", "0.0.0.0"):
+        # a loopback url is useless to other devices; advertise the LAN address instead
+        host = get_local_ip()
+        url = f"{parsed.scheme}://{host}:{port}"
+    adv = Advertiser(zc, SELF_ID, socket.gethostbyname(host), port, SELF_SKILL_SET, url=url)
+    try:
+        adv.tick()
+    except Exception as e:
+        # with several worker processes only one can register the service name
+        logger.warning("mDNS advertise skipped: %s", e)
+        return
+    ADVERTISER["advertiser"] = adv
+    while True:
+        time.sleep(ADVERTISE_CHECK)
+        try:
+            adv.tick()
+        except Exception as e:
+            # keep going: giving up would let peers expire this node after NODE_TTL
+            logger.warning("mDNS advertise failed: %s", e)
+
+
+_DISCOVERY_STARTED = threading.Event()
+_DISCOVERY_LOCK = threading.Lock()
+
+
+def start_discovery() -> None:
+    """Start mDNS browsing/advertising once. Called from __main__, or by the first
+    request when the app is loaded through serve.py -- never at import time."""
+    if not DISCOVERY:
+        return
+    with _DISCOVERY_LOCK:
+        if _DISCOVERY_STARTED.is_set():
+            return
+        _DISCOVERY_STARTED.set()
+    if Zeroconf is None:
+        logger.info("zeroconf not installed; routing from nodes.json only")
+        return
+    zc = Zeroconf(ip_version=4)
+    # send goodbye packets on a clean exit so peers drop this node right away
+    atexit.register(zc.close)
+    ServiceBrowser(zc, DISCOVERY_SERVICE, DiscoveryListener())
+    threading.Thread(target=_expire_nodes, name="mdns-expire", daemon=True).start()
+    if DISCOVERY_ADVERTISE:
+        threading.Thread(target=_advertise_self, args=(zc,), name="mdns-advertise", daemon=True).start()
+
+
+@app.before_request
+def _discovery_on_first_request() -> None:
+    if DISCOVERY and not _DISCOVERY_STARTED.is_set():
+        start_discovery()
+
+
+class StepFailed(Exception):
+    """A pipeline step failed; carries the HTTP error body and status to return."""
+
+    def __init__(self, body: Dict[str, Any], status: int):
+        super().__init__(body.get("error"))
+        self.body = body
+        self.status = status
+
+
+def _build_dag(pipeline: List[Dict[str, Any]]) -> List[Set[int]]:
+    """Return deps[i], the indexes of the steps that step i waits for.
+
+    Explicit ``depends_on`` (a list of step ids) wins; otherwise dependencies are
+    inferred from SKILL_IO so that steps touching the same state key keep their
+    original order. Skills without declared IO act as barriers.
+    """
+    ids = [str(step.get("id") or f"s{i}") for i, step in enumerate(pipeline)]
+    index: Dict[str, int] = {}
+    for i, sid in enumerate(ids):
+        if sid in index:
+            raise ValueError(f'duplicate step id "{sid}"')
+        index[sid] = i
+
+    io = [(_step_reads(step["op"], step.get("params") or {}),
+           _step_writes(step["op"], step.get("params") or {})) for step in pipeline]
+
+    deps: List[Set[int]] = []
+    for i, step in enumerate(pipeline):
+        explicit = step.get("depends_on")
+        if explicit is not None:
+            if not isinstance(explicit, list):
+                raise ValueError(f'step "{ids[i]}" depends_on must be a list')
+            missing = [ref for ref in explicit if str(ref) not in index]
+            if missing:
+                raise ValueError(f'step "{ids[i]}" depends on unknown step "{missing[0]}"')
+            deps.append({index[str(ref)] for ref in explicit})
+            continue
+
+        reads_i, writes_i = io[i]
+        d = set()
+        for j in range(i):
+            reads_j, writes_j = io[j]
+            if reads_i is None or writes_j is None:
+                d.add(j)
+            elif (writes_j & reads_i) or (writes_j & writes_i) or (reads_j & writes_i):
+                d.add(j)
+        deps.append(d)
+
+    remaining, done = set(range(len(pipeline))), set()
+    while remaining:
+        ready = {i for i in remaining if deps[i] <= done}
+        if not ready:
+            raise ValueError("pipeline depends_on contains a cycle")
+        done |= ready
+        remaining -= ready
+    return deps
+
+
+def _run_step(step: Dict[str, Any], state: Dict[str, Any]) -> Dict[str, Any]:
+    target_node = find_node_for_op(step["op"])
+    if target_node is None:
+        raise StepFailed({"error": f"no node can handle op={step['op']}"}, 400)
+    _track_inflight(target_node["id"], 1)
+    try:
+        return _run_step_on(target_node, step, state)
+    finally:
+        _track_inflight(target_node["id"], -1)
+
+
+def _run_step_on(target_node: Dict[str, Any], step: Dict[str, Any], state: Dict[str, Any]) -> Dict[str, Any]:
+    op = step["op"]
+    params = step.get("params", {}) or {}
+
+    if target_node.get("id") == SELF_ID:
+        impl = SKILL_IMPL.get(op)
+        if impl is None:
+            raise StepFailed({"error": f"skill {op} not implemented on this node"}, 500)
+        try:
+            return impl(state, params)
+        except Exception as e:
+            logger.exception("Local skill %s failed: %s", op, e)
+            raise StepFailed({"error": "local skill failed", "detail": str(e)}, 500)
+
+    url = target_node.get("url", "").rstrip("/") + "/execute_step"
+    # send only the keys the skill reads and ask for a delta of the keys it writes
+    reads = _step_reads(op, params)
+    sent_state = state if reads is None else {k: state[k] for k in reads if k in state}
+    payload = {"op": op, "params": params, "state": sent_state, "delta": True}
+    try:
+        resp = PEER_POOL.post(target_node.get("url", ""), "/execute_step", json=payload)
+    except Exception as e:
+        logger.exception("Request to %s failed: %s", url, e)
+        raise StepFailed({"error": "remote request failed", "detail": str(e)}, 500)
+
+    if resp.status_code != 200:
+        logger.error("Remote node %s returned %s: %s", target_node.get("id"), resp.status_code, resp.text)
+        raise StepFailed({"error": "remote node failed", "detail": resp.text}, 500)
+
+    try:
+        resp_json = resp.json()
+    except Exception:
+        raise StepFailed({"error": "remote node returned non-json", "detail": resp.text}, 500)
+
+    if "delta" in resp_json:
+        merged = dict(state)
+        merged.update(resp_json["delta"])
+        return merged
+    # older nodes ignore "delta" and return the full state
+    return resp_json.get("state", {})
+
+
+def _run_pipeline(pipeline: List[Dict[str, Any]], state: Dict[str, Any]) -> Dict[str, Any]:
+    """Dispatch every step whose dependencies are satisfied concurrently and
+    merge each step's state changes in step order, so the result is deterministic."""
+    deps = _build_dag(pipeline)
+    pending = set(range(len(pipeline)))
+    done: Set[int] = set()
+    running: Dict[Any, int] = {}
+    snapshots: Dict[int, Dict[str, Any]] = {}
+    failure: Optional[StepFailed] = None
+
+    while (pending and failure is None) or running:
+        if failure is None:
+            for i in sorted(i for i in pending if deps[i] <= done):
+                pending.discard(i)
+                snapshots[i] = dict(state)
+                running[STEP_EXECUTOR.submit(_run_step, pipeline[i], dict(snapshots[i]))] = i
+        if not running:
+            break
+
+        completed, _ = wait(list(running), return_when=FIRST_COMPLETED)
+        for fut in sorted(completed, key=lambda f: running[f]):
+            i = running.pop(fut)
+            exc = fut.exception()
+            if exc is not None:
+                if failure is None:
+                    failure = exc if isinstance(exc, StepFailed) else StepFailed(
+                        {"error": "step failed", "detail": str(exc)}, 500)
+                continue
+            before = snapshots.pop(i)
+            new_state = fut.result()
+            state.update({k: v for k, v in new_state.items() if k not in before or before[k] != v})
+            done.add(i)
+
+    if failure is not None:
+        raise failure
+    return state
 
 
 @app.route("/task", methods=["POST"])
@@ -126,44 +787,18 @@ def handle_task():
     state = data.get("state", {}) or {}
 
     for step in pipeline:
-        op = step.get("op")
-        params = step.get("params", {}) or {}
-
-        if not op:
+        if not isinstance(step, dict) or not step.get("op"):
             return jsonify({"error": "step missing op"}), 400
 
-        target_node = find_node_for_op(op)
-        if target_node is None:
-            return jsonify({"error": f"no node can handle op={op}"}), 400
-
-        if target_node.get("id") == SELF_ID:
-            impl = SKILL_IMPL.get(op)
-            if impl is None:
-                return jsonify({"error": f"skill {op} not implemented on this node"}), 500
-            try:
-                state = impl(state, params)
-            except Exception as e:
-                logger.exception("Local skill %s failed: %s", op, e)
-                return jsonify({"error": "local skill failed", "detail": str(e)}), 500
-        else:
-            url = target_node.get("url", "").rstrip("/") + "/execute_step"
-            payload = {"op": op, "params": params, "state": state}
-            try:
-                resp = requests.post(url, json=payload, timeout=60)
-            except Exception as e:
-                logger.exception("Request to %s failed: %s", url, e)
-                return jsonify({"error": "remote request failed", "detail": str(e)}), 500
-
-            if resp.status_code != 200:
-                logger.error("Remote node %s returned %s: %s", target_node.get("id"), resp.status_code, resp.text)
-                return jsonify({"error": "remote node failed", "detail": resp.text}), 500
-
-            try:
-                resp_json = resp.json()
-            except Exception:
-                return jsonify({"error": "remote node returned non-json", "detail": resp.text}), 500
-
-            state = resp_json.get("state", {})
+    try:
+        _build_dag(pipeline)
+    except ValueError as e:
+        return jsonify({"error": "invalid pipeline", "detail": str(e)}), 400
+
+    try:
+        state = _run_pipeline(pipeline, state)
+    except StepFailed as e:
+        return jsonify(e.body), e.status
 
     return jsonify({"final_state": state})
 
@@ -186,12 +821,14 @@ def execute_step():
         return jsonify({"error": f"skill {op} not implemented in code"}), 500
 
     try:
-        state = impl(state, params)
+        new_state = impl(state, params)
     except Exception as e:
         logger.exception("Skill %s execution failed: %s", op, e)
         return jsonify({"error": "skill execution failed", "detail": str(e)}), 500
 
-    return jsonify({"state": state})
+    if data.get("delta"):
+        return jsonify({"delta": {k: v for k, v in new_state.items() if k not in state or state[k] != v}})
+    return jsonify({"state": new_state})
 
 
 @app.route("/info", methods=["GET"])
@@ -200,10 +837,23 @@ def info():
         "id": SELF_ID,
         "url": SELF_URL,
         "skills": sorted(list(SELF_SKILL_SET)),
+        "registry": REGISTRY.stats(),
+        "advertiser": ADVERTISER["advertiser"].stats if ADVERTISER else None,
+        "inflight": dict(INFLIGHT),
+        "peer_pool": PEER_POOL.stats(),
     })
 
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", "5000"))
     logger.info("Starting Echonet node %s at %s (port=%s)", SELF_ID, SELF_URL, port)
-    app.run(host="0.0.0.0", port=port)
+    start_discovery()
+    # prefer waitress (multi-threaded) when installed; use serve.py for multiple worker processes
+    try:
+        from waitress import serve
+    except ImportError:
+        serve = None
+    if serve is not None and os.getenv("WEB_SERVER", "waitress") != "dev":
+        serve(app, host="0.0.0.0", port=port, threads=int(os.getenv("WEB_THREADS", "16")))
+    else:
+        app.run(host="0.0.0.0", port=port, threaded=True)
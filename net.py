@@ -1,112 +1,3292 @@
 # echonet_node.py
+import asyncio
+import atexit
+import contextvars
+import copy
+import hashlib
+import hmac
 import json
+import queue
+import random
 import re
+import secrets
+import socket
+import sqlite3
+import threading
+import time
+import unicodedata
+import urllib.parse
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import requests
-from flask import Flask, request, jsonify, send_from_directory
-from openai import OpenAI
+from requests.adapters import HTTPAdapter
+from flask import Flask, Response, request, jsonify, send_from_directory, stream_with_context
+from openai import APIConnectionError, APIStatusError, AsyncOpenAI, OpenAI, RateLimitError
 import os
 from dotenv import load_dotenv
 
-# 从项目根目录的 .env 加载环境变量（不会把密钥写入源码）
-load_dotenv()
+from echonet_discovery import ADVERTISE_CHECK, NODE_TTL, SERVICE_TYPE, Advertiser, decode_txt, get_local_ip
+
+try:
+    # 可选：安装 httpx[http2] 后可以用 PEER_HTTP2=1 让节点间调用走 HTTP/2
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    # 可选：有 psutil 时用它读取 CPU / 电量，否则退化为 loadavg
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    # 可选：安装 zeroconf 后通过 mDNS（_echotest._tcp.local.）发现局域网里的其他节点
+    from zeroconf import ServiceBrowser, Zeroconf
+except ImportError:
+    Zeroconf = None
+
+# 从项目根目录的 .env 加载环境变量（不会把密钥写入源码）
+load_dotenv()
+
+# 把 frontend 目录作为静态资源目录（避免跨域，便于直接在同一服务下提供 UI）
+app = Flask(__name__, static_folder='frontend', static_url_path='')
+
+
+# 根路径返回前端页面 index.html，避免浏览器访问 / 时 404
+@app.route('/', methods=['GET'])
+def root_index():
+    # Use an absolute path to be robust against different working directories
+    frontend_dir = os.path.join(os.path.dirname(__file__), 'frontend')
+    return send_from_directory(frontend_dir, 'index.html')
+
+# ====== 读取配置 ======
+with open("nodes.json", "r", encoding="utf-8") as f:
+    CONFIG = json.load(f)
+
+SELF_ID = CONFIG["self_id"]
+SELF_URL = CONFIG["self_url"]
+
+
+# ====== 节点注册表：nodes.json 作为种子，mDNS 发现的节点动态加入 / 离开 ======
+class RegistryView:
+    """某一时刻的集群成员快照，只读。op -> 副本列表等索引在成员变化时一次性建好，请求路径上直接查表"""
+
+    def __init__(self, nodes, version):
+        self.version = version
+        self.nodes = tuple(nodes)
+        self.by_id = {n["id"]: n for n in self.nodes}
+        by_op = {}
+        for n in self.nodes:
+            for op in n.get("skills", []):
+                by_op.setdefault(op, []).append(n)
+        self.by_op = {op: tuple(replicas) for op, replicas in by_op.items()}
+        self.ops = frozenset(self.by_op)
+        self.peers = tuple(n for n in self.nodes if n["id"] != SELF_ID)
+        raw = json.dumps([sorted((n["id"], n.get("url", ""), tuple(sorted(n.get("skills", []))))
+                                 for n in self.nodes), sorted(self.ops)], ensure_ascii=False)
+        self.fingerprint = hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class NodeRegistry:
+    """种子节点（nodes.json）+ 发现的节点。同一个 id 以发现到的信息为准，发现的节点消失后退回种子配置。
+
+    只有 url / skills 变化才会重建视图；读方拿到的 view 是不可变对象，替换引用即完成原子切换，不需要加锁。
+    """
+
+    def __init__(self, seed, ttl):
+        self.ttl = ttl
+        self._seed = {n["id"]: dict(n, source="seed") for n in seed}
+        self._discovered = {}  # node_id -> (node, last_seen)
+        self._lock = threading.Lock()
+        self._stats = {"rebuilds": 0, "joined": 0, "left": 0, "expired": 0}
+        self.view = RegistryView(self._seed.values(), 0)
+
+    def _rebuild(self):
+        merged = dict(self._seed)
+        for node_id, (node, _) in self._discovered.items():
+            merged[node_id] = node
+        self._stats["rebuilds"] += 1
+        self.view = RegistryView(merged.values(), self.view.version + 1)
+
+    def upsert(self, node):
+        node = dict(node, source="mdns")
+        with self._lock:
+            old = self._discovered.get(node["id"])
+            self._discovered[node["id"]] = (node, time.monotonic())
+            if old is not None and (old[0]["url"], sorted(old[0]["skills"])) == (node["url"], sorted(node["skills"])):
+                return False
+            if old is None:
+                self._stats["joined"] += 1
+            self._rebuild()
+            return True
+
+    def touch(self, node_id):
+        with self._lock:
+            entry = self._discovered.get(node_id)
+            if entry is not None:
+                self._discovered[node_id] = (entry[0], time.monotonic())
+
+    def remove(self, node_id, expired=False):
+        with self._lock:
+            if self._discovered.pop(node_id, None) is None:
+                return False
+            self._stats["expired" if expired else "left"] += 1
+            self._rebuild()
+            return True
+
+    def expire(self):
+        now = time.monotonic()
+        for node_id, (_, seen) in list(self._discovered.items()):
+            if now - seen > self.ttl:
+                self.remove(node_id, expired=True)
+
+    def stats(self):
+        view = self.view
+        return dict(self._stats, version=view.version, nodes=len(view.nodes), discovered=len(self._discovered),
+                    ops={op: [n["id"] for n in replicas] for op, replicas in view.by_op.items()})
+
+
+# 发现的节点超过 DISCOVERY_TTL 秒既没有 mDNS 更新、/info 也拉不到（没发 goodbye 就掉线）就移出注册表
+DISCOVERY_TTL = float(os.getenv("DISCOVERY_TTL", str(NODE_TTL)))
+REGISTRY = NodeRegistry(CONFIG["nodes"], DISCOVERY_TTL)
+
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+if not OPENAI_API_KEY:
+    raise RuntimeError("OPENAI_API_KEY not set in environment/.env")
+
+# 新版 OpenAI Python 客户端；OPENAI_BASE_URL 可以指向兼容接口（如 bench/fake_openai.py）
+# 重试由 _upstream_call 统一负责（限速 + 带抖动的退避），客户端自身不再重试
+openai_client = OpenAI(api_key=OPENAI_API_KEY, base_url=os.getenv("OPENAI_BASE_URL") or None, max_retries=0)
+
+# ====== 多 worker 部署（serve.py / gunicorn） ======
+# WEB_WORKERS > 1 时多个进程共用同一个端口，任务表、用户表和负载计数都要放在进程之间共享的地方
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "1"))
+SHARED_STATE = WEB_WORKERS > 1
+SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH", "node_state.db")
+
+
+def _pid_alive(pid):
+    """进程是否还在；Windows 上只会单进程部署（而且 os.kill(pid, 0) 在那里是发 Ctrl-C），别的 pid 一律视为已退出"""
+    if pid == os.getpid():
+        return True
+    if os.name == "nt":
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# --- Minimal user store (token -> user id)
+USERS_PATH = os.getenv("USERS_PATH", "users.json")
+
+
+class UserStore:
+    """token -> user id；文件改动后自动重新加载，所有 worker 读同一个文件，看到的用户表一致"""
+
+    def __init__(self, path, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._users = {}
+        self._mtime = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self._reload()
+
+    def _reload(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+        self._checked_at = time.time()
+        if mtime is not None and mtime == self._mtime:
+            return
+        if mtime is None:
+            # create a default test user (convenience for local testing)
+            self._users = {'testtoken123': 'user1'}
+        else:
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                self._users = {u['token']: u['id'] for u in data.get('users', [])}
+            except Exception as e:
+                print(f"failed to load {self.path}: {e}")
+                # 第一次加载失败时拒绝所有 token；之后（比如文件写到一半）保留上一次的用户表
+                if self._mtime is None:
+                    self._users = {}
+                return
+        self._mtime = mtime
+
+    def get(self, token):
+        if time.time() - self._checked_at > self.check_interval:
+            with self._lock:
+                if time.time() - self._checked_at > self.check_interval:
+                    self._reload()
+        return self._users.get(token)
+
+    def __contains__(self, token):
+        return self.get(token) is not None
+
+    def __len__(self):
+        return len(self._users)
+
+
+USERS = UserStore(USERS_PATH)
+
+# ====== 任务表：task_id -> { owner, pipeline, steps, final_state, status, error, ... } ======
+# status: queued -> running -> done / error
+# TASK_STORE_BACKEND=memory（默认，有上限的 LRU + TTL）或 sqlite（WAL，批量写入，重启后结果仍可查询）
+TASK_STORE_BACKEND = os.getenv("TASK_STORE_BACKEND", "memory")
+TASK_STORE_PATH = os.getenv("TASK_STORE_PATH", "tasks.db")
+TASK_STORE_MAX = int(os.getenv("TASK_STORE_MAX", "10000"))
+# 任务结束后保留多久（秒）
+TASK_TTL = float(os.getenv("TASK_TTL", "86400"))
+TASK_COMPACT_INTERVAL = float(os.getenv("TASK_COMPACT_INTERVAL", "60"))
+TASK_STORE_FLUSH_MS = float(os.getenv("TASK_STORE_FLUSH_MS", "50"))
+TERMINAL_STATUSES = ('done', 'error')
+if SHARED_STATE:
+    # 多 worker：/result、/task/<id>/complete 可能落到任意一个进程，任务表必须共享且不能有进程内的写缓冲
+    if TASK_STORE_BACKEND != "sqlite":
+        print(f"WEB_WORKERS={WEB_WORKERS}: using the sqlite task store ({TASK_STORE_PATH}) shared by all workers")
+    TASK_STORE_BACKEND = "sqlite"
+    TASK_STORE_FLUSH_MS = 0
+
+
+def _copy_task(record):
+    snap = dict(record)
+    snap['steps'] = [dict(s) for s in record['steps']]
+    return snap
+
+
+class TaskStoreFull(Exception):
+    """任务表已满且没有可以淘汰的已结束任务，/task 返回 503"""
+
+
+class MemoryTaskStore:
+    """进程内任务表：超过 max_tasks 时淘汰最久未更新的已结束任务（排队 / 执行中的任务不淘汰），
+    结束超过 ttl 的任务由后台压缩线程清理"""
+
+    def __init__(self, max_tasks, ttl):
+        self.max_tasks = max_tasks
+        self.ttl = ttl
+        self._tasks = OrderedDict()
+        self._by_owner = {}
+        self._lock = threading.Lock()
+        self._stats = {'evicted': 0, 'expired': 0, 'rejected': 0}
+
+    def create(self, task_id, record):
+        with self._lock:
+            while len(self._tasks) >= self.max_tasks:
+                victim = next((tid for tid, t in self._tasks.items() if t['status'] in TERMINAL_STATUSES), None)
+                if victim is None:
+                    self._stats['rejected'] += 1
+                    raise TaskStoreFull(f"task store full ({self.max_tasks} unfinished tasks)")
+                self._remove(victim)
+                self._stats['evicted'] += 1
+            record = _copy_task(record)
+            record['updated_at'] = time.time()
+            self._tasks[task_id] = record
+            self._by_owner.setdefault(record['owner'], set()).add(task_id)
+
+    def _remove(self, task_id):
+        t = self._tasks.pop(task_id)
+        owned = self._by_owner.get(t['owner'])
+        if owned is not None:
+            owned.discard(task_id)
+            if not owned:
+                del self._by_owner[t['owner']]
+
+    def get(self, task_id):
+        with self._lock:
+            t = self._tasks.get(task_id)
+            return _copy_task(t) if t is not None else None
+
+    def update(self, task_id, **fields):
+        with self._lock:
+            t = self._tasks.get(task_id)
+            if t is not None:
+                t.update(fields)
+                t['updated_at'] = time.time()
+                self._tasks.move_to_end(task_id)
+
+    def update_step(self, task_id, idx, **fields):
+        with self._lock:
+            t = self._tasks.get(task_id)
+            if t is not None:
+                t['steps'][idx].update(fields)
+                t['updated_at'] = time.time()
+                self._tasks.move_to_end(task_id)
+
+    def for_owner(self, owner, limit=50):
+        with self._lock:
+            tasks = [(tid, self._tasks[tid]) for tid in self._by_owner.get(owner, ())]
+            tasks.sort(key=lambda x: x[1]['created_at'], reverse=True)
+            return [dict(_copy_task(t), task_id=tid) for tid, t in tasks[:limit]]
+
+    def compact(self):
+        deadline = time.time() - self.ttl
+        with self._lock:
+            # _tasks 按最近更新时间排序，遇到第一个未过期的就可以停
+            expired = []
+            for tid, t in self._tasks.items():
+                if t['updated_at'] > deadline:
+                    break
+                if t['status'] in TERMINAL_STATUSES:
+                    expired.append(tid)
+            for tid in expired:
+                self._remove(tid)
+            self._stats['expired'] += len(expired)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, backend='memory', tasks=len(self._tasks), max_tasks=self.max_tasks)
+
+
+class SQLiteTaskStore:
+    """SQLite 任务表（WAL）：未结束的任务在内存里保留一份便于频繁更新，
+    所有改动先进写缓冲，由写线程每 flush_interval 秒合并成一个事务落盘。
+    flush_interval <= 0 时直写：每次改动都是一个读-改-写事务，多个 worker 进程可以共用同一个文件"""
+
+    _UPSERT = ("INSERT OR REPLACE INTO tasks (task_id, owner, status, record, created_at, updated_at, expires_at)"
+               " VALUES (?, ?, ?, ?, ?, ?, ?)")
+
+    def __init__(self, path, ttl, flush_interval):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.write_through = flush_interval <= 0
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            " task_id TEXT PRIMARY KEY, owner TEXT NOT NULL, status TEXT NOT NULL,"
+            " record TEXT NOT NULL, created_at REAL NOT NULL, updated_at REAL NOT NULL, expires_at REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS tasks_owner ON tasks (owner, created_at)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS tasks_expires ON tasks (expires_at)")
+        self._db.commit()
+        self._db_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._active = {}  # 未结束（或尚未落盘）的任务
+        self._dirty = set()
+        self._stats = {'flushes': 0, 'rows_written': 0, 'expired': 0, 'flush_errors': 0}
+        self._recover_interrupted()
+        if not self.write_through:
+            threading.Thread(target=self._writer, name="task-store-writer", daemon=True).start()
+
+    def _recover_interrupted(self):
+        # 已退出的进程没跑完的任务不会再继续，标记为失败（其他 worker 还在跑的任务不动）
+        rows = self._db.execute(
+            "SELECT task_id, record FROM tasks WHERE status NOT IN ('done', 'error')"
+        ).fetchall()
+        now = time.time()
+        for task_id, raw in rows:
+            record = json.loads(raw)
+            pid = record.get('pid')
+            if pid is not None and pid != os.getpid() and _pid_alive(pid):
+                continue
+            record.update(status='error', error='node restarted before the task finished', updated_at=now)
+            self._db.execute(
+                "UPDATE tasks SET status = 'error', record = ?, updated_at = ?, expires_at = ? WHERE task_id = ?",
+                (json.dumps(record, ensure_ascii=False), now, now + self.ttl, task_id),
+            )
+        self._db.commit()
+
+    def _load(self, task_id):
+        with self._db_lock:
+            row = self._db.execute("SELECT record FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _row(self, task_id, t):
+        expires = t['updated_at'] + self.ttl if t['status'] in TERMINAL_STATUSES else None
+        return (task_id, t['owner'], t['status'], json.dumps(t, ensure_ascii=False),
+                t['created_at'], t['updated_at'], expires)
+
+    def create(self, task_id, record):
+        record = _copy_task(record)
+        record['updated_at'] = time.time()
+        record['pid'] = os.getpid()
+        if self.write_through:
+            with self._db_lock:
+                self._db.execute(self._UPSERT, self._row(task_id, record))
+                self._db.commit()
+            return
+        with self._lock:
+            self._active[task_id] = record
+            self._dirty.add(task_id)
+
+    def get(self, task_id):
+        with self._lock:
+            t = self._active.get(task_id)
+            if t is not None:
+                return _copy_task(t)
+        return self._load(task_id)
+
+    def _mutate(self, task_id, fn):
+        if self.write_through:
+            # BEGIN IMMEDIATE 先拿写锁，别的进程对同一任务的读-改-写不会互相覆盖
+            with self._db_lock:
+                self._db.execute("BEGIN IMMEDIATE")
+                try:
+                    row = self._db.execute("SELECT record FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+                    if row is not None:
+                        t = json.loads(row[0])
+                        fn(t)
+                        t['updated_at'] = time.time()
+                        self._db.execute(self._UPSERT, self._row(task_id, t))
+                    self._db.commit()
+                except BaseException:
+                    self._db.rollback()
+                    raise
+            return
+        with self._lock:
+            t = self._active.get(task_id)
+            if t is None:
+                t = self._load(task_id)
+                if t is None:
+                    return
+                self._active[task_id] = t
+            fn(t)
+            t['updated_at'] = time.time()
+            self._dirty.add(task_id)
+
+    def update(self, task_id, **fields):
+        self._mutate(task_id, lambda t: t.update(fields))
+
+    def update_step(self, task_id, idx, **fields):
+        self._mutate(task_id, lambda t: t['steps'][idx].update(fields))
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            rows = [self._row(tid, self._active[tid]) for tid in self._dirty]
+            self._dirty = set()
+        try:
+            with self._db_lock:
+                try:
+                    self._db.executemany(self._UPSERT, rows)
+                    self._db.commit()
+                except BaseException:
+                    self._db.rollback()
+                    raise
+        except BaseException:
+            # 写盘失败（库被锁、磁盘满）：这些任务放回写缓冲，下次 flush 重试，也不会被移出内存
+            with self._lock:
+                self._dirty.update(row[0] for row in rows)
+                self._stats['flush_errors'] += 1
+            raise
+        with self._lock:
+            self._stats['flushes'] += 1
+            self._stats['rows_written'] += len(rows)
+            # 已结束且已落盘的任务不再常驻内存
+            for row in rows:
+                tid = row[0]
+                t = self._active.get(tid)
+                if t is not None and tid not in self._dirty and t['status'] in TERMINAL_STATUSES:
+                    del self._active[tid]
+
+    def _writer(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print("task store flush failed:", e)
+
+    def for_owner(self, owner, limit=50):
+        self.flush()
+        with self._db_lock:
+            rows = self._db.execute(
+                "SELECT task_id, record FROM tasks WHERE owner = ? ORDER BY created_at DESC LIMIT ?",
+                (owner, limit),
+            ).fetchall()
+        return [dict(json.loads(raw), task_id=tid) for tid, raw in rows]
+
+    def compact(self):
+        with self._db_lock:
+            cur = self._db.execute("DELETE FROM tasks WHERE expires_at IS NOT NULL AND expires_at < ?",
+                                   (time.time(),))
+            self._db.commit()
+        with self._lock:
+            self._stats['expired'] += cur.rowcount
+
+    def stats(self):
+        with self._db_lock:
+            total = self._db.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+        with self._lock:
+            return dict(self._stats, backend='sqlite', tasks=total, active=len(self._active),
+                        pending_writes=len(self._dirty), write_through=self.write_through)
+
+
+if TASK_STORE_BACKEND == "sqlite":
+    TASK_STORE = SQLiteTaskStore(TASK_STORE_PATH, TASK_TTL, TASK_STORE_FLUSH_MS / 1000.0)
+else:
+    TASK_STORE = MemoryTaskStore(TASK_STORE_MAX, TASK_TTL)
+
+
+def _compact_task_store():
+    while True:
+        time.sleep(TASK_COMPACT_INTERVAL)
+        try:
+            TASK_STORE.compact()
+        except Exception as e:
+            print("task store compaction failed:", e)
+
+
+threading.Thread(target=_compact_task_store, name="task-store-compact", daemon=True).start()
+
+# ====== Prometheus 指标（/metrics） ======
+# 每个线程写自己的分片（热路径上不加锁），抓取时再把所有分片加总；线程退出后其分片并入 _retired
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Metrics:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._local = threading.local()
+        self._shards = []  # (thread, {"counters": {...}, "histograms": {...}})
+        self._retired = {"counters": {}, "histograms": {}}
+        self._help = {}
+        self._gauges = []
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = {"counters": {}, "histograms": {}}
+            self._local.shard = shard
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def inc(self, name, labels=(), value=1):
+        counters = self._shard()["counters"]
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        histograms = self._shard()["histograms"]
+        key = (name, labels)
+        h = histograms.get(key)
+        if h is None:
+            h = histograms[key] = [0] * (len(self.buckets) + 2)  # 各桶计数 + sum + count
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                h[i] += 1
+                break
+        h[-2] += seconds
+        h[-1] += 1
+
+    def gauge(self, name, text, fn, kind="gauge"):
+        """抓取时调用 fn()，返回 [(labels, value), ...]；已有统计里的累计值用 kind="counter" 导出"""
+        self.describe(name, kind, text)
+        self._gauges.append((name, fn))
+
+    def _merge_into(self, dst, src):
+        for key, v in list(src["counters"].items()):
+            dst["counters"][key] = dst["counters"].get(key, 0) + v
+        for key, h in list(src["histograms"].items()):
+            acc = dst["histograms"].setdefault(key, [0] * len(h))
+            for i, v in enumerate(list(h)):
+                acc[i] += v
+
+    def _collect(self):
+        with self._lock:
+            alive = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    alive.append((thread, shard))
+                else:
+                    self._merge_into(self._retired, shard)
+            self._shards = alive
+            total = {"counters": {}, "histograms": {}}
+            self._merge_into(total, self._retired)
+            for _, shard in alive:
+                self._merge_into(total, shard)
+        return total
+
+    def render(self):
+        total = self._collect()
+        families = {}
+        for (name, labels), v in total["counters"].items():
+            families.setdefault(name, []).append(f"{name}{_fmt_labels(labels)} {v}")
+        for (name, labels), h in total["histograms"].items():
+            lines = families.setdefault(name, [])
+            cumulative = 0
+            for bound, n in zip(self.buckets, h):
+                cumulative += n
+                lines.append(f"{name}_bucket{_fmt_labels(labels + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{name}_bucket{_fmt_labels(labels + (('le', '+Inf'),))} {h[-1]}")
+            lines.append(f"{name}_sum{_fmt_labels(labels)} {h[-2]}")
+            lines.append(f"{name}_count{_fmt_labels(labels)} {h[-1]}")
+        for name, fn in self._gauges:
+            try:
+                families[name] = [f"{name}{_fmt_labels(labels)} {v}" for labels, v in fn()]
+            except Exception as e:
+                print(f"metrics gauge {name} failed:", e)
+        out = []
+        for name in sorted(families):
+            kind, text = self._help.get(name, ("untyped", ""))
+            out.append(f"# HELP {name} {text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(families[name])
+        return "\n".join(out) + "\n"
+
+
+def _fmt_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for k, v in labels:
+        v = str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        parts.append(f'{k}="{v}"')
+    return "{" + ",".join(parts) + "}"
+
+
+METRICS = Metrics(METRIC_BUCKETS)
+METRICS.describe("echonet_http_requests_total", "counter", "HTTP requests handled, by route, method and status.")
+METRICS.describe("echonet_http_request_duration_seconds", "histogram", "Time to produce the response headers, by route.")
+METRICS.describe("echonet_skill_duration_seconds", "histogram", "Local skill execution time, by op and outcome.")
+METRICS.describe("echonet_peer_request_duration_seconds", "histogram", "Requests to other nodes, by peer, path and outcome.")
+METRICS.describe("echonet_openai_request_duration_seconds", "histogram", "OpenAI chat completion calls, by kind, model and outcome.")
+METRICS.describe("echonet_openai_tokens_total", "counter", "OpenAI token usage, by model and type.")
+METRICS.describe("echonet_openai_retries_total", "counter", "OpenAI calls retried after 429 / 5xx / connection errors, by kind and reason.")
+METRICS.describe("echonet_openai_rate_wait_seconds", "histogram", "Time OpenAI calls queued in the upstream rate limiter, by kind.")
+
+
+@app.before_request
+def _metrics_start():
+    request.environ["echonet.started"] = time.perf_counter()
+
+
+@app.after_request
+def _metrics_finish(response):
+    started = request.environ.get("echonet.started")
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        METRICS.inc("echonet_http_requests_total",
+                    (("route", route), ("method", request.method), ("status", str(response.status_code))))
+        METRICS.observe("echonet_http_request_duration_seconds", (("route", route),),
+                        time.perf_counter() - started)
+    return response
+
+
+# ====== 分布式追踪：trace id 在 /task 创建，随 traceparent 头传给下游节点 ======
+# 每个节点只保存自己产生的 span；发起节点的 /trace/<task_id> 再向其他节点拉取同一 trace 的 span
+TRACING = os.getenv("TRACING", "1") == "1"
+TRACE_MAX_TRACES = int(os.getenv("TRACE_MAX_TRACES", "1000"))
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", "500"))
+# 设置后，任务结束时把完整 trace 以 OTLP JSON 追加写入该文件（每行一个 trace）
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH")
+# 等待下游节点的 span 落地后再导出
+TRACE_EXPORT_DELAY = float(os.getenv("TRACE_EXPORT_DELAY", "1"))
+
+# 当前 trace 上下文 (trace_id, span_id)；用 contextvar 而不是 threading.local，
+# 这样同一个事件循环上并发执行的协程各有各的上下文
+_TRACE_CTX = contextvars.ContextVar("trace_ctx", default=None)
+
+
+class TraceStore:
+    def __init__(self, max_traces, max_spans):
+        self.max_traces = max_traces
+        self.max_spans = max_spans
+        self._traces = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            spans = self._traces.get(span["trace_id"])
+            if spans is None:
+                spans = self._traces[span["trace_id"]] = []
+                while len(self._traces) > self.max_traces:
+                    self._traces.popitem(last=False)
+            if len(spans) < self.max_spans:
+                spans.append(span)
+
+    def get(self, trace_id):
+        with self._lock:
+            return list(self._traces.get(trace_id, ()))
+
+
+TRACE_STORE = TraceStore(TRACE_MAX_TRACES, TRACE_MAX_SPANS)
+
+
+def _trace_context():
+    return _TRACE_CTX.get()
+
+
+@contextmanager
+def _trace_scope(ctx):
+    token = _TRACE_CTX.set(ctx)
+    try:
+        yield
+    finally:
+        _TRACE_CTX.reset(token)
+
+
+def _in_scope(ctx, fn, *args, **kwargs):
+    """在另一个线程里以 ctx 作为当前 trace 上下文执行 fn"""
+    with _trace_scope(ctx):
+        return fn(*args, **kwargs)
+
+
+def _start_span(name, **attrs):
+    parent = _trace_context()
+    if not TRACING or parent is None:
+        return None
+    return {"trace_id": parent[0], "span_id": secrets.token_hex(8), "parent_span_id": parent[1],
+            "name": name, "node": SELF_ID, "start": time.time(), "end": None, "attrs": attrs, "status": "ok"}
+
+
+def _end_span(span, error=None):
+    if span is None:
+        return
+    span["end"] = time.time()
+    if error is not None:
+        span["status"] = "error"
+        span["attrs"]["error"] = str(error)
+    TRACE_STORE.add(span)
+
+
+@contextmanager
+def _span(name, **attrs):
+    """记录一个 span，并在 with 块内把它作为子 span 的父节点；当前线程没有 trace 时什么都不做"""
+    span = _start_span(name, **attrs)
+    if span is None:
+        yield None
+        return
+    token = _TRACE_CTX.set((span["trace_id"], span["span_id"]))
+    error = None
+    try:
+        yield span
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        _TRACE_CTX.reset(token)
+        _end_span(span, error)
+
+
+def _traceparent():
+    ctx = _trace_context()
+    return f"00-{ctx[0]}-{ctx[1]}-01" if ctx else None
+
+
+def _parse_traceparent(value):
+    parts = (value or "").split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    return parts[1], parts[2]
+
+
+def _trace_otlp(spans):
+    """把 span 列表转换成 OTLP JSON（按节点分成多个 resourceSpans）"""
+    by_node = {}
+    for sp in spans:
+        by_node.setdefault(sp["node"], []).append({
+            "traceId": sp["trace_id"],
+            "spanId": sp["span_id"],
+            "parentSpanId": sp["parent_span_id"] or "",
+            "name": sp["name"],
+            "kind": 1,
+            "startTimeUnixNano": str(int(sp["start"] * 1e9)),
+            "endTimeUnixNano": str(int((sp["end"] or sp["start"]) * 1e9)),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in sp["attrs"].items()],
+            "status": {"code": 2 if sp["status"] == "error" else 1},
+        })
+    return {"resourceSpans": [{
+        "resource": {"attributes": [
+            {"key": "service.name", "value": {"stringValue": "echonet"}},
+            {"key": "service.instance.id", "value": {"stringValue": node}},
+        ]},
+        "scopeSpans": [{"scope": {"name": "echonet"}, "spans": node_spans}],
+    } for node, node_spans in by_node.items()]}
+
+
+def _otlp_value(v):
+    if isinstance(v, bool):
+        return {"boolValue": v}
+    if isinstance(v, int):
+        return {"intValue": str(v)}
+    if isinstance(v, float):
+        return {"doubleValue": v}
+    return {"stringValue": str(v)}
+
+
+# ====== 任务事件流（供 /task/<task_id>/stream 的 SSE 订阅） ======
+# task_id -> {"events": [(type, data), ...], "closed": bool, "stream": bool, "subscribers": int}；
+# 任务结束后保留 TASK_EVENTS_TTL 秒以便重放
+TASK_EVENTS = {}
+TASK_EVENTS_TTL = float(os.getenv("TASK_EVENTS_TTL", "600"))
+_EVENTS_COND = threading.Condition()
+_EVENTS_EXPIRY = deque()  # (expire_at, task_id)，按结束时间先后排列
+TERMINAL_EVENTS = ("task_finished",)
+
+# 当前正在执行的步骤的 token 回调：不为空时，_chat 以流式方式调用模型并逐段回调
+# （contextvar：线程之间、事件循环上的协程之间互不影响）
+_STEP_ON_TOKEN = contextvars.ContextVar("step_on_token", default=None)
+
+# ====== 后台任务线程池：/task 只负责入队，流水线由这里的 worker 执行 ======
+TASK_WORKERS = int(os.getenv("TASK_WORKERS", "8"))
+# 排队上限（不含正在执行的），超过则 /task 直接返回 503，避免无限堆积
+TASK_QUEUE_MAX = int(os.getenv("TASK_QUEUE_MAX", "256"))
+TASK_EXECUTOR = ThreadPoolExecutor(max_workers=TASK_WORKERS, thread_name_prefix="task-worker")
+_TASK_SLOTS = threading.BoundedSemaphore(TASK_WORKERS + TASK_QUEUE_MAX)
+# 单个步骤的执行线程池：DAG 中互不依赖的步骤在这里并发派发
+STEP_WORKERS = int(os.getenv("STEP_WORKERS", "16"))
+STEP_EXECUTOR = ThreadPoolExecutor(max_workers=STEP_WORKERS, thread_name_prefix="step-worker")
+# /execute_steps 批量接口内部并发执行各条目的线程池（与 STEP_EXECUTOR 分开，避免节点间互相等待时耗尽）
+BATCH_EXECUTOR = ThreadPoolExecutor(max_workers=STEP_WORKERS, thread_name_prefix="batch-item")
+# 对冲请求（hedging）的发送线程池：远程步骤迟迟不返回时，向另一个副本再发一份
+HEDGE_EXECUTOR = ThreadPoolExecutor(max_workers=STEP_WORKERS * 2, thread_name_prefix="hedge")
+
+# ====== 微批处理窗口（毫秒，0 表示关闭） ======
+# 同一时间窗口内发往同一 peer 的步骤合并成一次 /execute_steps 调用（合并后的步骤不再流式回传 token）
+PEER_BATCH_WINDOW_MS = float(os.getenv("PEER_BATCH_WINDOW_MS", "0"))
+PEER_BATCH_MAX = int(os.getenv("PEER_BATCH_MAX", "16"))
+# 同一时间窗口内的多条 translate_zh 合并成一次模型调用（合并后整段结果作为一个 token 推送）
+TRANSLATE_BATCH_WINDOW_MS = float(os.getenv("TRANSLATE_BATCH_WINDOW_MS", "0"))
+TRANSLATE_BATCH_MAX = int(os.getenv("TRANSLATE_BATCH_MAX", "8"))
+
+
+class MicroBatcher:
+    """把时间窗口内到达的同组请求合并成一批执行。
+
+    第一个到达的调用方作为 leader 等待窗口结束（或攒满 max_items）后执行 run_batch(key, items)，
+    其余调用方等待结果。run_batch 返回与 items 一一对应的结果列表，元素为异常实例时在对应调用方抛出。
+    """
+
+    def __init__(self, window, max_items, run_batch):
+        self.window = window
+        self.max_items = max_items
+        self.run_batch = run_batch
+        self._open = {}
+        self._lock = threading.Lock()
+        self._stats = {'batches': 0, 'items': 0, 'max_batch': 0}
+
+    def submit(self, key, item):
+        with self._lock:
+            batch = self._open.get(key)
+            leader = batch is None
+            if leader:
+                batch = {'items': [], 'full': threading.Event(), 'done': threading.Event(), 'results': None}
+                self._open[key] = batch
+            idx = len(batch['items'])
+            batch['items'].append(item)
+            if len(batch['items']) >= self.max_items:
+                del self._open[key]
+                batch['full'].set()
+
+        if leader:
+            batch['full'].wait(self.window)
+            with self._lock:
+                if self._open.get(key) is batch:
+                    del self._open[key]
+            try:
+                results = self.run_batch(key, batch['items'])
+            except Exception as e:
+                results = [e] * len(batch['items'])
+            batch['results'] = results
+            with self._lock:
+                self._stats['batches'] += 1
+                self._stats['items'] += len(batch['items'])
+                self._stats['max_batch'] = max(self._stats['max_batch'], len(batch['items']))
+            batch['done'].set()
+        else:
+            batch['done'].wait()
+
+        result = batch['results'][idx]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+class _FlightProgress:
+    """leader 的进度回调。只有在有人订阅时为真：_chat 等按 `if on_token:` 决定是否流式调用，
+    没有订阅者的 flight 走普通（非流式）请求；开始调用前加入的订阅者同样会让它改为流式"""
+
+    def __init__(self, flight):
+        self._flight = flight
+
+    def __bool__(self):
+        return bool(self._flight['listeners'])
+
+    def __call__(self, x):
+        flight = self._flight
+        # 只持有本 flight 的锁：慢的订阅者只拖慢自己这一组调用，不影响其他 flight
+        with flight['emit']:
+            flight['progress'].append(x)
+            for cb in list(flight['listeners']):
+                cb(x)
+
+
+class SingleFlight:
+    """相同 key 的并发调用只执行一次：第一个调用方（leader）执行 fn(progress)，
+    其余调用方等待并拿到同一个结果（或同一个异常）。
+
+    leader 执行过程中通过 progress(x) 发出的进度会转发给所有订阅者，
+    晚加入的调用方会先补收已发出的进度。线程里用 do()，事件循环上用 ado()，两者共享同一组 flight。
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._stats = {'executions': 0, 'coalesced': 0}
+
+    def _join(self, key, on_progress, waiter=None):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = {'done': threading.Event(), 'result': None, 'error': None,
+                          'progress': [], 'listeners': [], 'waiters': [], 'emit': threading.Lock()}
+                self._flights[key] = flight
+                self._stats['executions'] += 1
+            else:
+                self._stats['coalesced'] += 1
+                if waiter is not None:
+                    flight['waiters'].append(waiter)
+        if on_progress is not None:
+            # 回调在全局锁外执行；补发和登记在同一把 flight 锁里完成，进度不会乱序也不会漏
+            with flight['emit']:
+                for x in flight['progress']:
+                    on_progress(x)
+                flight['listeners'].append(on_progress)
+        return flight, leader
+
+    def _progress(self, flight):
+        return _FlightProgress(flight)
+
+    def _finish(self, key, flight):
+        with self._lock:
+            del self._flights[key]
+        flight['done'].set()
+        for loop, fut in flight['waiters']:
+            loop.call_soon_threadsafe(lambda f=fut: f.done() or f.set_result(None))
+
+    @staticmethod
+    def _outcome(flight):
+        if flight['error'] is not None:
+            raise flight['error']
+        return flight['result']
+
+    def do(self, key, fn, on_progress=None):
+        flight, leader = self._join(key, on_progress)
+        if not leader:
+            flight['done'].wait()
+            return self._outcome(flight)
+        try:
+            flight['result'] = fn(self._progress(flight))
+        except Exception as e:
+            flight['error'] = e
+        finally:
+            self._finish(key, flight)
+        return self._outcome(flight)
+
+    async def ado(self, key, fn, on_progress=None):
+        """fn 是协程函数；跟随者在事件循环上等待，不占线程"""
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        flight, leader = self._join(key, on_progress, (loop, waiter))
+        if not leader:
+            await waiter
+            return self._outcome(flight)
+        try:
+            flight['result'] = await fn(self._progress(flight))
+        except Exception as e:
+            flight['error'] = e
+        finally:
+            self._finish(key, flight)
+        return self._outcome(flight)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, in_flight=len(self._flights))
+
+# ====== 节点间 HTTP 连接池：每个 peer 一个 keep-alive 会话，所有请求线程共享 ======
+PEER_POOL_SIZE = int(os.getenv("PEER_POOL_SIZE", "16"))
+PEER_CONNECT_TIMEOUT = float(os.getenv("PEER_CONNECT_TIMEOUT", "3"))
+PEER_READ_TIMEOUT = float(os.getenv("PEER_READ_TIMEOUT", "60"))
+PEER_HTTP2 = os.getenv("PEER_HTTP2", "0") == "1"
+
+
+class PeerPool:
+    """按 peer 的 base url 复用连接，并统计新建连接数与复用次数"""
+
+    def __init__(self, pool_size, connect_timeout, read_timeout, http2=False):
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.http2 = http2 and httpx is not None
+        if http2 and httpx is None:
+            print("PEER_HTTP2=1 but httpx is not installed; falling back to HTTP/1.1 keep-alive")
+        self._clients = {}
+        self._lock = threading.Lock()
+        # 只有 httpx 路径需要自己计数；requests 路径直接读 urllib3 连接池的计数器
+        self._h2_counts = {}
+
+    def _client(self, base_url):
+        client = self._clients.get(base_url)
+        if client is not None:
+            return client
+        with self._lock:
+            client = self._clients.get(base_url)
+            if client is None:
+                if self.http2:
+                    client = httpx.Client(
+                        http2=True,
+                        limits=httpx.Limits(max_connections=self.pool_size,
+                                            max_keepalive_connections=self.pool_size),
+                    )
+                    self._h2_counts[base_url] = {'requests': 0, 'connections_opened': 0}
+                else:
+                    client = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=False)
+                    client.mount("http://", adapter)
+                    client.mount("https://", adapter)
+                self._clients[base_url] = client
+        return client
+
+    def post(self, base_url, path, json=None, timeout=None, stream=False, data=None, headers=None):
+        return self.request("POST", base_url, path, json=json, timeout=timeout, stream=stream,
+                            data=data, headers=headers)
+
+    def get(self, base_url, path, timeout=None):
+        return self.request("GET", base_url, path, timeout=timeout)
+
+    def request(self, method, base_url, path, json=None, timeout=None, stream=False, data=None, headers=None):
+        """stream=True 时不预读响应体，调用方负责迭代并 close()；data 为已序列化好的请求体"""
+        base_url = base_url.rstrip("/")
+        client = self._client(base_url)
+        timeout = timeout or self.timeout
+        if not self.http2:
+            return client.request(method, base_url + path, json=json, data=data, headers=headers,
+                                  timeout=timeout, stream=stream)
+
+        counts = self._h2_counts[base_url]
+
+        def trace(event, info):
+            if event == "connection.connect_tcp.complete":
+                counts['connections_opened'] += 1
+
+        counts['requests'] += 1
+        req = client.build_request(
+            method, base_url + path, json=json, content=data, headers=headers,
+            timeout=httpx.Timeout(timeout[1], connect=timeout[0]),
+            extensions={"trace": trace},
+        )
+        return client.send(req, stream=stream)
+
+    def stats(self):
+        out = {}
+        for base_url, client in list(self._clients.items()):
+            if self.http2:
+                c = self._h2_counts[base_url]
+                opened, total = c['connections_opened'], c['requests']
+            else:
+                opened = total = 0
+                # http:// 与 https:// 挂的是同一个 adapter，去重后再统计
+                adapters = {id(a): a for a in client.adapters.values()}
+                for adapter in adapters.values():
+                    pools = adapter.poolmanager.pools
+                    for key in pools.keys():
+                        pool = pools.get(key)
+                        if pool is not None:
+                            opened += pool.num_connections
+                            total += pool.num_requests
+            out[base_url] = {
+                'requests': total,
+                'connections_opened': opened,
+                'connections_reused': max(total - opened, 0),
+            }
+        return out
+
+
+PEER_POOL = PeerPool(PEER_POOL_SIZE, PEER_CONNECT_TIMEOUT, PEER_READ_TIMEOUT, http2=PEER_HTTP2)
+
+# ====== 本节点负载与健康度 ======
+MAX_LOAD = int(os.getenv("MAX_LOAD", "5"))
+
+
+class LocalCounters:
+    """单进程部署的计数器"""
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, delta):
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + delta
+
+    def get(self, name):
+        return self._values.get(name, 0)
+
+
+class SQLiteCounters:
+    """多 worker 共享的计数器：每个进程只改自己那一行 (name, pid)，读取时加总还活着的进程，
+    worker 崩溃或被回收不会留下虚高的负载"""
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=OFF")
+        self._db.execute("CREATE TABLE IF NOT EXISTS counters ("
+                         " name TEXT NOT NULL, pid INTEGER NOT NULL, value INTEGER NOT NULL, PRIMARY KEY (name, pid))")
+        self._pid = os.getpid()
+        self._values = {}
+        self._lock = threading.Lock()
+        # 清掉已退出的进程（包括复用了同一个 pid 的上一个进程）留下的行
+        self._db.execute("DELETE FROM counters WHERE pid = ?", (self._pid,))
+        for (pid,) in self._db.execute("SELECT DISTINCT pid FROM counters").fetchall():
+            if not _pid_alive(pid):
+                self._db.execute("DELETE FROM counters WHERE pid = ?", (pid,))
+
+    def add(self, name, delta):
+        with self._lock:
+            value = self._values[name] = self._values.get(name, 0) + delta
+            self._db.execute("INSERT OR REPLACE INTO counters (name, pid, value) VALUES (?, ?, ?)",
+                             (name, self._pid, value))
+
+    def get(self, name):
+        with self._lock:
+            rows = self._db.execute("SELECT pid, value FROM counters WHERE name = ?", (name,)).fetchall()
+        return sum(value for pid, value in rows if _pid_alive(pid))
+
+
+# 正在执行的技能步骤数（本地步骤 + /execute_step，所有 worker 合计），由 _invoke_skill 维护
+NODE_COUNTERS = SQLiteCounters(SHARED_STATE_PATH) if SHARED_STATE else LocalCounters()
+
+
+def _current_load():
+    return NODE_COUNTERS.get("load")
+
+
+# 准入控制：最多 STEP_MAX_ACTIVE 个技能同时执行，再排队 STEP_QUEUE_DEPTH 个，
+# 超出后立即拒绝（/execute_step 返回 429 + Retry-After），调用方换一个副本重试。
+# 多 worker 时每个进程各有一个限流器，默认把 MAX_LOAD 平分给各个 worker（请求在 worker 间分布不均，队列不平分）
+STEP_MAX_ACTIVE = int(os.getenv("STEP_MAX_ACTIVE", str(max(1, -(-MAX_LOAD // WEB_WORKERS)))))
+STEP_QUEUE_DEPTH = int(os.getenv("STEP_QUEUE_DEPTH", str(MAX_LOAD * 2)))
+STEP_QUEUE_TIMEOUT = float(os.getenv("STEP_QUEUE_TIMEOUT", "30"))
+OVERLOAD_RETRY_AFTER = float(os.getenv("OVERLOAD_RETRY_AFTER", "1"))
+
+
+class AdmissionLimiter:
+    """有上限的并发 + 有上限的等待队列；排满时 acquire() 抛出 NodeOverloaded"""
+
+    def __init__(self, max_active, max_queue, queue_timeout, retry_after):
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._stats = {'admitted': 0, 'queued': 0, 'rejected': 0, 'timed_out': 0}
+
+    def shed(self):
+        """队列已满时返回 True（计入 rejected），用于在开始处理请求之前快速拒绝"""
+        with self._cond:
+            if self._active + self._waiting < self.max_active + self.max_queue:
+                return False
+            self._stats['rejected'] += 1
+            return True
+
+    def try_acquire(self):
+        """不排队：有空位就占用并返回 True"""
+        with self._cond:
+            if self._active < self.max_active and self._waiting == 0:
+                self._active += 1
+                self._stats['admitted'] += 1
+                return True
+            return False
+
+    def acquire(self):
+        if self.try_acquire():
+            return
+        with self._cond:
+            if self._waiting >= self.max_queue:
+                self._stats['rejected'] += 1
+                raise NodeOverloaded(f"node {SELF_ID} is overloaded", self.retry_after)
+            self._waiting += 1
+            self._stats['queued'] += 1
+            try:
+                ok = self._cond.wait_for(lambda: self._active < self.max_active, self.queue_timeout)
+            finally:
+                self._waiting -= 1
+            if not ok:
+                self._stats['timed_out'] += 1
+                raise NodeOverloaded(f"node {SELF_ID} is overloaded (queue wait timed out)", self.retry_after)
+            self._active += 1
+            self._stats['admitted'] += 1
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return dict(self._stats, active=self._active, waiting=self._waiting,
+                        max_active=self.max_active, max_queue=self.max_queue)
+
+
+STEP_ADMISSION = AdmissionLimiter(STEP_MAX_ACTIVE, STEP_QUEUE_DEPTH, STEP_QUEUE_TIMEOUT, OVERLOAD_RETRY_AFTER)
+
+
+def get_cpu():
+    if psutil is not None:
+        return psutil.cpu_percent(interval=None)
+    try:
+        return min(os.getloadavg()[0] / (os.cpu_count() or 1) * 100.0, 100.0)
+    except (AttributeError, OSError):
+        return 0.0
+
+
+def get_battery():
+    if psutil is None:
+        return None
+    try:
+        bat = psutil.sensors_battery()
+        return bat.percent if bat else None
+    except Exception:
+        return None
+
+
+def compute_health(cpu, battery, load):
+    score = 1.0
+    if cpu > 80: score -= 0.3
+    elif cpu > 50: score -= 0.15
+
+    if battery is not None:
+        if battery < 20: score -= 0.4
+        elif battery < 50: score -= 0.2
+
+    if load > MAX_LOAD * 0.7: score -= 0.2
+    elif load > MAX_LOAD * 0.5: score -= 0.1
+    return max(score, 0)
+
+
+def get_node_metrics():
+    cpu = get_cpu()
+    battery = get_battery()
+    load = _current_load()
+    health = compute_health(cpu, battery, load)
+    return {
+        "cpu": cpu,
+        "battery": battery,
+        "load": load,
+        "max_load": MAX_LOAD,
+        "health": health,
+    }
+
+def _require_token(req):
+    token = req.headers.get('X-User-Token') or req.args.get('token')
+    if not token:
+        return None, ('missing X-User-Token header', 401)
+    if token not in USERS:
+        return None, ('invalid token', 403)
+    return token, None
+
+# ====== LLM 响应缓存：按 (model, messages, 采样参数) 做内容寻址 ======
+# 内存 LRU 一级缓存 + 可选 SQLite 磁盘二级缓存（设置 LLM_CACHE_PATH 启用）
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "1024"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "86400"))
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH")
+LLM_CACHE_DISK_MAX_BYTES = int(os.getenv("LLM_CACHE_DISK_MAX_BYTES", str(256 * 1024 * 1024)))
+# 透传给 chat.completions.create 的采样参数（也参与缓存 key）
+SAMPLING_PARAMS = ("temperature", "top_p", "max_tokens", "seed", "presence_penalty", "frequency_penalty")
+
+
+class LLMCache:
+    def __init__(self, size, ttl, path=None, disk_max_bytes=0):
+        self.size = size
+        self.ttl = ttl
+        self.disk_max_bytes = disk_max_bytes
+        self._mem = OrderedDict()  # key -> (created_at, value)
+        self._lock = threading.Lock()
+        self._stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'stores': 0,
+                       'memory_evictions': 0, 'disk_evictions': 0}
+        self._db = None
+        self._disk_bytes = 0
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL,"
+                " created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed_at)")
+            self._db.commit()
+            self._disk_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+
+    @staticmethod
+    def make_key(model, messages, sampling):
+        raw = json.dumps({'model': model, 'messages': messages, 'sampling': sampling},
+                         sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._mem.get(key)
+            if entry is not None:
+                if now - entry[0] <= self.ttl:
+                    self._mem.move_to_end(key)
+                    self._stats['memory_hits'] += 1
+                    return entry[1]
+                del self._mem[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and now - row[1] <= self.ttl:
+                    self._db.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+                    self._db.commit()
+                    self._mem_put(key, row[1], row[0])
+                    self._stats['disk_hits'] += 1
+                    return row[0]
+
+            self._stats['misses'] += 1
+            return None
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._mem_put(key, now, value)
+            self._stats['stores'] += 1
+            if self._db is None:
+                return
+            size = len(value.encode("utf-8"))
+            old = self._db.execute("SELECT size FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, now, now),
+            )
+            self._disk_bytes += size - (old[0] if old else 0)
+            if self._disk_bytes > self.disk_max_bytes:
+                self._evict_disk(now)
+            self._db.commit()
+
+    def _mem_put(self, key, created_at, value):
+        self._mem[key] = (created_at, value)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.size:
+            self._mem.popitem(last=False)
+            self._stats['memory_evictions'] += 1
+
+    def _evict_disk(self, now):
+        # 先清过期的，再按最久未访问淘汰到容量的 90%
+        self._db.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl,))
+        self._disk_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+        target = int(self.disk_max_bytes * 0.9)
+        if self._disk_bytes <= target:
+            return
+        # 只删到刚好低于目标为止，不按固定批量删（小缓存会被整批清空，连刚写入的条目也删掉）
+        victims = []
+        for key, size in self._db.execute("SELECT key, size FROM llm_cache ORDER BY accessed_at"):
+            victims.append((key,))
+            self._disk_bytes -= size
+            if self._disk_bytes <= target:
+                break
+        self._db.executemany("DELETE FROM llm_cache WHERE key = ?", victims)
+        self._stats['disk_evictions'] += len(victims)
+
+    def stats(self):
+        with self._lock:
+            out = dict(self._stats)
+            out['memory_entries'] = len(self._mem)
+            if self._db is not None:
+                out['disk_bytes'] = self._disk_bytes
+        lookups = out['memory_hits'] + out['disk_hits'] + out['misses']
+        out['hit_rate'] = (out['memory_hits'] + out['disk_hits']) / lookups if lookups else 0.0
+        return out
+
+
+LLM_CACHE = LLMCache(LLM_CACHE_SIZE, LLM_CACHE_TTL, path=LLM_CACHE_PATH,
+                     disk_max_bytes=LLM_CACHE_DISK_MAX_BYTES)
+
+
+# ====== 异步 OpenAI 调用路径 ======
+# OPENAI_ASYNC=1：所有上游调用都交给后台事件循环线程上的 AsyncOpenAI 客户端（共享一个 httpx 连接池），
+# 同时在途的调用数不超过 OPENAI_MAX_CONCURRENCY，其余在事件循环上排队；DAG 任务也在这个事件循环上调度，
+# 本机有异步实现（ASYNC_SKILL_IMPL）的步骤直接在事件循环上执行，等待模型时不占线程。
+# 只有同步实现的技能照常在线程池里执行，它们的 _chat 调用同样走这里的连接池和并发上限。
+OPENAI_ASYNC = os.getenv("OPENAI_ASYNC", "0") == "1"
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "64"))
+OPENAI_POOL_SIZE = int(os.getenv("OPENAI_POOL_SIZE", "100"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "600"))
+
+
+class AsyncRuntime:
+    """后台线程里的 asyncio 事件循环，以及在这个循环上创建的 AsyncOpenAI 客户端和并发上限"""
+
+    def __init__(self, max_concurrency, pool_size, timeout):
+        self.max_concurrency = max_concurrency
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="openai-loop", daemon=True)
+        self._thread.start()
+        self._stats = {'calls': 0, 'in_flight': 0, 'waiting': 0}
+        self.submit(self._setup(max_concurrency, pool_size, timeout)).result()
+
+    async def _setup(self, max_concurrency, pool_size, timeout):
+        self._slots = asyncio.Semaphore(max_concurrency)
+        http_client = None
+        if httpx is not None:
+            limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+            http_client = httpx.AsyncClient(limits=limits, timeout=timeout)
+        self.client = AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=os.getenv("OPENAI_BASE_URL") or None,
+                                  http_client=http_client, max_retries=0)
+
+    def submit(self, coro):
+        """把协程交给事件循环，返回 concurrent.futures.Future（调用方的 contextvar 会带过去）"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        """在普通线程里阻塞等待协程结果；不能在事件循环线程上调用"""
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("AsyncRuntime.run() called from the event loop thread")
+        return self.submit(coro).result()
+
+    async def acquire(self):
+        self._stats['waiting'] += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self._stats['waiting'] -= 1
+        self._stats['calls'] += 1
+        self._stats['in_flight'] += 1
+
+    def release(self):
+        self._stats['in_flight'] -= 1
+        self._slots.release()
+
+    def stats(self):
+        return dict(self._stats, max_concurrency=self.max_concurrency)
+
+
+ASYNC_RUNTIME = AsyncRuntime(OPENAI_MAX_CONCURRENCY, OPENAI_POOL_SIZE, OPENAI_TIMEOUT) if OPENAI_ASYNC else None
+
+
+# ====== 上游限速：按 OpenAI 的 RPM / TPM 额度排队，429 / 5xx 带抖动退避重试 ======
+# OPENAI_RPM / OPENAI_TPM 为 0 时先不限速，从响应头 x-ratelimit-limit-* 学到额度后自动生效；
+# 只用额度的 OPENAI_RATE_HEADROOM，突发最多 OPENAI_RATE_BURST_S 秒的额度
+OPENAI_RPM = float(os.getenv("OPENAI_RPM", "0"))
+OPENAI_TPM = float(os.getenv("OPENAI_TPM", "0"))
+OPENAI_RATE_HEADROOM = float(os.getenv("OPENAI_RATE_HEADROOM", "0.9"))
+OPENAI_RATE_BURST_S = float(os.getenv("OPENAI_RATE_BURST_S", "5"))
+# 排队超过这么久就不再等，直接报限流（/analyze 返回 503 + Retry-After）
+OPENAI_RATE_MAX_WAIT = float(os.getenv("OPENAI_RATE_MAX_WAIT", "120"))
+# 估算 token 时没有 max_tokens 的请求按这么多输出 token 计
+OPENAI_EST_COMPLETION_TOKENS = int(os.getenv("OPENAI_EST_COMPLETION_TOKENS", "256"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "4"))
+OPENAI_BACKOFF_BASE = float(os.getenv("OPENAI_BACKOFF_BASE", "0.5"))
+OPENAI_BACKOFF_MAX = float(os.getenv("OPENAI_BACKOFF_MAX", "20"))
+
+
+class UpstreamRateLimited(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucketLimiter:
+    """请求数、token 数两个令牌桶，按每分钟额度匀速补充。
+
+    reserve() 立即扣除并返回要等待的秒数：余额为负时后来的调用方等得更久，相当于先来先服务的排队，
+    等待期间不占锁。实际用量在调用结束后 settle() 多退少补。响应头 x-ratelimit-* 用来学习额度，
+    并把余额下调到服务端的剩余额度（同一个 key 的其他节点也在消耗）；429 之后 penalize() 让所有人暂停。
+    """
+
+    def __init__(self, rpm, tpm, headroom, burst_seconds):
+        self.headroom = headroom
+        self.burst_seconds = burst_seconds
+        self._configured = {'requests': rpm > 0, 'tokens': tpm > 0}
+        self._buckets = {'requests': {'level': 0.0}, 'tokens': {'level': 0.0}}
+        self._set_limit('requests', rpm, fill=True)
+        self._set_limit('tokens', tpm, fill=True)
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self._stats = {'reserved': 0, 'delayed': 0, 'wait_seconds': 0.0, 'rejected': 0, 'penalties': 0}
+
+    def _set_limit(self, name, per_minute, fill=False):
+        b = self._buckets[name]
+        b['limit'] = per_minute
+        b['rate'] = per_minute * self.headroom / 60.0
+        b['capacity'] = max(b['rate'] * self.burst_seconds, 1.0)
+        b['level'] = b['capacity'] if fill else min(b['level'], b['capacity'])
+        b['ts'] = time.monotonic()
+
+    def _refill(self, b, now):
+        if b['rate']:
+            b['level'] = min(b['capacity'], b['level'] + (now - b['ts']) * b['rate'])
+        b['ts'] = now
+
+    def reserve(self, tokens, max_wait):
+        with self._lock:
+            now = time.monotonic()
+            wait = max(self._paused_until - now, 0.0)
+            for name, need in (('requests', 1), ('tokens', tokens)):
+                b = self._buckets[name]
+                if not b['rate']:
+                    continue
+                self._refill(b, now)
+                if b['level'] - need < 0:
+                    wait = max(wait, (need - b['level']) / b['rate'])
+            if wait > max_wait:
+                self._stats['rejected'] += 1
+                raise UpstreamRateLimited(f"upstream rate limit: would wait {wait:.1f}s", wait)
+            for name, need in (('requests', 1), ('tokens', tokens)):
+                if self._buckets[name]['rate']:
+                    self._buckets[name]['level'] -= need
+            self._stats['reserved'] += 1
+            if wait > 0:
+                self._stats['delayed'] += 1
+                self._stats['wait_seconds'] += wait
+            return wait
+
+    def settle(self, estimated, actual):
+        with self._lock:
+            b = self._buckets['tokens']
+            if b['rate']:
+                b['level'] = min(b['capacity'], b['level'] + estimated - actual)
+
+    def observe(self, headers):
+        if not headers:
+            return
+        with self._lock:
+            now = time.monotonic()
+            for name in ('requests', 'tokens'):
+                try:
+                    limit = float(headers.get(f"x-ratelimit-limit-{name}") or 0)
+                    remaining = headers.get(f"x-ratelimit-remaining-{name}")
+                    remaining = float(remaining) if remaining is not None else None
+                except ValueError:
+                    continue
+                b = self._buckets[name]
+                if limit and not self._configured[name] and limit != b['limit']:
+                    self._set_limit(name, limit, fill=b['limit'] == 0)
+                if remaining is not None and b['rate']:
+                    self._refill(b, now)
+                    b['level'] = min(b['level'], remaining - b['limit'] * (1 - self.headroom))
+
+    def penalize(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._stats['penalties'] += 1
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            out = dict(self._stats, wait_seconds=round(self._stats['wait_seconds'], 3),
+                       paused_for=round(max(self._paused_until - now, 0.0), 3))
+            for name, b in self._buckets.items():
+                self._refill(b, now)
+                out[name] = {'limit_per_minute': b['limit'],
+                             'available': round(b['level'], 1) if b['rate'] else None}
+            return out
+
+
+OPENAI_LIMITER = TokenBucketLimiter(OPENAI_RPM, OPENAI_TPM, OPENAI_RATE_HEADROOM, OPENAI_RATE_BURST_S)
+
+
+def _estimate_tokens(kwargs):
+    # 粗略估算：约 3 个字符一个 token，加上输出上限
+    chars = sum(len(str(m.get("content", ""))) for m in kwargs.get("messages", []))
+    return chars // 3 + int(kwargs.get("max_tokens") or OPENAI_EST_COMPLETION_TOKENS)
+
+
+def _retry_delay(e, attempt):
+    """429 / 5xx / 连接错误返回下次重试前的等待秒数（全抖动指数退避，不少于 Retry-After），其他错误返回 None"""
+    if isinstance(e, APIStatusError):
+        if not (isinstance(e, RateLimitError) or e.status_code >= 500):
+            return None
+    elif not isinstance(e, APIConnectionError):
+        return None
+    if attempt >= OPENAI_MAX_RETRIES:
+        return None
+    delay = random.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** attempt))
+    response = getattr(e, "response", None)
+    if response is not None:
+        try:
+            if response.headers.get("retry-after-ms"):
+                delay = max(delay, float(response.headers["retry-after-ms"]) / 1000.0)
+            elif response.headers.get("retry-after"):
+                delay = max(delay, float(response.headers["retry-after"]))
+        except ValueError:
+            pass
+        OPENAI_LIMITER.observe(response.headers)
+    if isinstance(e, RateLimitError):
+        OPENAI_LIMITER.penalize(delay)
+    return delay
+
+
+def _count_retry(kind, e, attempt, span):
+    reason = "rate_limited" if isinstance(e, RateLimitError) else \
+        "connection" if isinstance(e, APIConnectionError) else "server_error"
+    METRICS.inc("echonet_openai_retries_total", (("kind", kind), ("reason", reason)))
+    if span is not None:
+        span["attrs"]["retries"] = attempt
+
+
+def _upstream_call(kind, span, estimate, call):
+    """先在令牌桶排队，再调用；可重试的错误退避后重新排队。返回解析后的响应"""
+    attempt = 0
+    while True:
+        wait = OPENAI_LIMITER.reserve(estimate, OPENAI_RATE_MAX_WAIT)
+        if wait > 0:
+            METRICS.observe("echonet_openai_rate_wait_seconds", (("kind", kind),), wait)
+            time.sleep(wait)
+        try:
+            raw = call()
+        except Exception as e:
+            OPENAI_LIMITER.settle(estimate, 0)
+            delay = _retry_delay(e, attempt)
+            if delay is None:
+                raise
+            attempt += 1
+            _count_retry(kind, e, attempt, span)
+            time.sleep(delay)
+            continue
+        OPENAI_LIMITER.observe(raw.headers)
+        return raw.parse()
+
+
+def _openai_create(kind, **kwargs):
+    """所有 chat.completions 调用的统一入口：限速与重试，记录耗时与 token 用量（流式调用在流结束时记录）"""
+    if ASYNC_RUNTIME is not None and not kwargs.get("stream"):
+        return ASYNC_RUNTIME.run(_aopenai_create(kind, **kwargs))
+    model = kwargs.get("model", "")
+    span = _start_span("openai.chat", kind=kind, model=model, stream=bool(kwargs.get("stream")))
+    started = time.perf_counter()
+    estimate = _estimate_tokens(kwargs)
+    try:
+        resp = _upstream_call(kind, span, estimate,
+                              lambda: openai_client.chat.completions.with_raw_response.create(**kwargs))
+    except Exception as e:
+        METRICS.observe("echonet_openai_request_duration_seconds",
+                        (("kind", kind), ("model", model), ("outcome", "error")), time.perf_counter() - started)
+        _end_span(span, e)
+        raise
+    if kwargs.get("stream"):
+        return _metered_stream(resp, kind, model, started, span, estimate)
+    _record_openai(kind, model, started, getattr(resp, "usage", None), span, estimate)
+    return resp
+
+
+def _metered_stream(stream, kind, model, started, span, estimate=None):
+    usage = None
+    try:
+        for chunk in stream:
+            usage = getattr(chunk, "usage", None) or usage
+            if span is not None and "first_token_ms" not in span["attrs"]:
+                span["attrs"]["first_token_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            yield chunk
+    except Exception as e:
+        _end_span(span, e)
+        raise
+    _record_openai(kind, model, started, usage, span, estimate)
+
+
+async def _aupstream_call(kind, span, estimate, call):
+    """_upstream_call 的异步版本：限速排队时不占并发名额，拿到名额后才真正发请求"""
+    attempt = 0
+    while True:
+        wait = OPENAI_LIMITER.reserve(estimate, OPENAI_RATE_MAX_WAIT)
+        if wait > 0:
+            METRICS.observe("echonet_openai_rate_wait_seconds", (("kind", kind),), wait)
+            await asyncio.sleep(wait)
+        await ASYNC_RUNTIME.acquire()
+        try:
+            raw = await call()
+        except Exception as e:
+            ASYNC_RUNTIME.release()
+            OPENAI_LIMITER.settle(estimate, 0)
+            delay = _retry_delay(e, attempt)
+            if delay is None:
+                raise
+            attempt += 1
+            _count_retry(kind, e, attempt, span)
+            await asyncio.sleep(delay)
+            continue
+        OPENAI_LIMITER.observe(raw.headers)
+        return raw.parse()
+
+
+async def _aopenai_create(kind, **kwargs):
+    """_openai_create 的异步版本：在事件循环上排队拿到并发名额；流式调用的名额在流结束时归还"""
+    model = kwargs.get("model", "")
+    span = _start_span("openai.chat", kind=kind, model=model, stream=bool(kwargs.get("stream")))
+    started = time.perf_counter()
+    estimate = _estimate_tokens(kwargs)
+    try:
+        resp = await _aupstream_call(kind, span, estimate,
+                                     lambda: ASYNC_RUNTIME.client.chat.completions.with_raw_response.create(**kwargs))
+    except Exception as e:
+        METRICS.observe("echonet_openai_request_duration_seconds",
+                        (("kind", kind), ("model", model), ("outcome", "error")), time.perf_counter() - started)
+        _end_span(span, e)
+        raise
+    if kwargs.get("stream"):
+        return _ametered_stream(resp, kind, model, started, span, estimate)
+    ASYNC_RUNTIME.release()
+    _record_openai(kind, model, started, getattr(resp, "usage", None), span, estimate)
+    return resp
+
+
+async def _ametered_stream(stream, kind, model, started, span, estimate=None):
+    usage = None
+    try:
+        async for chunk in stream:
+            usage = getattr(chunk, "usage", None) or usage
+            if span is not None and "first_token_ms" not in span["attrs"]:
+                span["attrs"]["first_token_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            yield chunk
+    except Exception as e:
+        _end_span(span, e)
+        raise
+    finally:
+        ASYNC_RUNTIME.release()
+    _record_openai(kind, model, started, usage, span, estimate)
+
+
+def _record_openai(kind, model, started, usage, span=None, estimate=None):
+    METRICS.observe("echonet_openai_request_duration_seconds",
+                    (("kind", kind), ("model", model), ("outcome", "ok")), time.perf_counter() - started)
+    if estimate is not None and getattr(usage, "total_tokens", None):
+        OPENAI_LIMITER.settle(estimate, usage.total_tokens)
+    if usage is not None:
+        for field in ("prompt_tokens", "completion_tokens"):
+            n = getattr(usage, field, None)
+            if n:
+                METRICS.inc("echonet_openai_tokens_total", (("model", model), ("type", field[:-len("_tokens")])), n)
+                if span is not None:
+                    span["attrs"][field] = n
+    _end_span(span)
+
+
+def _chat(prompt, params, model="gpt-4o-mini"):
+    """技能统一的 chat 调用入口：先查缓存，params["cache"] = false 时跳过缓存；
+    当前步骤有 on_token 订阅者时改用流式调用，边生成边回调"""
+    if ASYNC_RUNTIME is not None:
+        return ASYNC_RUNTIME.run(_achat(prompt, params, model))
+    messages = [{"role": "user", "content": prompt}]
+    model = params.get("model", model)
+    sampling = {k: params[k] for k in SAMPLING_PARAMS if k in params}
+    use_cache = params.get("cache", True) is not False
+    on_token = _STEP_ON_TOKEN.get()
+
+    key = LLMCache.make_key(model, messages, sampling)
+    if use_cache:
+        hit = LLM_CACHE.get(key)
+        if hit is not None:
+            if on_token:
+                on_token(hit)
+            return hit
+
+    if on_token:
+        parts = []
+        stream = _openai_create(
+            "chat",
+            model=model,
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True},
+            **sampling,
+        )
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            piece = chunk.choices[0].delta.content
+            if piece:
+                parts.append(piece)
+                on_token(piece)
+        content = "".join(parts)
+    else:
+        completion = _openai_create(
+            "chat",
+            model=model,
+            messages=messages,
+            **sampling,
+        )
+        # new client returns structure similar to legacy; access the content
+        content = completion.choices[0].message.content
+    if use_cache and content is not None:
+        LLM_CACHE.put(key, content)
+    return content
+
+
+async def _achat(prompt, params, model="gpt-4o-mini"):
+    """_chat 的异步版本（缓存、流式回调的行为相同）"""
+    messages = [{"role": "user", "content": prompt}]
+    model = params.get("model", model)
+    sampling = {k: params[k] for k in SAMPLING_PARAMS if k in params}
+    use_cache = params.get("cache", True) is not False
+    on_token = _STEP_ON_TOKEN.get()
+
+    key = LLMCache.make_key(model, messages, sampling)
+    if use_cache:
+        hit = LLM_CACHE.get(key)
+        if hit is not None:
+            if on_token:
+                on_token(hit)
+            return hit
+
+    if on_token:
+        parts = []
+        stream = await _aopenai_create(
+            "chat",
+            model=model,
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True},
+            **sampling,
+        )
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            piece = chunk.choices[0].delta.content
+            if piece:
+                parts.append(piece)
+                on_token(piece)
+        content = "".join(parts)
+    else:
+        completion = await _aopenai_create("chat", model=model, messages=messages, **sampling)
+        content = completion.choices[0].message.content
+    if use_cache and content is not None:
+        LLM_CACHE.put(key, content)
+    return content
+
+
+# ====== 定义本节点的技能实现 ======
+
+def skill_generate_poem_en(state, params):
+    prompt = params.get("prompt", "Write a short poem about i love morven.")
+    poem = _chat(prompt, params)
+    state[params.get("output_var", "english_poem")] = poem
+    return state
+
+def _translate_prompt(text):
+    return f"翻译成中文诗：\n{text}"
+
+
+def _translate_batchable(params):
+    """没有自定义提示词 / 采样参数、允许缓存的普通翻译可以和其他请求合并"""
+    return TRANSLATE_BATCH_WINDOW_MS > 0 and not params.get("prompt") \
+        and not any(k in params for k in SAMPLING_PARAMS) and params.get("cache", True) is not False
+
+
+def skill_translate_zh(state, params):
+    text = state.get(params.get("text_var", "english_poem"), "")
+    if _translate_batchable(params):
+        # 可以和其他请求合并的普通翻译：走微批处理
+        zh = _TRANSLATE_BATCHER.submit(params.get("model", "gpt-4o-mini"), text)
+        on_token = _STEP_ON_TOKEN.get()
+        if on_token:
+            on_token(zh)
+    else:
+        prompt = params.get("prompt") or _translate_prompt(text)
+        zh = _chat(prompt, params)
+    state[params.get("output_var", "chinese_poem")] = zh
+    return state
+
+
+# 技能的异步实现：签名与 SKILL_IMPL 相同，只是返回协程；OPENAI_ASYNC=1 时本机步骤优先用它们
+async def askill_generate_poem_en(state, params):
+    prompt = params.get("prompt", "Write a short poem about i love morven.")
+    state[params.get("output_var", "english_poem")] = await _achat(prompt, params)
+    return state
+
+
+async def askill_translate_zh(state, params):
+    text = state.get(params.get("text_var", "english_poem"), "")
+    if _translate_batchable(params):
+        # 微批处理器是阻塞接口，放到线程池里等，事件循环不被卡住
+        zh = await asyncio.get_running_loop().run_in_executor(
+            BATCH_EXECUTOR, _TRANSLATE_BATCHER.submit, params.get("model", "gpt-4o-mini"), text)
+        on_token = _STEP_ON_TOKEN.get()
+        if on_token:
+            on_token(zh)
+    else:
+        zh = await _achat(params.get("prompt") or _translate_prompt(text), params)
+    state[params.get("output_var", "chinese_poem")] = zh
+    return state
+
+
+def _translate_batch(model, texts):
+    """把多段英文诗合并成一次模型调用翻译；解析失败时逐条调用兜底"""
+    results = [None] * len(texts)
+    keys = [LLMCache.make_key(model, [{"role": "user", "content": _translate_prompt(t)}], {}) for t in texts]
+    missing = []
+    for i, key in enumerate(keys):
+        hit = LLM_CACHE.get(key)
+        if hit is not None:
+            results[i] = hit
+        else:
+            missing.append(i)
+
+    if len(missing) > 1:
+        numbered = "\n\n".join(f"[{n + 1}]\n{texts[i]}" for n, i in enumerate(missing))
+        prompt = (
+            f"把下面 {len(missing)} 首英文诗分别翻译成中文诗（保留诗意）。\n"
+            f"只返回 JSON：{{\"translations\": [...]}}，数组按编号顺序包含 {len(missing)} 个字符串。\n\n"
+            + numbered
+        )
+        completion = _openai_create(
+            "translate_batch",
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+        )
+        parsed = _extract_json_candidate(completion.choices[0].message.content or "")
+        translations = parsed.get("translations") if isinstance(parsed, dict) else None
+        if isinstance(translations, list) and len(translations) == len(missing) \
+                and all(isinstance(x, str) for x in translations):
+            for i, zh in zip(missing, translations):
+                results[i] = zh
+                LLM_CACHE.put(keys[i], zh)
+            missing = []
+
+    for i in missing:
+        try:
+            results[i] = _chat(_translate_prompt(texts[i]), {"model": model})
+        except Exception as e:
+            results[i] = e
+    return results
+
+
+_TRANSLATE_BATCHER = MicroBatcher(TRANSLATE_BATCH_WINDOW_MS / 1000.0, TRANSLATE_BATCH_MAX, _translate_batch)
+
+SKILL_IMPL = {
+    "generate_poem_en": skill_generate_poem_en,
+    "translate_zh": skill_translate_zh,
+}
+
+ASYNC_SKILL_IMPL = {
+    "generate_poem_en": askill_generate_poem_en,
+    "translate_zh": askill_translate_zh,
+}
+
+# 每个技能读/写的 state key，用来推断步骤之间的依赖。
+# params 里的 text_var / output_var 可以改写默认的输入/输出 key（扇出时让各分支互不覆盖）
+SKILL_IO = {
+    "generate_poem_en": {"reads": [], "writes": ["english_poem"]},
+    "translate_zh": {"reads": ["english_poem"], "writes": ["chinese_poem"]},
+}
+
+
+def _step_reads(op, params):
+    io = SKILL_IO.get(op)
+    if io is None:
+        return None
+    reads = list(io["reads"])
+    if reads and params.get("text_var"):
+        reads[0] = params["text_var"]
+    return set(reads)
+
+
+def _step_writes(op, params):
+    io = SKILL_IO.get(op)
+    if io is None:
+        return None
+    writes = list(io["writes"])
+    if writes and params.get("output_var"):
+        writes[0] = params["output_var"]
+    return set(writes)
+
+def self_skills():
+    node = REGISTRY.view.by_id.get(SELF_ID)
+    return set(node["skills"]) if node else set()
+
+SELF_SKILL_SET = self_skills()
+
+# 相同 (op, params, 技能要读的 state) 的并发调用合并成一次执行（params["cache"] = false 时不合并）
+SINGLE_FLIGHT = os.getenv("SINGLE_FLIGHT", "1") == "1"
+_SKILL_FLIGHT = SingleFlight()
+
+
+def _flight_key(op, params, state):
+    reads = _step_reads(op, params)
+    inputs = state if reads is None else {k: state.get(k) for k in reads}
+    return (op, json.dumps(params, sort_keys=True, default=str),
+            json.dumps(inputs, sort_keys=True, default=str))
+
+
+def _invoke_skill(op, impl, state, params):
+    """经过准入控制执行技能，并维护本节点的负载计数（正在执行的步骤数）"""
+    with _span("admission"):
+        STEP_ADMISSION.acquire()
+    NODE_COUNTERS.add("load", 1)
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        with _span("skill", op=op):
+            result = impl(state, params)
+        outcome = "ok"
+        return result
+    finally:
+        METRICS.observe("echonet_skill_duration_seconds", (("op", op), ("outcome", outcome)),
+                        time.perf_counter() - started)
+        NODE_COUNTERS.add("load", -1)
+        STEP_ADMISSION.release()
+
+
+def _run_skill(op, params, state):
+    """执行本地技能；节点过载时抛出 NodeOverloaded"""
+    impl = SKILL_IMPL.get(op)
+    if impl is None:
+        raise StepError(f"skill {op} not implemented on this node")
+    if not SINGLE_FLIGHT or params.get("cache", True) is False:
+        return _invoke_skill(op, impl, state, params)
+
+    on_token = _STEP_ON_TOKEN.get()
+
+    def run(progress):
+        # leader 产生的 token 广播给所有合并进来的调用方；没有订阅者时 progress 为假，_chat 走非流式调用
+        token = _STEP_ON_TOKEN.set(progress)
+        try:
+            before = dict(state)
+            return _state_delta(before, _invoke_skill(op, impl, dict(state), params))
+        finally:
+            _STEP_ON_TOKEN.reset(token)
+
+    delta = _SKILL_FLIGHT.do(_flight_key(op, params, state), run, on_token)
+    state.update(delta)
+    return state
+
+
+async def _ainvoke_skill(op, impl, state, params):
+    """_invoke_skill 的异步版本：有空位直接占用，需要排队时在线程池里等准入（过载时抛出 NodeOverloaded）"""
+    if not STEP_ADMISSION.try_acquire():
+        with _span("admission"):
+            await asyncio.get_running_loop().run_in_executor(None, STEP_ADMISSION.acquire)
+    NODE_COUNTERS.add("load", 1)
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        with _span("skill", op=op):
+            result = await impl(state, params)
+        outcome = "ok"
+        return result
+    finally:
+        METRICS.observe("echonet_skill_duration_seconds", (("op", op), ("outcome", outcome)),
+                        time.perf_counter() - started)
+        NODE_COUNTERS.add("load", -1)
+        STEP_ADMISSION.release()
+
+
+async def _arun_skill(op, impl, params, state):
+    if not SINGLE_FLIGHT or params.get("cache", True) is False:
+        return await _ainvoke_skill(op, impl, state, params)
+
+    on_token = _STEP_ON_TOKEN.get()
+
+    async def run(progress):
+        token = _STEP_ON_TOKEN.set(progress)
+        try:
+            before = dict(state)
+            return _state_delta(before, await _ainvoke_skill(op, impl, dict(state), params))
+        finally:
+            _STEP_ON_TOKEN.reset(token)
+
+    delta = await _SKILL_FLIGHT.ado(_flight_key(op, params, state), run, on_token)
+    state.update(delta)
+    return state
+
+
+# ====== 其他节点的健康度 / 负载（后台线程定期拉取各节点 /info） ======
+PEER_METRICS_INTERVAL = float(os.getenv("PEER_METRICS_INTERVAL", "5"))
+# node_id -> {"health", "load", "max_load", "ts"}
+PEER_METRICS = {}
+# 本节点派发到各 peer 且尚未返回的步骤数
+PEER_INFLIGHT = {}
+_PEER_LOCK = threading.Lock()
+_metrics_poller_started = False
+
+
+def _poll_peer_metrics():
+    while True:
+        REGISTRY.expire()
+        for n in REGISTRY.view.peers:
+            try:
+                resp = PEER_POOL.get(n["url"], "/info", timeout=(PEER_CONNECT_TIMEOUT, 2))
+                data = resp.json()
+                # net.py / echonet_node 把指标放在 metrics 里，PWA 节点的 /info 直接就是指标
+                m = data.get("metrics", data)
+                PEER_METRICS[n["id"]] = {
+                    "health": float(m.get("health", 1.0)),
+                    "load": int(m.get("load", 0) or 0),
+                    "max_load": int(m.get("max_load", MAX_LOAD) or MAX_LOAD),
+                    "ts": time.time(),
+                }
+                REGISTRY.touch(n["id"])
+            except Exception:
+                # 拉取失败：保留旧值，过期后按未知节点处理
+                pass
+        time.sleep(PEER_METRICS_INTERVAL)
+
+
+def _ensure_metrics_poller():
+    global _metrics_poller_started
+    if _metrics_poller_started:
+        return
+    with _PEER_LOCK:
+        if _metrics_poller_started:
+            return
+        _metrics_poller_started = True
+    threading.Thread(target=_poll_peer_metrics, name="peer-metrics", daemon=True).start()
+
+
+# ====== mDNS 发现：与 PWA_echonet / node_test.py 使用同一个服务类型 ======
+DISCOVERY = os.getenv("DISCOVERY", "1") == "1"
+DISCOVERY_ADVERTISE = os.getenv("DISCOVERY_ADVERTISE", "1") == "1"
+DISCOVERY_SERVICE = SERVICE_TYPE
+_DISCOVERY_STATE = {"started": False, "enabled": False, "advertising": False, "zeroconf": None, "advertiser": None}
+_DISCOVERY_LOCK = threading.Lock()
+
+
+def _node_from_service(info):
+    """ServiceInfo -> (注册表里的节点, 广播里的指标)。TXT 格式见 echonet_discovery，
+    解析不了时抛 ValueError，由监听器跳过这一条服务"""
+    rec = decode_txt(info.properties)
+    url = rec["url"]
+    if not url:
+        addresses = info.parsed_addresses()
+        if not addresses:
+            raise ValueError("service has no address")
+        url = f"http://{addresses[0]}:{info.port}"
+    return {"id": rec["id"], "url": url.rstrip("/"), "skills": list(rec["skills"])}, rec["metrics"]
+
+
+class _DiscoveryListener:
+    def __init__(self):
+        self._names = {}  # 服务名 -> node_id，remove_service 时只有服务名
+
+    def add_service(self, zc, service_type, name):
+        info = zc.get_service_info(service_type, name)
+        if not info:
+            return
+        try:
+            node, metrics = _node_from_service(info)
+        except ValueError as e:
+            print(f"ignoring mDNS service {name}: {e}")
+            return
+        if node["id"] == SELF_ID:
+            return
+        self._names[name] = node["id"]
+        if REGISTRY.upsert(node):
+            print(f"discovered node {node['id']} @ {node['url']} skills={node['skills']}")
+        if metrics:
+            # 广播里带的指标先用着，之后由 /info 轮询刷新；v1 的 JSON 指标可能缺字段 / 类型不对
+            try:
+                PEER_METRICS[node["id"]] = {
+                    "health": float(metrics.get("health", 1.0)),
+                    "load": int(metrics.get("load", 0) or 0),
+                    "max_load": int(metrics.get("max_load", MAX_LOAD) or MAX_LOAD),
+                    "ts": time.time(),
+                }
+            except (TypeError, ValueError):
+                pass
+
+    update_service = add_service
+
+    def remove_service(self, zc, service_type, name):
+        node_id = self._names.pop(name, None)
+        if node_id and REGISTRY.remove(node_id):
+            print(f"node {node_id} left")
+
+
+def _advertise_self(zc):
+    """用共享的 Advertiser 广播本节点：指标变化超过阈值时更新，否则每 ADVERTISE_HEARTBEAT 秒心跳一次，
+    其他节点才不会在 NODE_TTL 后把本节点当成离线"""
+    parsed = urllib.parse.urlsplit(SELF_URL)
+    host = parsed.hostname or "127.0.0.1"
+    port = parsed.port or 80
+    url = SELF_URL
+    if host in ("127.0.0.1", "localhost", "0.0.0.0"):
+        # 回环地址对其他设备没有意义，改为广播局域网地址
+        host = get_local_ip()
+        url = f"{parsed.scheme}://{host}:{port}"
+    adv = Advertiser(zc, SELF_ID, socket.gethostbyname(host), port, SELF_SKILL_SET, get_node_metrics, url=url)
+    try:
+        adv.tick()
+    except Exception as e:
+        # 多 worker 时只有一个进程能注册同名服务，其余 worker 只做发现
+        print(f"mDNS advertise skipped: {e}")
+        return
+    _DISCOVERY_STATE.update(advertising=True, advertiser=adv)
+    while True:
+        time.sleep(ADVERTISE_CHECK)
+        try:
+            adv.tick()
+        except Exception as e:
+            # 单次失败不停止广播，否则其他节点会在 NODE_TTL 后把本节点移除
+            print(f"mDNS advertise failed: {e}")
+
+
+def _start_discovery():
+    """启动 mDNS 发现 / 广播，只执行一次。不在 import 时执行（测试、工具脚本 import net 不应该上网广播）：
+    直接运行时由 __main__ 在开始监听前调用，经 serve.py 加载时由第一个请求触发"""
+    if not DISCOVERY:
+        return
+    with _DISCOVERY_LOCK:
+        if _DISCOVERY_STATE["started"]:
+            return
+        _DISCOVERY_STATE["started"] = True
+    if Zeroconf is None:
+        print("zeroconf not installed; using nodes.json only (pip install zeroconf for LAN discovery)")
+        return
+    zc = Zeroconf(ip_version=4)
+    # 正常退出时发送 goodbye，其他节点立即把本节点移出注册表
+    atexit.register(zc.close)
+    _DISCOVERY_STATE.update(enabled=True, zeroconf=zc)
+    ServiceBrowser(zc, DISCOVERY_SERVICE, _DiscoveryListener())
+    if DISCOVERY_ADVERTISE:
+        threading.Thread(target=_advertise_self, args=(zc,), name="mdns-advertise", daemon=True).start()
+    # 过期清理跟随 /info 轮询线程
+    _ensure_metrics_poller()
+
+
+@app.before_request
+def _discovery_on_first_request():
+    if DISCOVERY and not _DISCOVERY_STATE["started"]:
+        _start_discovery()
+
+
+def _peer_load(node_id):
+    """返回 (health, 负载)：负载 = 节点上报的 load + 本节点派发给它还没返回的步骤数"""
+    if node_id == SELF_ID:
+        load = _current_load()
+        return compute_health(get_cpu(), get_battery(), load), load
+    m = PEER_METRICS.get(node_id)
+    inflight = PEER_INFLIGHT.get(node_id, 0)
+    if m is None or time.time() - m["ts"] > PEER_METRICS_INTERVAL * 3:
+        # 没有（或已过期的）指标：按中等健康度处理，优先选择已知健康的副本
+        return 0.5, inflight
+    return m["health"], m["load"] + inflight
+
+
+def _track_inflight(node_id, delta):
+    with _PEER_LOCK:
+        PEER_INFLIGHT[node_id] = PEER_INFLIGHT.get(node_id, 0) + delta
+
+
+# ====== 每个 peer 一个熔断器：最近 BREAKER_WINDOW 次请求失败率过高时熔断，路由直接跳过该节点 ======
+BREAKER_WINDOW = int(os.getenv("BREAKER_WINDOW", "20"))
+BREAKER_MIN_REQUESTS = int(os.getenv("BREAKER_MIN_REQUESTS", "4"))
+BREAKER_FAILURE_RATE = float(os.getenv("BREAKER_FAILURE_RATE", "0.5"))
+# 熔断多久后进入半开状态，放一个探测请求过去
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "10"))
+
+
+class CircuitBreaker:
+    """closed -> open（失败率超过阈值）-> half_open（冷却结束，只放行一个探测请求）
+    -> 探测成功回到 closed，失败重新 open"""
+
+    def __init__(self, window, min_requests, failure_rate, open_seconds, probe_timeout):
+        self.min_requests = min_requests
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.probe_timeout = probe_timeout
+        self.state = "closed"
+        self._outcomes = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probe_started = None
+        self._lock = threading.Lock()
+        self._stats = {'opened': 0, 'rejected': 0}
+
+    def _refresh(self, now):
+        if self.state == "open" and now - self._opened_at >= self.open_seconds:
+            self.state = "half_open"
+            self._probe_started = None
+
+    def available(self):
+        """路由时使用：是否值得把请求发给该节点（不占用探测名额）"""
+        with self._lock:
+            now = time.time()
+            self._refresh(now)
+            if self.state == "closed":
+                return True
+            if self.state == "half_open":
+                return self._probe_started is None or now - self._probe_started > self.probe_timeout
+            return False
+
+    def allow(self):
+        """真正发请求前调用；半开状态下只有拿到探测名额的请求返回 True"""
+        with self._lock:
+            now = time.time()
+            self._refresh(now)
+            if self.state == "closed":
+                return True
+            if self.state == "half_open" and (self._probe_started is None
+                                              or now - self._probe_started > self.probe_timeout):
+                self._probe_started = now
+                return True
+            self._stats['rejected'] += 1
+            return False
+
+    def record(self, ok):
+        with self._lock:
+            if self.state == "half_open":
+                if ok:
+                    self.state = "closed"
+                    self._outcomes.clear()
+                else:
+                    self._trip()
+                return
+            if self.state != "closed":
+                return
+            self._outcomes.append(ok)
+            failures = self._outcomes.count(False)
+            if len(self._outcomes) >= self.min_requests and failures / len(self._outcomes) >= self.failure_rate:
+                self._trip()
+
+    def _trip(self):
+        self.state = "open"
+        self._opened_at = time.time()
+        self._probe_started = None
+        self._outcomes.clear()
+        self._stats['opened'] += 1
+
+    def stats(self):
+        with self._lock:
+            self._refresh(time.time())
+            return dict(self._stats, state=self.state, window_requests=len(self._outcomes),
+                        window_failures=self._outcomes.count(False))
+
+
+PEER_BREAKERS = {}
+
+
+def _breaker(node_id):
+    b = PEER_BREAKERS.get(node_id)
+    if b is None:
+        with _PEER_LOCK:
+            b = PEER_BREAKERS.setdefault(node_id, CircuitBreaker(
+                BREAKER_WINDOW, BREAKER_MIN_REQUESTS, BREAKER_FAILURE_RATE, BREAKER_OPEN_SECONDS,
+                PEER_READ_TIMEOUT))
+    return b
+
+
+def _node_available(node):
+    return node["id"] == SELF_ID or _breaker(node["id"]).available()
+
+
+# ====== 工具：根据 op 找一个有这个技能的节点 ======
+def find_node_for_op(op, exclude=()):
+    # 熔断中的节点直接跳过
+    candidates = [n for n in REGISTRY.view.by_op.get(op, ()) if n["id"] not in exclude and _node_available(n)]
+    if not candidates:
+        return None
+    if len(candidates) == 1:
+        return candidates[0]
+    _ensure_metrics_poller()
+
+    # power-of-two-choices：按健康度加权随机抽两个副本，选负载/健康度更低的那个
+    loads = {n["id"]: _peer_load(n["id"]) for n in candidates}
+    weights = [loads[n["id"]][0] + 0.05 for n in candidates]
+    first = random.choices(candidates, weights=weights)[0]
+    rest = [n for n in candidates if n is not first]
+    second = random.choices(rest, weights=[loads[n["id"]][0] + 0.05 for n in rest])[0]
+
+    def cost(n):
+        health, load = loads[n["id"]]
+        return (load + 1) / max(health, 0.05)
+
+    return min((first, second), key=cost)
+
+# ====== 任务事件 ======
+def _open_events(task_id, stream=False):
+    """stream=True：客户端提交时就声明要看逐 token 输出（SSE 可能在第一步开始之后才连上）"""
+    now = time.time()
+    with _EVENTS_COND:
+        # 顺便清理已过保留期的事件日志
+        while _EVENTS_EXPIRY and _EVENTS_EXPIRY[0][0] <= now:
+            TASK_EVENTS.pop(_EVENTS_EXPIRY.popleft()[1], None)
+        TASK_EVENTS[task_id] = {"events": [], "closed": False, "stream": stream, "subscribers": 0}
+
+
+def _token_listener(task_id, sid, op):
+    """步骤开始时决定是否流式：有 SSE 订阅者或客户端要求流式时返回 token 回调，
+    否则返回 None，模型 / 远程步骤走非流式调用，事件日志里只有步骤级事件"""
+    with _EVENTS_COND:
+        log = TASK_EVENTS.get(task_id)
+        if log is None or log["closed"] or not (log["stream"] or log["subscribers"]):
+            return None
+    return lambda text: _emit(task_id, "token", step=sid, op=op, text=text)
+
+
+def _emit(task_id, event, **data):
+    with _EVENTS_COND:
+        log = TASK_EVENTS.get(task_id)
+        if log is None or log["closed"]:
+            return
+        log["events"].append((event, data))
+        if event in TERMINAL_EVENTS:
+            log["closed"] = True
+            _EVENTS_EXPIRY.append((time.time() + TASK_EVENTS_TTL, task_id))
+        _EVENTS_COND.notify_all()
+
+
+# ====== TASK_STORE 读写（worker 线程与请求线程共享，加锁由各个 store 负责） ======
+def _task_update(task_id, **fields):
+    TASK_STORE.update(task_id, **fields)
+
+
+def _step_update(task_id, idx, **fields):
+    TASK_STORE.update_step(task_id, idx, **fields)
+
+
+def _task_snapshot(task_id):
+    return TASK_STORE.get(task_id)
+
+
+class StepError(Exception):
+    """流水线中某一步失败（找不到节点、远程失败等），由 worker 记录到 TASK_STORE"""
+
+
+class NodeUnavailable(StepError):
+    """连不上目标节点（或其熔断器处于打开状态），应换一个副本"""
+
+
+class NodeOverloaded(StepError):
+    """目标节点（或本节点）执行队列已满，应换一个副本或稍后重试"""
+
+    def __init__(self, message, retry_after=OVERLOAD_RETRY_AFTER):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# 所有副本都过载时，等待 Retry-After 后重新挑选的次数
+OVERLOAD_RETRIES = int(os.getenv("OVERLOAD_RETRIES", "3"))
+
+
+def _retry_after(resp):
+    try:
+        return float(resp.headers.get("Retry-After", OVERLOAD_RETRY_AFTER))
+    except ValueError:
+        return OVERLOAD_RETRY_AFTER
+
+
+def _pick_target_node(step):
+    op = step["op"]
+    # 如果调用方/AI 指定了 target_node 且该节点存在且声明了此技能，则优先使用
+    specified = step.get("target_node")
+    if specified:
+        n = REGISTRY.view.by_id.get(specified)
+        if n is not None and op in n.get('skills', []) and _node_available(n):
+            return n
+    # 否则按照能力选择节点
+    return find_node_for_op(op)
+
+
+def _execute_on_node(target_node, op, params, state, on_token=None):
+    if target_node["id"] == SELF_ID:
+        # 本机有这个技能 → 本地执行
+        token = _STEP_ON_TOKEN.set(on_token)
+        try:
+            return _run_skill(op, params, state)
+        finally:
+            _STEP_ON_TOKEN.reset(token)
+
+    # 交给别的节点执行这一步（复用到该节点的 keep-alive 连接）
+    # 只发送该技能要读的 state key，并要求对方只回传写入的增量
+    payload = {
+        "op": op,
+        "params": params,
+        "state": _transfer_state(op, params, state),
+        "delta": True,
+    }
+    if PEER_BATCH_WINDOW_MS > 0:
+        payload["traceparent"] = _traceparent()
+        with _span("peer_batch", peer=target_node["id"]):
+            body = _PEER_BATCHER.submit(target_node["url"], (target_node, payload))
+        return _merge_remote(state, body)
+    if on_token:
+        # 让远程节点以 NDJSON 流的形式边执行边回传 token
+        payload["stream"] = True
+    with _span("serialize", peer=target_node["id"]) as sp:
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        if sp is not None:
+            sp["attrs"]["bytes"] = len(data)
+    _track_inflight(target_node["id"], 1)
+    try:
+        with _span("http", peer=target_node["id"], path="/execute_step"):
+            headers = {"Content-Type": "application/json"}
+            if _traceparent():
+                headers["traceparent"] = _traceparent()
+            resp = _post_to_peer(target_node, "/execute_step", data=data, headers=headers,
+                                 stream=bool(on_token))
+        try:
+            if resp.status_code == 429:
+                raise NodeOverloaded(f"remote node {target_node['id']} is overloaded", _retry_after(resp))
+            if resp.status_code != 200:
+                raise StepError(f"remote node {target_node['id']} failed: {_response_text(resp)}")
+            with _span("receive", peer=target_node["id"]):
+                if not resp.headers.get("Content-Type", "").startswith("application/x-ndjson"):
+                    # 旧版本节点不支持流式，直接返回整个 JSON
+                    return _merge_remote(state, json.loads(_response_text(resp)))
+                return _merge_remote(state, _consume_step_stream(target_node, resp, on_token))
+        finally:
+            resp.close()
+    finally:
+        _track_inflight(target_node["id"], -1)
+
+
+# ====== 对冲请求：远程步骤超过该 op 历史延迟的 HEDGE_PERCENTILE 分位仍未开始返回时，向另一个副本再发一份 ======
+STEP_HEDGING = os.getenv("STEP_HEDGING", "0") == "1"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+# 样本不足 HEDGE_MIN_SAMPLES 个时使用 HEDGE_DEFAULT_DELAY 秒
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "5"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY_MS", "50")) / 1000.0
+
+
+class LatencyTracker:
+    """按 op 记录最近 window 次远程步骤的耗时，用于计算对冲阈值"""
+
+    def __init__(self, window=200):
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, op, seconds):
+        with self._lock:
+            self._samples.setdefault(op, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, op, p):
+        with self._lock:
+            samples = sorted(self._samples.get(op, ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+    def stats(self):
+        with self._lock:
+            ops = list(self._samples)
+        return {op: {"samples": len(self._samples[op]),
+                     "p50": self.percentile(op, 50), "p99": self.percentile(op, 99)} for op in ops}
+
+
+STEP_LATENCY = LatencyTracker()
+HEDGE_STATS = {"hedged": 0, "hedge_wins": 0}
+_HEDGE_LOCK = threading.Lock()
+
+
+def _hedge_delay(op):
+    p = STEP_LATENCY.percentile(op, HEDGE_PERCENTILE)
+    return HEDGE_DEFAULT_DELAY if p is None else max(p, HEDGE_MIN_DELAY)
+
+
+def _execute_remote_timed(target_node, op, params, state, on_token):
+    started = time.time()
+    result = _execute_on_node(target_node, op, params, state, on_token=on_token)
+    STEP_LATENCY.record(op, time.time() - started)
+    return result
+
+
+def _execute_hedged(target_node, op, params, state, on_token=None, on_backup_win=None):
+    """执行远程步骤；开启 STEP_HEDGING 时，超过阈值仍无响应（没有任何 token）就向另一个副本再发一份，
+    取先成功的结果，另一份的结果直接丢弃；备份副本胜出时回调 on_backup_win(node)"""
+    if target_node["id"] == SELF_ID:
+        return _execute_on_node(target_node, op, params, state, on_token=on_token)
+    if not STEP_HEDGING:
+        return _execute_remote_timed(target_node, op, params, state, on_token)
+
+    # 先发出 token 的那一份独占 token 推送，避免两份输出交错
+    owner = []
+    first_token = threading.Event()
+
+    def token_sink(attempt):
+        def sink(text):
+            with _HEDGE_LOCK:
+                if not owner:
+                    owner.append(attempt)
+                mine = owner[0] == attempt
+            first_token.set()
+            if mine and on_token:
+                on_token(text)
+        return sink
+
+    ctx = _trace_context()
+    primary = HEDGE_EXECUTOR.submit(_in_scope, ctx, _execute_remote_timed, target_node, op, params, dict(state),
+                                    token_sink(0))
+    wait([primary], timeout=_hedge_delay(op))
+    if primary.done() or first_token.is_set():
+        return primary.result()
+    backup_node = find_node_for_op(op, exclude={target_node["id"]})
+    if backup_node is None:
+        return primary.result()
+
+    with _HEDGE_LOCK:
+        HEDGE_STATS["hedged"] += 1
+    backup = HEDGE_EXECUTOR.submit(_in_scope, ctx, _execute_remote_timed, backup_node, op, params, dict(state),
+                                   token_sink(1))
+    pending = {primary, backup}
+    error = None
+    while pending:
+        finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for f in finished:
+            if f.exception() is None:
+                if f is backup:
+                    with _HEDGE_LOCK:
+                        HEDGE_STATS["hedge_wins"] += 1
+                    if on_backup_win:
+                        on_backup_win(backup_node)
+                return f.result()
+            if f is primary or error is None:
+                error = f.exception()
+    raise error
+
+
+def _post_to_peer(node, path, json=None, stream=False, data=None, headers=None):
+    """经过熔断器向 peer 发请求：连接失败 / 5xx 计为失败，连接失败时抛出 NodeUnavailable"""
+    breaker = _breaker(node["id"])
+    if not breaker.allow():
+        raise NodeUnavailable(f"remote node {node['id']} is unavailable (circuit open)")
+    started = time.perf_counter()
+    try:
+        resp = PEER_POOL.post(node["url"], path, json=json, stream=stream, data=data, headers=headers)
+    except Exception as e:
+        breaker.record(False)
+        METRICS.observe("echonet_peer_request_duration_seconds",
+                        (("peer", node["id"]), ("path", path), ("outcome", "unreachable")),
+                        time.perf_counter() - started)
+        raise NodeUnavailable(f"remote node {node['id']} is unreachable: {e}")
+    breaker.record(resp.status_code < 500)
+    METRICS.observe("echonet_peer_request_duration_seconds",
+                    (("peer", node["id"]), ("path", path), ("outcome", str(resp.status_code))),
+                    time.perf_counter() - started)
+    return resp
+
+
+def _transfer_state(op, params, state):
+    reads = _step_reads(op, params)
+    if reads is None:
+        # 没有声明读集合的技能只能发送完整 state
+        return state
+    return {k: state[k] for k in reads if k in state}
+
+
+def _merge_remote(state, body):
+    """远程返回 {"delta": ...} 时合并到本地 state；旧节点返回完整 {"state": ...} 时直接使用"""
+    if "delta" in body:
+        merged = dict(state)
+        merged.update(body["delta"])
+        return merged
+    return body["state"]
+
+
+def _send_peer_batch(base_url, items):
+    """把发往同一 peer 的多个步骤合并成一次 /execute_steps 调用"""
+    node = items[0][0]
+    _track_inflight(node["id"], len(items))
+    try:
+        resp = _post_to_peer(node, "/execute_steps", json={"items": [payload for _, payload in items]})
+    except NodeUnavailable as e:
+        return [e] * len(items)
+    finally:
+        _track_inflight(node["id"], -len(items))
+    if resp.status_code == 429:
+        return [NodeOverloaded(f"remote node {node['id']} is overloaded", _retry_after(resp))] * len(items)
+    if resp.status_code != 200:
+        err = StepError(f"remote node {node['id']} failed: {resp.text}")
+        return [err] * len(items)
+    out = []
+    for r in resp.json()["results"]:
+        if "state" in r or "delta" in r:
+            out.append(r)
+        elif r.get("status") == 429:
+            out.append(NodeOverloaded(f"remote node {node['id']} is overloaded", r.get("retry_after", OVERLOAD_RETRY_AFTER)))
+        else:
+            out.append(StepError(f"remote node {node['id']} failed: {r.get('error')}"))
+    return out
+
+
+_PEER_BATCHER = MicroBatcher(PEER_BATCH_WINDOW_MS / 1000.0, PEER_BATCH_MAX, _send_peer_batch)
+
+
+def _response_text(resp):
+    if isinstance(resp, requests.Response):
+        return resp.text
+    resp.read()
+    return resp.text
+
+
+def _consume_step_stream(target_node, resp, on_token):
+    lines = resp.iter_lines(decode_unicode=True) if isinstance(resp, requests.Response) else resp.iter_lines()
+    for line in lines:
+        if not line:
+            continue
+        msg = json.loads(line)
+        if msg["type"] == "token":
+            on_token(msg["text"])
+        elif msg["type"] == "state":
+            return {"state": msg["state"]}
+        elif msg["type"] == "delta":
+            return {"delta": msg["delta"]}
+        elif msg["type"] == "error":
+            if msg.get("status") == 429:
+                raise NodeOverloaded(f"remote node {target_node['id']} is overloaded",
+                                     msg.get("retry_after", OVERLOAD_RETRY_AFTER))
+            raise StepError(f"remote node {target_node['id']} failed: {msg['error']}")
+    raise StepError(f"remote node {target_node['id']} closed the stream without a result")
+
+
+def _step_id(step, idx):
+    return str(step.get("id") or f"s{idx}")
+
 
-# 把 frontend 目录作为静态资源目录（避免跨域，便于直接在同一服务下提供 UI）
-app = Flask(__name__, static_folder='frontend', static_url_path='')
+def _build_dag(pipeline):
+    """返回每个步骤依赖的步骤下标集合：deps[i] = {j, ...}
 
+    步骤可以显式给出 depends_on（步骤 id 列表）；否则按 SKILL_IO 推断：
+    读后写 / 写后读 / 写后写 同一个 state key 的步骤保持原有先后顺序，
+    未声明读写集合的技能当作屏障，与前后所有步骤串行。
+    """
+    ids = [_step_id(step, i) for i, step in enumerate(pipeline)]
+    index = {}
+    for i, sid in enumerate(ids):
+        if sid in index:
+            raise ValueError(f'duplicate step id "{sid}"')
+        index[sid] = i
 
-# 根路径返回前端页面 index.html，避免浏览器访问 / 时 404
-@app.route('/', methods=['GET'])
-def root_index():
-    # Use an absolute path to be robust against different working directories
-    frontend_dir = os.path.join(os.path.dirname(__file__), 'frontend')
-    return send_from_directory(frontend_dir, 'index.html')
+    io = [(_step_reads(step["op"], step.get("params") or {}),
+           _step_writes(step["op"], step.get("params") or {})) for step in pipeline]
 
-# ====== 读取配置 ======
-with open("nodes.json", "r", encoding="utf-8") as f:
-    CONFIG = json.load(f)
+    deps = []
+    for i, step in enumerate(pipeline):
+        explicit = step.get("depends_on")
+        if explicit is not None:
+            if not isinstance(explicit, list):
+                raise ValueError(f'step "{ids[i]}" depends_on must be a list')
+            d = set()
+            for ref in explicit:
+                if str(ref) not in index:
+                    raise ValueError(f'step "{ids[i]}" depends on unknown step "{ref}"')
+                d.add(index[str(ref)])
+            deps.append(d)
+            continue
 
-SELF_ID = CONFIG["self_id"]
-SELF_URL = CONFIG["self_url"]
-NODES = CONFIG["nodes"]
+        reads_i, writes_i = io[i]
+        d = set()
+        for j in range(i):
+            reads_j, writes_j = io[j]
+            if reads_i is None or writes_j is None:
+                d.add(j)
+            elif (writes_j & reads_i) or (writes_j & writes_i) or (reads_j & writes_i):
+                d.add(j)
+        deps.append(d)
 
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-if not OPENAI_API_KEY:
-    raise RuntimeError("OPENAI_API_KEY not set in environment/.env")
+    # 检查环：按拓扑序能把所有步骤排完才算合法
+    remaining = set(range(len(pipeline)))
+    done = set()
+    while remaining:
+        ready = {i for i in remaining if deps[i] <= done}
+        if not ready:
+            raise ValueError("pipeline depends_on contains a cycle")
+        done |= ready
+        remaining -= ready
+    return deps
 
-# 新版 OpenAI Python 客户端
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
 
-# --- Minimal user store (token -> user id)
-USERS = {}
-if os.path.exists('users.json'):
+def _run_step(task_id, idx, step, state):
+    """执行单个步骤；state 是快照的副本，返回该步骤执行后的完整 state"""
+    op = step["op"]
+    params = step.get("params", {})
+    sid = _step_id(step, idx)
+    with _span("step", step=sid, op=op):
+        return _run_step_traced(task_id, idx, step, state, sid, op, params)
+
+
+def _run_step_traced(task_id, idx, step, state, sid, op, params):
+    _step_update(task_id, idx, status='running', started_at=time.time())
+    with _span("route", op=op) as sp:
+        target_node = _pick_target_node(step)
+        if sp is not None and target_node is not None:
+            sp["attrs"]["node"] = target_node["id"]
+    if target_node is None:
+        raise StepError(f"no node can handle op={op}")
+
+    on_token = _token_listener(task_id, sid, op)
+
+    # 节点连不上 / 过载（429）时换一个还没试过的副本；所有副本都过载时等 Retry-After 再来
+    tried = set()
+    retries = 0
+    while True:
+        _step_update(task_id, idx, node=target_node["id"])
+        _emit(task_id, "step_started", step=sid, op=op, node=target_node["id"])
+        try:
+            return _execute_hedged(target_node, op, params, dict(state), on_token=on_token,
+                                   on_backup_win=lambda n: _step_update(task_id, idx, node=n["id"]))
+        except NodeUnavailable:
+            # 节点连不上：立即换一个副本，没有可用副本就失败
+            tried.add(target_node["id"])
+            target_node = find_node_for_op(op, exclude=tried)
+            if target_node is None:
+                raise
+        except NodeOverloaded as e:
+            tried.add(target_node["id"])
+            target_node = find_node_for_op(op, exclude=tried)
+            if target_node is None:
+                if retries >= OVERLOAD_RETRIES:
+                    raise
+                retries += 1
+                time.sleep(e.retry_after)
+                tried.clear()
+                target_node = find_node_for_op(op)
+                if target_node is None:
+                    raise
+
+
+async def _arun_step(task_id, idx, step, state):
+    """事件循环上执行一个步骤：路由到本机且有异步实现时直接 await；
+    远程步骤、只有同步实现的技能、本机过载时交给线程池里的 _run_step（换副本、重试、对冲都在那里）"""
+    op = step["op"]
+    params = step.get("params", {})
+    impl = ASYNC_SKILL_IMPL.get(op)
+    if impl is not None and op in SELF_SKILL_SET:
+        target_node = _pick_target_node(step)
+        if target_node is not None and target_node["id"] == SELF_ID:
+            sid = _step_id(step, idx)
+            try:
+                with _span("step", step=sid, op=op):
+                    _step_update(task_id, idx, status='running', started_at=time.time(), node=SELF_ID)
+                    _emit(task_id, "step_started", step=sid, op=op, node=SELF_ID)
+                    token = _STEP_ON_TOKEN.set(_token_listener(task_id, sid, op))
+                    try:
+                        return await _arun_skill(op, impl, params, dict(state))
+                    finally:
+                        _STEP_ON_TOKEN.reset(token)
+            except NodeOverloaded:
+                pass
+    return await asyncio.get_running_loop().run_in_executor(
+        STEP_EXECUTOR, _in_scope, _trace_context(), _run_step, task_id, idx, step, state)
+
+
+def _task_trace_started(task_id, trace):
+    """worker 开始执行任务：记录排队耗时，返回任务根 span 作为当前 trace 上下文"""
+    if trace is None:
+        return None
+    t = _task_snapshot(task_id)
+    if t is not None:
+        with _trace_scope(trace):
+            span = _start_span("queued")
+            if span is not None:
+                span["start"] = t['created_at']
+                _end_span(span)
+    return trace
+
+
+def _fail_task(task_id, exc):
+    """worker 里的意外异常：把任务和未结束的步骤标记为失败，而不是让任务一直停在 running"""
+    print(f"task {task_id} crashed: {exc!r}")
+    t = _task_snapshot(task_id)
+    if t is None or t['status'] in TERMINAL_STATUSES:
+        return
+    for i, st in enumerate(t['steps']):
+        if st['status'] not in ('done', 'error', 'skipped'):
+            _step_update(task_id, i, status='skipped')
+    _finish_task(task_id, 'error', None, f"internal error: {exc}")
+
+
+def _run_task(task_id, pipeline, state, trace=None):
     try:
-        with open('users.json', 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            for u in data.get('users', []):
-                USERS[u['token']] = u['id']
-    except Exception:
-        USERS = {}
-else:
-    # create a default test user (convenience for local testing)
-    USERS['testtoken123'] = 'user1'
+        with _trace_scope(_task_trace_started(task_id, trace)):
+            _run_task_dag(task_id, pipeline, state)
+    except Exception as e:
+        _fail_task(task_id, e)
 
-# In-memory task store: task_id -> { owner_token, pipeline, final_state, status }
-TASK_STORE = {}
 
-import uuid
+def _run_task_dag(task_id, pipeline, state):
+    """在 worker 线程里按 DAG 执行流水线：所有依赖已满足的步骤并发派发，
+    完成后按步骤下标顺序合并各自对 state 的修改，保证结果确定"""
+    _task_update(task_id, status='running', started_at=time.time())
+    _emit(task_id, "task_started")
+    deps = _build_dag(pipeline)
+    pending = set(range(len(pipeline)))
+    done = set()
+    running = {}
+    snapshots = {}
+    failure = None
 
-def _require_token(req):
-    token = req.headers.get('X-User-Token') or req.args.get('token')
-    if not token:
-        return None, ('missing X-User-Token header', 401)
-    if token not in USERS:
-        return None, ('invalid token', 403)
-    return token, None
+    while (pending and failure is None) or running:
+        if failure is None:
+            ready = sorted(i for i in pending if deps[i] <= done)
+            if len(ready) == 1 and not running:
+                # 纯串行的情况直接在当前线程执行，省一次线程切换
+                i = ready[0]
+                pending.discard(i)
+                snapshots[i] = dict(state)
+                try:
+                    outcome = (_run_step(task_id, i, pipeline[i], snapshots[i]), None)
+                except Exception as e:
+                    outcome = (None, e)
+                finished = [(i, outcome)]
+            else:
+                for i in ready:
+                    pending.discard(i)
+                    snapshots[i] = dict(state)
+                    running[STEP_EXECUTOR.submit(_in_scope, _trace_context(), _run_step,
+                                                 task_id, i, pipeline[i], snapshots[i])] = i
+                finished = []
+        else:
+            finished = []
 
-# ====== 定义本节点的技能实现 ======
+        if not finished:
+            if not running:
+                failure = failure or "pipeline stalled: unresolved dependencies"
+                break
+            completed, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for fut in completed:
+                i = running.pop(fut)
+                exc = fut.exception()
+                finished.append((i, (None, exc) if exc else (fut.result(), None)))
 
-def skill_generate_poem_en(state, params):
-    prompt = params.get("prompt", "Write a short poem about i love morven.")
-    completion = openai_client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[{"role": "user", "content": prompt}],
-    )
-    # new client returns structure similar to legacy; access the content
-    poem = completion.choices[0].message.content
-    state["english_poem"] = poem
-    return state
+        for i, (new_state, exc) in sorted(finished, key=lambda x: x[0]):
+            error = _settle_step(task_id, pipeline, i, new_state, exc, state, snapshots, done)
+            failure = failure or error
 
-def skill_translate_zh(state, params):
-    text = state.get("english_poem", "")
-    prompt = params.get("prompt") or f"翻译成中文诗：\n{text}"
-    completion = openai_client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[{"role": "user", "content": prompt}],
-    )
-    zh = completion.choices[0].message.content
-    state["chinese_poem"] = zh
-    return state
+    _finish_dag(task_id, state, pending, failure)
 
-SKILL_IMPL = {
-    "generate_poem_en": skill_generate_poem_en,
-    "translate_zh": skill_translate_zh,
-}
 
-def self_skills():
-    for n in NODES:
-        if n["id"] == SELF_ID:
-            return set(n["skills"])
-    return set()
+def _settle_step(task_id, pipeline, i, new_state, exc, state, snapshots, done):
+    """合并一个已结束步骤的结果；失败时返回错误描述"""
+    if exc is not None:
+        _step_update(task_id, i, status='error', error=str(exc), finished_at=time.time())
+        _emit(task_id, "step_finished", step=_step_id(pipeline[i], i), op=pipeline[i]["op"],
+              status='error', error=str(exc))
+        return f"step {_step_id(pipeline[i], i)} ({pipeline[i]['op']}) failed: {exc}"
+    before = snapshots.pop(i)
+    state.update({k: v for k, v in new_state.items() if k not in before or before[k] != v})
+    done.add(i)
+    _step_update(task_id, i, status='done', finished_at=time.time())
+    _emit(task_id, "step_finished", step=_step_id(pipeline[i], i), op=pipeline[i]["op"], status='done')
+    return None
 
-SELF_SKILL_SET = self_skills()
 
-# ====== 工具：根据 op 找一个有这个技能的节点 ======
-def find_node_for_op(op):
-    candidates = [n for n in NODES if op in n["skills"]]
-    if not candidates:
-        return None
-    # 简单：随便选第一个，后面可以做负载均衡
-    return candidates[0]
+def _finish_dag(task_id, state, pending, failure):
+    if failure is not None:
+        for i in pending:
+            _step_update(task_id, i, status='skipped')
+        _finish_task(task_id, 'error', state, failure)
+        return
+
+    # 保存最终状态
+    _finish_task(task_id, 'done', state)
+
+
+async def _run_task_async(task_id, pipeline, state, trace=None):
+    try:
+        with _trace_scope(_task_trace_started(task_id, trace)):
+            await _run_task_dag_async(task_id, pipeline, state)
+    except Exception as e:
+        _fail_task(task_id, e)
+
+
+async def _run_task_dag_async(task_id, pipeline, state):
+    """_run_task_dag 的事件循环版本（OPENAI_ASYNC=1）：调度不占线程，许多任务共用一个事件循环"""
+    _task_update(task_id, status='running', started_at=time.time())
+    _emit(task_id, "task_started")
+    deps = _build_dag(pipeline)
+    pending = set(range(len(pipeline)))
+    done = set()
+    running = {}
+    snapshots = {}
+    failure = None
+
+    while (pending and failure is None) or running:
+        if failure is None:
+            for i in sorted(i for i in pending if deps[i] <= done):
+                pending.discard(i)
+                snapshots[i] = dict(state)
+                running[asyncio.ensure_future(_arun_step(task_id, i, pipeline[i], snapshots[i]))] = i
+        if not running:
+            failure = failure or "pipeline stalled: unresolved dependencies"
+            break
+        completed, _ = await asyncio.wait(list(running), return_when=asyncio.FIRST_COMPLETED)
+        finished = []
+        for fut in completed:
+            i = running.pop(fut)
+            exc = fut.exception()
+            finished.append((i, (None, exc) if exc else (fut.result(), None)))
+        for i, (new_state, exc) in sorted(finished, key=lambda x: x[0]):
+            error = _settle_step(task_id, pipeline, i, new_state, exc, state, snapshots, done)
+            failure = failure or error
+
+    _finish_dag(task_id, state, pending, failure)
+
+
+def _finish_task(task_id, status, state, error=None):
+    finished_at = time.time()
+    _task_update(task_id, status=status, error=error, final_state=state, finished_at=finished_at)
+    t = _task_snapshot(task_id)
+    if TRACING and t is not None and t.get('trace_id'):
+        # 任务根 span：从 /task 受理到结束
+        _end_span({"trace_id": t['trace_id'], "span_id": t['root_span_id'], "parent_span_id": None,
+                   "name": "task", "node": SELF_ID, "start": t['created_at'], "end": None,
+                   "attrs": {"task_id": task_id, "steps": len(t['steps'])}, "status": "ok"}, error)
+        if TRACE_EXPORT_PATH:
+            _TRACE_EXPORTS.put((time.time() + TRACE_EXPORT_DELAY, task_id))
+    if error:
+        _emit(task_id, "task_finished", status=status, error=error, final_state=state)
+    else:
+        _emit(task_id, "task_finished", status=status, final_state=state)
+
+
+# ====== 点对点转发：把剩余的串行子流水线交给下一个节点，由最后一个节点把结果回传给发起节点 ======
+PIPELINE_FORWARDING = os.getenv("PIPELINE_FORWARDING", "0") == "1"
+# 发起节点等待转发链回传结果的最长时间
+FORWARD_TIMEOUT = float(os.getenv("FORWARD_TIMEOUT", "600"))
+# 集群内共享的节点 token：/forward 与 /task/<id>/complete 只接受带 X-Node-Token 的请求。
+# 未设置时不做逐跳转发（串行流水线照常按 DAG 执行），用户 token 永远不会发给其他节点
+NODE_TOKEN = os.getenv("NODE_TOKEN")
+if PIPELINE_FORWARDING and not NODE_TOKEN:
+    print("PIPELINE_FORWARDING=1 but NODE_TOKEN is not set; pipelines will not be forwarded")
+# 随请求体转发的上下文字段；另外带上 owner_id（用户 id，不是 token）供下游节点记录
+FORWARD_CTX_KEYS = ("task_id", "origin_id", "origin_url", "callback_token")
+
+
+def _is_chain(deps):
+    """每一步都依赖上一步：只有这种纯串行流水线适合逐跳转发"""
+    return all(i - 1 in deps[i] for i in range(1, len(deps)))
+
+
+def _advance_chain(ctx, pipeline, offset, state, records, on_step_done=None):
+    """从 offset 开始执行本节点负责的连续步骤，遇到别的节点的步骤就把剩余部分整体转发过去；
+    执行到末尾（或出错）时把最终 state 回传给发起节点"""
+    i = offset
+    try:
+        while i < len(pipeline):
+            step = pipeline[i]
+            node = _pick_target_node(step)
+            # 下一跳连不上时换一个副本（可能换回本节点）
+            tried = set()
+            last_error = None
+            while node is not None and node["id"] != SELF_ID:
+                try:
+                    _forward_to(node, ctx, pipeline, i, state, records)
+                    return
+                except NodeUnavailable as e:
+                    last_error = e
+                    tried.add(node["id"])
+                    node = find_node_for_op(step["op"], exclude=tried)
+            if node is None:
+                raise last_error or StepError(f"no node can handle op={step['op']}")
+            started = time.time()
+            try:
+                with _span("step", step=_step_id(step, i), op=step["op"]):
+                    state = _run_skill(step["op"], step.get("params", {}), dict(state))
+            except NodeOverloaded:
+                # 本节点过载：把剩余部分转给另一个副本
+                other = find_node_for_op(step["op"], exclude={SELF_ID})
+                if other is None:
+                    raise
+                _forward_to(other, ctx, pipeline, i, state, records)
+                return
+            record = {'index': i, 'node': SELF_ID, 'started_at': started, 'finished_at': time.time()}
+            records.append(record)
+            if on_step_done:
+                on_step_done(record)
+            i += 1
+    except Exception as e:
+        _complete_forwarded(ctx, {
+            'status': 'error', 'final_state': state, 'steps': records, 'failed_index': i,
+            'error': f"step {_step_id(pipeline[i], i)} ({pipeline[i]['op']}) failed: {e}",
+        })
+        return
+    _complete_forwarded(ctx, {'status': 'done', 'final_state': state, 'steps': records})
+
+
+def _node_headers():
+    return {'X-Node-Token': NODE_TOKEN}
+
+
+def _forward_to(node, ctx, pipeline, offset, state, records):
+    with _span("forward", peer=node["id"], offset=offset):
+        body = {k: ctx[k] for k in FORWARD_CTX_KEYS}
+        body.update(owner_id=ctx.get('owner_id'), pipeline=pipeline, offset=offset, state=state, steps=records,
+                    traceparent=_traceparent())
+        resp = _post_to_peer(node, "/forward", json=body, headers=_node_headers())
+    if resp.status_code != 202:
+        raise StepError(f"forward to {node['id']} failed: {resp.text}")
+
+
+def _complete_forwarded(ctx, result):
+    if ctx["origin_id"] == SELF_ID:
+        _apply_forward_result(ctx["task_id"], result)
+        return
+    body = dict(result, callback_token=ctx["callback_token"])
+    last_error = None
+    for attempt in range(3):
+        try:
+            resp = PEER_POOL.post(ctx["origin_url"], f"/task/{ctx['task_id']}/complete", json=body,
+                                  headers=_node_headers())
+            if resp.status_code == 200:
+                return
+            last_error = resp.text
+        except Exception as e:
+            last_error = str(e)
+        time.sleep(0.5 * (attempt + 1))
+    print(f"failed to deliver forwarded result of task {ctx['task_id']} (owner {ctx.get('owner_id')}) "
+          f"to {ctx['origin_url']}: {last_error}")
+
+
+def _apply_forward_result(task_id, result):
+    """发起节点收到转发链的最终结果：补齐每一步的记录并结束任务"""
+    t = _task_snapshot(task_id)
+    if t is None or t['status'] in ('done', 'error'):
+        return
+    pipeline = t['pipeline']
+    for rec in result.get('steps', []):
+        i = rec['index']
+        if t['steps'][i]['status'] == 'done':
+            continue
+        _step_update(task_id, i, status='done', node=rec['node'],
+                     started_at=rec['started_at'], finished_at=rec['finished_at'])
+        _emit(task_id, "step_finished", step=_step_id(pipeline[i], i), op=pipeline[i]["op"],
+              node=rec['node'], status='done')
+    if result.get('status') == 'done':
+        _finish_task(task_id, 'done', result.get('final_state'))
+        return
+    failed = result.get('failed_index')
+    if failed is not None:
+        _step_update(task_id, failed, status='error', error=result.get('error'), finished_at=time.time())
+        for i in range(failed + 1, len(pipeline)):
+            _step_update(task_id, i, status='skipped')
+    _finish_task(task_id, 'error', result.get('final_state'), result.get('error'))
+
+
+def _run_forwarded_task(task_id, pipeline, state, callback_token, trace=None):
+    try:
+        with _trace_scope(_task_trace_started(task_id, trace)):
+            _run_forwarded_chain(task_id, pipeline, state, callback_token)
+    except Exception as e:
+        _fail_task(task_id, e)
+
+
+def _run_forwarded_chain(task_id, pipeline, state, callback_token):
+    _task_update(task_id, status='running', started_at=time.time(),
+                 forward_deadline=time.time() + FORWARD_TIMEOUT)
+    _FORWARD_DEADLINES.put((time.time() + FORWARD_TIMEOUT, task_id))
+    _emit(task_id, "task_started", mode='forward')
+    t = _task_snapshot(task_id)
+    ctx = {'task_id': task_id, 'origin_id': SELF_ID, 'origin_url': SELF_URL, 'callback_token': callback_token,
+           'owner_id': USERS.get(t['owner']) if t else None}
+    records = []
+
+    def on_step_done(rec):
+        i = rec['index']
+        _step_update(task_id, i, status='done', node=SELF_ID,
+                     started_at=rec['started_at'], finished_at=rec['finished_at'])
+        _emit(task_id, "step_finished", step=_step_id(pipeline[i], i), op=pipeline[i]["op"],
+              node=SELF_ID, status='done')
+
+    _advance_chain(ctx, pipeline, 0, state, records, on_step_done)
+    # 剩余步骤已经交给下游节点
+    t = _task_snapshot(task_id)
+    if t and t['status'] == 'running':
+        for i, st in enumerate(t['steps']):
+            if st['status'] == 'pending':
+                _step_update(task_id, i, status='forwarded')
+
+
+def _check_forward_deadline(task_id):
+    t = _task_snapshot(task_id)
+    if t and t['status'] == 'running' and t.get('forward_deadline') and time.time() > t['forward_deadline']:
+        _finish_task(task_id, 'error', None, 'forwarded pipeline timed out')
+
+
+# 转发任务的截止时间队列：超时都是 FORWARD_TIMEOUT，先入队的先到期，按 FIFO 处理即可
+_FORWARD_DEADLINES = queue.Queue()
+
+
+def _sweep_forward_deadlines():
+    """下游节点掉线、回调丢失时，没人轮询 /result 的转发任务也要按时失败"""
+    while True:
+        due, task_id = _FORWARD_DEADLINES.get()
+        time.sleep(max(0.0, due - time.time()) + 0.1)
+        try:
+            _check_forward_deadline(task_id)
+        except Exception as e:
+            print("forward deadline sweep failed:", e)
+
+
+threading.Thread(target=_sweep_forward_deadlines, name="forward-deadlines", daemon=True).start()
+
+
+def _require_node(req):
+    """节点间接口的鉴权：只认集群共享的 NODE_TOKEN，不接受用户 token"""
+    if not NODE_TOKEN:
+        return ('node-to-node calls are disabled (NODE_TOKEN not set)', 403)
+    node_token = req.headers.get('X-Node-Token')
+    if not node_token:
+        return ('missing X-Node-Token header', 401)
+    if not hmac.compare_digest(node_token, NODE_TOKEN):
+        return ('invalid node token', 403)
+    return None
+
+
+def _known_origin(origin_id, origin_url):
+    """只把结果回传给注册表里的节点，不能让调用方指定任意 URL"""
+    node = {"url": SELF_URL} if origin_id == SELF_ID else REGISTRY.view.by_id.get(origin_id)
+    return node is not None and node.get("url", "").rstrip("/") == origin_url.rstrip("/")
+
+
+@app.route("/forward", methods=["POST"])
+def forward_pipeline():
+    """接收上一跳转发过来的剩余子流水线：先返回 202，再在后台执行本节点的连续步骤并继续转发"""
+    err = _require_node(request)
+    if err:
+        return jsonify({'error': err[0]}), err[1]
+    data = request.json or {}
+    pipeline = data.get("pipeline")
+    offset = data.get("offset")
+    if not isinstance(pipeline, list) or not isinstance(offset, int) or not 0 <= offset < len(pipeline):
+        return jsonify({"error": "invalid forwarded pipeline"}), 400
+    ctx = {k: data.get(k) for k in FORWARD_CTX_KEYS}
+    if not all(isinstance(v, str) and v for v in ctx.values()):
+        return jsonify({"error": "missing forwarding context"}), 400
+    if not _known_origin(ctx["origin_id"], ctx["origin_url"]):
+        return jsonify({"error": "unknown origin node"}), 403
+    owner_id = data.get("owner_id")
+    ctx["owner_id"] = owner_id if isinstance(owner_id, str) else None
+    records = list(data.get("steps") or [])
+    state = data.get("state") or {}
+
+    TASK_EXECUTOR.submit(_in_scope, _parse_traceparent(data.get("traceparent")),
+                         _advance_chain, ctx, pipeline, offset, state, records)
+    return jsonify({"accepted": True}), 202
+
+
+@app.route("/task/<task_id>/complete", methods=["POST"])
+def complete_forwarded_task(task_id):
+    err = _require_node(request)
+    if err:
+        return jsonify({'error': err[0]}), err[1]
+    data = request.json or {}
+    t = TASK_STORE.get(task_id)
+    expected = t.get('callback_token') if t else None
+    if not expected:
+        return jsonify({'error': 'task not found'}), 404
+    if not hmac.compare_digest(str(data.get('callback_token', '')), expected):
+        return jsonify({'error': 'forbidden'}), 403
+    _apply_forward_result(task_id, data)
+    return jsonify({'ok': True})
+
 
 # ====== 接收完整任务（可以发给任意节点） ======
 @app.route("/task", methods=["POST"])
@@ -120,55 +3300,208 @@ def handle_task():
     pipeline = data.get("pipeline")
     if not isinstance(pipeline, list):
         return jsonify({'error': 'pipeline missing or not a list'}), 400
+    for i, step in enumerate(pipeline):
+        if not isinstance(step, dict):
+            return jsonify({'error': f'pipeline[{i}] is not an object'}), 400
+        if not isinstance(step.get("op"), str):
+            return jsonify({'error': f'pipeline[{i}].op missing or not a string'}), 400
+        if not isinstance(step.get("params", {}), dict):
+            return jsonify({'error': f'pipeline[{i}].params must be an object'}), 400
     state = data.get("state", {})
+    if not isinstance(state, dict):
+        return jsonify({'error': 'state must be an object'}), 400
+    try:
+        deps = _build_dag(pipeline)
+    except ValueError as e:
+        return jsonify({'error': f'invalid pipeline: {e}'}), 400
+    # 串行流水线可以选择逐跳转发（body 里 "forward": true 或 PIPELINE_FORWARDING=1）；需要配置 NODE_TOKEN
+    forward = bool(data.get("forward", PIPELINE_FORWARDING)) and _is_chain(deps) and bool(NODE_TOKEN)
+
+    # 队列已满：快速拒绝，而不是让客户端一直挂着
+    if not _TASK_SLOTS.acquire(blocking=False):
+        return jsonify({'error': 'task queue full'}), 503, {'Retry-After': '1'}
 
     task_id = str(uuid.uuid4())
-    TASK_STORE[task_id] = {'owner': token, 'pipeline': pipeline, 'final_state': None, 'status': 'running'}
-
-    for step in pipeline:
-        op = step["op"]
-        params = step.get("params", {})
-
-        # 如果调用方/AI 指定了 target_node 且该节点存在且声明了此技能，则优先使用
-        specified = step.get("target_node")
-        target_node = None
-        if specified:
-            for n in NODES:
-                if n['id'] == specified and op in n.get('skills', []):
-                    target_node = n
-                    break
+    steps = [{'id': _step_id(step, i), 'op': step['op'], 'status': 'pending', 'node': None}
+             for i, step in enumerate(pipeline)]
+    callback_token = secrets.token_urlsafe(16) if forward else None
+    # 新建 trace；任务根 span 的 id 提前生成，步骤 span 都挂在它下面
+    trace = (secrets.token_hex(16), secrets.token_hex(8)) if TRACING else None
+    try:
+        TASK_STORE.create(task_id, {
+            'owner': token, 'pipeline': pipeline, 'steps': steps,
+            'final_state': None, 'status': 'queued', 'error': None,
+            'created_at': time.time(),
+            'callback_token': callback_token,
+            'trace_id': trace[0] if trace else None,
+            'root_span_id': trace[1] if trace else None,
+        })
+    except TaskStoreFull as e:
+        _TASK_SLOTS.release()
+        return jsonify({'error': str(e)}), 503, {'Retry-After': '1'}
+    _open_events(task_id, stream=bool(data.get("stream")))
+    _emit(task_id, "task_queued", steps=[dict(st) for st in steps])
 
-        # 否则按照能力选择节点
-        if target_node is None:
-            target_node = find_node_for_op(op)
-        if target_node is None:
-            return jsonify({"error": f"no node can handle op={op}"}), 400
-
-        if target_node["id"] == SELF_ID:
-            # 本机有这个技能 → 本地执行
-            impl = SKILL_IMPL.get(op)
-            if impl is None:
-                return jsonify({"error": f"skill {op} not implemented on this node"}), 500
-            state = impl(state, params)
+    try:
+        if forward:
+            future = TASK_EXECUTOR.submit(_run_forwarded_task, task_id, pipeline, state, callback_token, trace)
+        elif ASYNC_RUNTIME is not None:
+            future = ASYNC_RUNTIME.submit(_run_task_async(task_id, pipeline, state, trace))
         else:
-            # 交给别的节点执行这一步
-            url = target_node["url"] + "/execute_step"
-            payload = {
-                "op": op,
-                "params": params,
-                "state": state,
-            }
-            resp = requests.post(url, json=payload, timeout=60)
-            if resp.status_code != 200:
-                return jsonify({"error": f"remote node {target_node['id']} failed", "detail": resp.text}), 500
-            state = resp.json()["state"]
+            future = TASK_EXECUTOR.submit(_run_task, task_id, pipeline, state, trace)
+    except Exception:
+        _TASK_SLOTS.release()
+        raise
+    future.add_done_callback(lambda _f: _TASK_SLOTS.release())
+
+    # 立即返回 task_id，结果通过 /result/<task_id> 轮询
+    return jsonify({"task_id": task_id, "status": "queued", "mode": "forward" if forward else "dag"}), 202
+
+# ====== 任务进度 / token 的 SSE 推送 ======
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+# 多 worker 时轮询任务表的间隔（秒）
+SSE_POLL_INTERVAL = float(os.getenv("SSE_POLL_INTERVAL", "0.25"))
+
+
+def _finished_event(task_id, t):
+    return {'task_id': task_id, 'status': t['status'], 'error': t.get('error'),
+            'final_state': t.get('final_state')}
+
+
+def _poll_task_events(task_id):
+    """轮询共享任务表，把步骤状态变化转成 step_finished / task_finished（没有逐 token 的事件）"""
+    reported = {}
+    last_sent = time.time()
+    while True:
+        t = _task_snapshot(task_id)
+        if t is None:
+            return
+        for i, st in enumerate(t['steps']):
+            if st['status'] in TERMINAL_STATUSES and reported.get(i) != st['status']:
+                reported[i] = st['status']
+                last_sent = time.time()
+                yield _sse("step_finished", {'task_id': task_id, 'step': st['id'], 'op': st['op'],
+                                             'node': st.get('node'), 'status': st['status'],
+                                             'error': st.get('error')})
+        if t['status'] in TERMINAL_STATUSES:
+            yield _sse("task_finished", _finished_event(task_id, t))
+            return
+        _check_forward_deadline(task_id)
+        if time.time() - last_sent > 15:
+            last_sent = time.time()
+            yield ": keep-alive\n\n"
+        time.sleep(SSE_POLL_INTERVAL)
+
+
+@app.route("/task/<task_id>/stream", methods=["GET"])
+def stream_task(task_id):
+    # EventSource 不能设置请求头，所以也接受 ?token=
+    token, err = _require_token(request)
+    if err:
+        return jsonify({'error': err[0]}), err[1]
+    t = _task_snapshot(task_id)
+    if not t:
+        return jsonify({'error': 'task not found'}), 404
+    if t['owner'] != token:
+        return jsonify({'error': 'forbidden'}), 403
+
+    def generate():
+        with _EVENTS_COND:
+            log = TASK_EVENTS.get(task_id)
+        if log is None and SHARED_STATE and t['status'] not in TERMINAL_STATUSES:
+            # 任务由别的 worker 执行，本进程没有它的事件日志
+            yield from _poll_task_events(task_id)
+            return
+        if log is None:
+            # 事件日志已过期：只能给出最终结果
+            snap = _task_snapshot(task_id) or t
+            yield _sse("task_finished", {'status': snap['status'], 'error': snap.get('error'),
+                                         'final_state': snap.get('final_state')})
+            return
+        with _EVENTS_COND:
+            log["subscribers"] += 1
+        try:
+            yield from _replay_events(task_id, log)
+        finally:
+            with _EVENTS_COND:
+                log["subscribers"] -= 1
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def _replay_events(task_id, log):
+    """先重放已有事件，再跟随新事件直到 task_finished"""
+    sent = 0
+    while True:
+        with _EVENTS_COND:
+            if sent >= len(log["events"]) and not log["closed"]:
+                _EVENTS_COND.wait(timeout=SSE_POLL_INTERVAL if SHARED_STATE else 15)
+            batch = log["events"][sent:]
+            closed = log["closed"]
+        if not batch:
+            if closed:
+                return
+            _check_forward_deadline(task_id)
+            if SHARED_STATE:
+                # 转发结果的回调可能落到了别的 worker，本进程收不到 task_finished：以任务表为准收尾
+                snap = _task_snapshot(task_id)
+                if snap and snap['status'] in TERMINAL_STATUSES:
+                    yield _sse("task_finished", _finished_event(task_id, snap))
+                    return
+            yield ": keep-alive\n\n"
+            continue
+        for event, data in batch:
+            yield _sse(event, dict(data, task_id=task_id))
+        sent += len(batch)
+        if closed and sent >= len(log["events"]):
+            return
 
-    # 保存并返回 task_id 与最终状态
-    TASK_STORE[task_id]['final_state'] = state
-    TASK_STORE[task_id]['status'] = 'done'
-    return jsonify({"task_id": task_id, "final_state": state})
 
 # ====== 只执行单个 step 的接口（给别的节点调用） ======
+def _state_delta(before, after):
+    return {k: v for k, v in after.items() if k not in before or before[k] != v}
+
+
+def _skill_result(op, params, state, delta=False):
+    """执行技能；delta=True 时只返回技能写入/修改的 key"""
+    before = dict(state) if delta else None
+    new_state = _run_skill(op, params, state)
+    if delta:
+        return {"delta": _state_delta(before, new_state)}
+    return {"state": new_state}
+
+
+def _stream_step(op, params, state, delta=False, trace=None):
+    """在 BATCH_EXECUTOR 里执行技能，把 token 与最终 state（或增量）以 NDJSON 逐行写回调用方。
+    不用 STEP_EXECUTOR：发起节点的步骤线程正等着这里的结果，两个节点互相调用时会彼此耗尽"""
+    q = queue.Queue()
+
+    def worker():
+        token = _STEP_ON_TOKEN.set(lambda text: q.put({"type": "token", "text": text}))
+        try:
+            with _trace_scope(trace), _span("execute_step", op=op, stream=True):
+                result = _skill_result(op, params, state, delta)
+            kind = "delta" if delta else "state"
+            q.put({"type": kind, kind: result[kind]})
+        except NodeOverloaded as e:
+            q.put({"type": "error", "error": str(e), "status": 429, "retry_after": e.retry_after})
+        except Exception as e:
+            q.put({"type": "error", "error": str(e)})
+        finally:
+            _STEP_ON_TOKEN.reset(token)
+
+    BATCH_EXECUTOR.submit(worker)
+    while True:
+        msg = q.get()
+        yield json.dumps(msg, ensure_ascii=False) + "\n"
+        if msg["type"] != "token":
+            return
+
+
 @app.route("/execute_step", methods=["POST"])
 def execute_step():
     data = request.json
@@ -179,12 +3512,84 @@ def execute_step():
     if op not in SELF_SKILL_SET:
         return jsonify({"error": f"this node cannot handle {op}"}), 400
 
-    impl = SKILL_IMPL.get(op)
-    if impl is None:
+    if SKILL_IMPL.get(op) is None:
         return jsonify({"error": f"skill {op} not implemented in code"}), 500
 
-    state = impl(state, params)
-    return jsonify({"state": state})
+    delta = bool(data.get("delta"))
+    if STEP_ADMISSION.shed():
+        # 队列已满：快速拒绝，调用方换副本，而不是等到超时
+        return _overloaded_response(f"node {SELF_ID} is overloaded", STEP_ADMISSION.retry_after)
+    trace = _parse_traceparent(request.headers.get("traceparent"))
+    if data.get("stream"):
+        return Response(_stream_step(op, params, state, delta, trace), mimetype="application/x-ndjson")
+
+    try:
+        with _trace_scope(trace), _span("execute_step", op=op):
+            return jsonify(_skill_result(op, params, state, delta))
+    except NodeOverloaded as e:
+        return _overloaded_response(str(e), e.retry_after)
+
+
+def _overloaded_response(message, retry_after):
+    return jsonify({"error": message}), 429, {"Retry-After": str(max(1, int(round(retry_after))))}
+
+# ====== 批量执行多个 step（给别的节点调用，一次 HTTP 请求携带 N 个条目） ======
+def _execute_item(item):
+    if not isinstance(item, dict):
+        return {"error": "item must be an object", "status": 400}
+    op = item.get("op")
+    params = item.get("params") or {}
+    state = item.get("state") or {}
+    if op not in SELF_SKILL_SET:
+        return {"error": f"this node cannot handle {op}", "status": 400}
+    if SKILL_IMPL.get(op) is None:
+        return {"error": f"skill {op} not implemented in code", "status": 500}
+    try:
+        with _trace_scope(_parse_traceparent(item.get("traceparent"))), _span("execute_step", op=op, batched=True):
+            return _skill_result(op, params, state, bool(item.get("delta")))
+    except NodeOverloaded as e:
+        return {"error": str(e), "status": 429, "retry_after": e.retry_after}
+    except Exception as e:
+        return {"error": str(e), "status": 500}
+
+
+@app.route("/execute_steps", methods=["POST"])
+def execute_steps():
+    data = request.json or {}
+    items = data.get("items")
+    if not isinstance(items, list):
+        return jsonify({"error": "items missing or not a list"}), 400
+    # 各条目并发执行，兼容的 translate_zh 会在技能层的微批窗口里合并成一次模型调用
+    results = list(BATCH_EXECUTOR.map(_execute_item, items))
+    return jsonify({"results": results})
+
+# ====== Prometheus 抓取接口 ======
+METRICS.gauge("echonet_current_load", "Skill steps executing on this node.", lambda: [((), _current_load())])
+METRICS.gauge("echonet_task_queue_depth", "Tasks waiting for a task worker.",
+              lambda: [((), TASK_EXECUTOR._work_queue.qsize())])
+METRICS.gauge("echonet_step_admission", "Admission limiter slots in use, by state.", lambda: [
+    ((("state", "active"),), STEP_ADMISSION.stats()["active"]),
+    ((("state", "waiting"),), STEP_ADMISSION.stats()["waiting"]),
+])
+if ASYNC_RUNTIME is not None:
+    METRICS.gauge("echonet_openai_calls", "Upstream OpenAI calls on the async path, by state.", lambda: [
+        ((("state", "in_flight"),), ASYNC_RUNTIME.stats()["in_flight"]),
+        ((("state", "waiting"),), ASYNC_RUNTIME.stats()["waiting"]),
+    ])
+METRICS.gauge("echonet_peer_inflight", "Steps dispatched to a peer and not yet returned.",
+              lambda: [((("peer", k),), v) for k, v in list(PEER_INFLIGHT.items())])
+METRICS.gauge("echonet_peer_breaker_open", "1 when the peer's circuit breaker is not closed.",
+              lambda: [((("peer", k),), int(b.stats()["state"] != "closed")) for k, b in list(PEER_BREAKERS.items())])
+METRICS.gauge("echonet_llm_cache_hit_rate", "LLM response cache hit rate.",
+              lambda: [((), LLM_CACHE.stats()["hit_rate"])])
+METRICS.gauge("echonet_single_flight_coalesced_total", "Skill calls that joined an identical in-flight call.",
+              lambda: [((), _SKILL_FLIGHT.stats()["coalesced"])], kind="counter")
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
 
 # ====== 查看节点信息 ======
 @app.route("/info", methods=["GET"])
@@ -193,6 +3598,25 @@ def info():
         "id": SELF_ID,
         "url": SELF_URL,
         "skills": list(SELF_SKILL_SET),
+        "metrics": get_node_metrics(),
+        "registry": dict(REGISTRY.stats(), discovery=_DISCOVERY_STATE["enabled"],
+                         advertising=_DISCOVERY_STATE["advertising"],
+                         advertiser=_DISCOVERY_STATE["advertiser"].stats if _DISCOVERY_STATE["advertiser"] else None),
+        "peer_pool": PEER_POOL.stats(),
+        "llm_cache": LLM_CACHE.stats(),
+        "plan_cache": PLAN_CACHE.stats(),
+        "task_store": TASK_STORE.stats(),
+        "server": {"workers": WEB_WORKERS, "pid": os.getpid(), "shared_state": SHARED_STATE},
+        "single_flight": _SKILL_FLIGHT.stats(),
+        "admission": STEP_ADMISSION.stats(),
+        "openai_async": ASYNC_RUNTIME.stats() if ASYNC_RUNTIME is not None else {"enabled": False},
+        "openai_rate_limit": OPENAI_LIMITER.stats(),
+        "hedging": dict(HEDGE_STATS, enabled=STEP_HEDGING, latency=STEP_LATENCY.stats()),
+        "breakers": {node_id: b.stats() for node_id, b in list(PEER_BREAKERS.items())},
+        "batching": {
+            "peer": _PEER_BATCHER.stats(),
+            "translate_zh": _TRANSLATE_BATCHER.stats(),
+        },
     })
 
 
@@ -202,21 +3626,114 @@ def get_result(task_id):
     token, err = _require_token(request)
     if err:
         return jsonify({'error': err[0]}), err[1]
-    t = TASK_STORE.get(task_id)
+    _check_forward_deadline(task_id)
+    t = _task_snapshot(task_id)
+    if not t:
+        return jsonify({'error': 'task not found'}), 404
+    if t['owner'] != token:
+        return jsonify({'error': 'forbidden'}), 403
+    return jsonify({
+        'task_id': task_id,
+        'status': t['status'],
+        'steps': t['steps'],
+        'error': t.get('error'),
+        'final_state': t.get('final_state'),
+    })
+
+
+# ====== 任务 trace：本节点的 span + 向其他节点拉取同一 trace 的 span ======
+def _fetch_peer_spans(node, trace_id):
+    try:
+        resp = PEER_POOL.get(node["url"], f"/trace/spans/{trace_id}", timeout=(PEER_CONNECT_TIMEOUT, 2))
+        if resp.status_code == 200:
+            return resp.json().get("spans", [])
+    except Exception:
+        pass
+    return []
+
+
+def _collect_trace(trace_id):
+    spans = TRACE_STORE.get(trace_id)
+    peers = [n for n in REGISTRY.view.peers if _node_available(n)]
+    for peer_spans in BATCH_EXECUTOR.map(lambda n: _fetch_peer_spans(n, trace_id), peers):
+        spans.extend(peer_spans)
+    spans.sort(key=lambda sp: sp["start"])
+    return spans
+
+
+@app.route('/trace/spans/<trace_id>', methods=['GET'])
+def trace_spans(trace_id):
+    # 节点之间调用：只返回本节点记录的 span
+    return jsonify({'node': SELF_ID, 'spans': TRACE_STORE.get(trace_id)})
+
+
+@app.route('/trace/<task_id>', methods=['GET'])
+def get_trace(task_id):
+    """任务的时间线；?format=otlp 返回 OpenTelemetry (OTLP JSON) 格式"""
+    token, err = _require_token(request)
+    if err:
+        return jsonify({'error': err[0]}), err[1]
+    t = _task_snapshot(task_id)
     if not t:
         return jsonify({'error': 'task not found'}), 404
     if t['owner'] != token:
         return jsonify({'error': 'forbidden'}), 403
-    return jsonify({'task_id': task_id, 'status': t['status'], 'final_state': t.get('final_state')})
+    if not t.get('trace_id'):
+        return jsonify({'error': 'task was not traced'}), 404
+    spans = _collect_trace(t['trace_id'])
+    if request.args.get('format') == 'otlp':
+        return jsonify(_trace_otlp(spans))
+    origin = t['created_at']
+    timeline = [dict(sp, offset_ms=round((sp["start"] - origin) * 1000, 2),
+                     duration_ms=round(((sp["end"] or sp["start"]) - sp["start"]) * 1000, 2)) for sp in spans]
+    return jsonify({'task_id': task_id, 'trace_id': t['trace_id'], 'status': t['status'], 'spans': timeline})
+
+
+# 任务结束后延迟 TRACE_EXPORT_DELAY 秒导出完整 trace（等待下游节点的 span 记录完）
+_TRACE_EXPORTS = queue.Queue()
+_TRACE_EXPORT_LOCK = threading.Lock()
+
+
+def _trace_exporter():
+    while True:
+        due, task_id = _TRACE_EXPORTS.get()
+        time.sleep(max(0.0, due - time.time()))
+        try:
+            t = _task_snapshot(task_id)
+            if t is None or not t.get('trace_id'):
+                continue
+            line = json.dumps(_trace_otlp(_collect_trace(t['trace_id'])), ensure_ascii=False)
+            with _TRACE_EXPORT_LOCK, open(TRACE_EXPORT_PATH, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except Exception as e:
+            print("trace export failed:", e)
+
+
+if TRACE_EXPORT_PATH:
+    threading.Thread(target=_trace_exporter, name="trace-exporter", daemon=True).start()
+
+
+@app.route('/tasks', methods=['GET'])
+def list_tasks():
+    # 列出当前用户最近的任务（按 owner 索引）
+    token, err = _require_token(request)
+    if err:
+        return jsonify({'error': err[0]}), err[1]
+    # type=int 解析失败时返回 None（而不是抛异常），没传 limit 时用默认值
+    limit = request.args.get('limit', type=int)
+    if limit is None and 'limit' in request.args:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    limit = 50 if limit is None else max(1, min(limit, 500))
+    tasks = [{
+        'task_id': t['task_id'], 'status': t['status'], 'created_at': t['created_at'],
+        'finished_at': t.get('finished_at'), 'error': t.get('error'),
+    } for t in TASK_STORE.for_owner(token, limit)]
+    return jsonify({'tasks': tasks})
 
 
 def _all_allowed_ops():
-    """从 nodes.json 中收集所有声明的技能作为允许列表"""
-    ops = set()
-    for n in NODES:
-        for s in n.get("skills", []):
-            ops.add(s)
-    return ops
+    """注册表中所有节点声明的技能作为允许列表"""
+    return REGISTRY.view.ops
 
 
 def _extract_json_candidate(text: str):
@@ -244,8 +3761,10 @@ def _validate_tasks_structure(obj):
     if not isinstance(tasks, list):
         return False, 'tasks must be a list'
 
-    allowed_ops = _all_allowed_ops()
-    node_ids = {n['id'] for n in NODES}
+    view = REGISTRY.view
+    allowed_ops = view.ops
+    node_ids = view.by_id
+    task_ids = {str(t.get('id')) for t in tasks if isinstance(t, dict) and t.get('id') is not None}
 
     for i, t in enumerate(tasks):
         if not isinstance(t, dict):
@@ -261,24 +3780,116 @@ def _validate_tasks_structure(obj):
         target = t.get('target_node')
         if target is not None and target not in node_ids:
             return False, f'task[{i}].target_node "{target}" not a known node'
+        depends_on = t.get('depends_on')
+        if depends_on is not None:
+            if not isinstance(depends_on, list):
+                return False, f'task[{i}].depends_on must be a list'
+            for ref in depends_on:
+                if str(ref) not in task_ids:
+                    return False, f'task[{i}].depends_on references unknown task "{ref}"'
 
     return True, ''
 
 
-@app.route('/analyze', methods=['POST'])
-def analyze():
-    """接受 { command: '...' }，调用 OpenAI 返回拆分任务的 JSON，验证并返回 tasks 列表"""
-    data = request.json or {}
-    command = data.get('command')
-    if not command or not isinstance(command, str):
-        return jsonify({'error': 'missing command'}), 400
+# ====== /analyze 计划缓存：key = 归一化后的命令 + 集群拓扑指纹 ======
+PLAN_CACHE_SIZE = int(os.getenv("PLAN_CACHE_SIZE", "512"))
+# > 0 时启用近似匹配：词集合 Jaccard 相似度不低于该值的命令复用同一个计划（如 0.9）
+PLAN_CACHE_SIMILARITY = float(os.getenv("PLAN_CACHE_SIMILARITY", "0"))
+
+_CJK_OR_WORD = re.compile(r"[\u3400-\u9fff]|[^\W_]+")
+
+
+def _normalize_command(command):
+    text = unicodedata.normalize("NFKC", command).lower()
+    text = " ".join(text.split())
+    return text.strip(" .。!！?？")
 
+
+def _command_tokens(normalized):
+    # 英文按单词切分，中文按单字切分
+    return frozenset(_CJK_OR_WORD.findall(normalized))
+
+
+def _topology_fingerprint():
+    return REGISTRY.view.fingerprint
+
+
+class PlanCache:
+    """缓存模型拆分出的原始 tasks（后端填充 target_node 之前），拓扑指纹变化时整体失效"""
+
+    def __init__(self, size, similarity=0.0):
+        self.size = size
+        self.similarity = similarity
+        self._plans = OrderedDict()  # normalized command -> (tokens, tasks)
+        self._fingerprint = None
+        self._lock = threading.Lock()
+        self._stats = {'exact_hits': 0, 'similar_hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def _check_fingerprint(self, fingerprint):
+        if fingerprint != self._fingerprint:
+            if self._plans:
+                self._stats['invalidations'] += 1
+            self._plans.clear()
+            self._fingerprint = fingerprint
+
+    def get(self, command, fingerprint):
+        """返回 (tasks 副本, 'exact' | 'similar')，未命中返回 None"""
+        key = _normalize_command(command)
+        with self._lock:
+            self._check_fingerprint(fingerprint)
+            entry = self._plans.get(key)
+            if entry is not None:
+                self._plans.move_to_end(key)
+                self._stats['exact_hits'] += 1
+                return copy.deepcopy(entry[1]), 'exact'
+
+            if self.similarity > 0:
+                tokens = _command_tokens(key)
+                best, best_score = None, 0.0
+                for other_key, (other_tokens, _) in self._plans.items():
+                    union = len(tokens | other_tokens)
+                    score = len(tokens & other_tokens) / union if union else 0.0
+                    if score > best_score:
+                        best, best_score = other_key, score
+                if best is not None and best_score >= self.similarity:
+                    self._plans.move_to_end(best)
+                    self._stats['similar_hits'] += 1
+                    return copy.deepcopy(self._plans[best][1]), 'similar'
+
+            self._stats['misses'] += 1
+            return None
+
+    def put(self, command, fingerprint, tasks):
+        key = _normalize_command(command)
+        with self._lock:
+            self._check_fingerprint(fingerprint)
+            self._plans[key] = (_command_tokens(key), copy.deepcopy(tasks))
+            self._plans.move_to_end(key)
+            while len(self._plans) > self.size:
+                self._plans.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            out = dict(self._stats)
+            out['entries'] = len(self._plans)
+        return out
+
+
+PLAN_CACHE = PlanCache(PLAN_CACHE_SIZE, similarity=PLAN_CACHE_SIMILARITY)
+
+
+def _plan_with_model(command):
+    """调用模型拆分命令，返回 (tasks, None) 或 (None, (错误响应体, 状态码))"""
     # 生成 prompt：强制模型仅返回 JSON，并且为每个 task 指定 target_node（必须是下面给出的节点 id 之一）
-    allowed_ops = sorted(list(_all_allowed_ops()))
-    node_ids = [n['id'] for n in NODES]
+    view = REGISTRY.view
+    allowed_ops = sorted(view.ops)
+    node_ids = [n['id'] for n in view.nodes]
     prompt = (
         "You are an assistant that splits a user's high-level command into a sequence of small tasks.\n"
-        "Return only a JSON object with the shape: { \"tasks\": [ { \"id\": string, \"op\": string, \"params\": object, \"target_node\": string }, ... ] }\n"
+        "Return only a JSON object with the shape: { \"tasks\": [ { \"id\": string, \"op\": string, \"params\": object, \"target_node\": string, \"depends_on\": [string] }, ... ] }\n"
+        "Tasks run in parallel unless \"depends_on\" lists the ids of tasks whose output they need.\n"
+        "Tasks pass data through a shared state: use params \"output_var\" to name the state key a task writes "
+        "and \"text_var\" to name the key it reads, so that parallel branches do not overwrite each other.\n"
         "For each task, set \"target_node\" to one of the following node ids: " + ", ".join(node_ids) + ".\n"
         "Ensure that the chosen target_node actually supports the requested operation (i.e., its skills include the op).\n"
         "Use only these operations: " + ", ".join(allowed_ops) + ".\n"
@@ -287,14 +3898,20 @@ def analyze():
     )
 
     try:
-        resp = openai_client.chat.completions.create(
+        resp = _openai_create(
+            'analyze',
             model='gpt-4o-mini',
             messages=[{"role": "user", "content": prompt}],
             max_tokens=800,
             temperature=0.0,
         )
+    except UpstreamRateLimited as e:
+        return None, ({'error': 'openai rate limited', 'detail': str(e)}, 503,
+                      {'Retry-After': str(max(1, int(e.retry_after)))})
+    except RateLimitError as e:
+        return None, ({'error': 'openai rate limited', 'detail': str(e)}, 503, {'Retry-After': '1'})
     except Exception as e:
-        return jsonify({'error': 'openai error', 'detail': str(e)}), 500
+        return None, ({'error': 'openai error', 'detail': str(e)}, 500)
 
     # 尝试从模型输出中提取 JSON
     text = ''
@@ -306,14 +3923,38 @@ def analyze():
 
     parsed = _extract_json_candidate(text)
     if parsed is None:
-        return jsonify({'error': 'failed to parse JSON from model output', 'raw': text}), 502
+        return None, ({'error': 'failed to parse JSON from model output', 'raw': text}, 502)
 
-    # 如果模型没有指定 target_node 或指定了不存在的 node，后端尝试填充一个可用的节点
     tasks = parsed.get('tasks') if isinstance(parsed, dict) else None
     if not isinstance(tasks, list):
-        return jsonify({'error': 'parsed output missing tasks list', 'raw': parsed}), 502
+        return None, ({'error': 'parsed output missing tasks list', 'raw': parsed}, 502)
+    return tasks, None
+
+
+@app.route('/analyze', methods=['POST'])
+def analyze():
+    """接受 { command: '...' }，调用 OpenAI 返回拆分任务的 JSON，验证并返回 tasks 列表"""
+    data = request.json or {}
+    command = data.get('command')
+    if not command or not isinstance(command, str):
+        return jsonify({'error': 'missing command'}), 400
+
+    # temperature=0 的拆分结果对同一命令 + 同一拓扑是确定的，命中缓存时不再调用模型
+    fingerprint = _topology_fingerprint()
+    cached = PLAN_CACHE.get(command, fingerprint)
+    if cached is not None:
+        tasks, cache_match = cached
+    else:
+        tasks, err = _plan_with_model(command)
+        if err:
+            return (jsonify(err[0]),) + err[1:]
+        cache_match = None
+    model_tasks = copy.deepcopy(tasks)
+    parsed = {'tasks': model_tasks}
+
+    # 如果模型没有指定 target_node 或指定了不存在的 node，后端尝试填充一个可用的节点
 
-    node_ids = {n['id'] for n in NODES}
+    node_ids = REGISTRY.view.by_id
     for t in tasks:
         op = t.get('op')
         specified = t.get('target_node')
@@ -332,9 +3973,23 @@ def analyze():
     if not ok:
         return jsonify({'error': 'invalid tasks structure after fill', 'detail': reason, 'raw': tasks}), 400
 
+    if cache_match is None:
+        PLAN_CACHE.put(command, fingerprint, model_tasks)
+
     # 成功：返回解析并校验后的 tasks（包含 target_node）
-    return jsonify({'tasks': tasks, 'info': 'analyze successful'})
+    return jsonify({'tasks': tasks, 'info': 'analyze successful', 'plan_cache': cache_match or 'miss'})
+
 
 if __name__ == "__main__":
-    # 两台电脑都用 0.0.0.0:5000，靠 IP 区分
-    app.run(host="0.0.0.0", port=5000)
+    # 两台电脑都用 0.0.0.0:5000，靠 IP 区分；同一台机器跑多个节点时用 PORT 区分
+    # 装了 waitress 就用它（多线程）；多进程部署用 python serve.py net:app --workers N
+    port = int(os.getenv("PORT", "5000"))
+    _start_discovery()
+    try:
+        from waitress import serve
+    except ImportError:
+        serve = None
+    if serve is not None and os.getenv("WEB_SERVER", "waitress") != "dev":
+        serve(app, host="0.0.0.0", port=port, threads=int(os.getenv("WEB_THREADS", "16")))
+    else:
+        app.run(host="0.0.0.0", port=port, threaded=True)
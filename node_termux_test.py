@@ -1,8 +1,9 @@
 import time
-import json
 import socket
-import subprocess
-from zeroconf import Zeroconf, ServiceInfo, ServiceBrowser
+import threading
+from zeroconf import Zeroconf, ServiceBrowser
+
+from echonet_discovery import ADVERTISE_CHECK, SERVICE_TYPE, Advertiser, MetricsSampler, decode_txt, get_local_ip
 
 # ----------------------------
 # CHANGE THIS PER DEVICE
@@ -15,45 +16,7 @@ current_load = 0
 # ----------------------------
 
 
-def get_local_ip():
-    """Get LAN IP address."""
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    try:
-        s.connect(("8.8.8.8", 80))
-        ip = s.getsockname()[0]
-    except:
-        ip = "127.0.0.1"
-    finally:
-        s.close()
-    return ip
-
-
-# ----- FIX 1: SAFE BATTERY FOR TERMUX -----
-def get_battery():
-    """Get battery level using Termux API."""
-    try:
-        out = subprocess.check_output(["termux-battery-status"])
-        data = json.loads(out.decode())
-        return data.get("percentage")
-    except:
-        return None
-
-
-# ----- FIX 2: SAFE CPU FOR TERMUX -----
-def get_cpu():
-    """Termux cannot access psutil CPU. Use /proc/stat safely."""
-    try:
-        out = subprocess.check_output("top -bn1 | head -n 5", shell=True)
-        text = out.decode().lower()
-        # crude parse: look for '%cpu'
-        for line in text.splitlines():
-            if "%cpu" in line:
-                # try extracting the first number
-                num = "".join(ch for ch in line if ch.isdigit() or ch == '.')
-                return float(num) if num else 0.0
-        return 0.0
-    except:
-        return 0.0
+SAMPLER = MetricsSampler()
 
 
 def compute_health(cpu, battery, load):
@@ -72,8 +35,9 @@ def compute_health(cpu, battery, load):
 
 
 def get_node_metrics():
-    cpu = get_cpu()
-    battery = get_battery()
+    # cached by SAMPLER; no subprocess on this path
+    cpu = round(SAMPLER.cpu or 0.0, 1)
+    battery = SAMPLER.battery
     health = compute_health(cpu, battery, current_load)
 
     return {
@@ -91,22 +55,25 @@ class DiscoveryListener:
         if not info:
             return
 
-        node_id = info.properties[b"id"].decode()
-
-        if node_id == NODE_ID:
+        try:
+            node = decode_txt(info.properties)
+        except ValueError as e:
+            print(f"⚠️  ignoring {name}: {e}")
             return
 
-        skills = json.loads(info.properties[b"skills"].decode())
-        metrics = json.loads(info.properties[b"metrics"].decode())
+        if node["id"] == NODE_ID:
+            return
 
         node_ip = socket.inet_ntoa(info.addresses[0])
+        metrics = node["metrics"]
 
-        print(f"\n✨ FOUND NODE → {node_id} @ {node_ip}:{info.port}")
-        print(f"   skills:  {skills}")
-        print(f"   cpu:     {metrics['cpu']}")
-        print(f"   battery: {metrics['battery']}")
-        print(f"   load:    {metrics['load']}/{metrics['max_load']}")
-        print(f"   health:  {metrics['health']:.2f}")
+        print(f"\n✨ FOUND NODE → {node['id']} @ {node_ip}:{info.port}")
+        print(f"   skills:  {node['skills']}")
+        if metrics:
+            print(f"   cpu:     {metrics.get('cpu')}")
+            print(f"   battery: {metrics.get('battery')}")
+            print(f"   load:    {metrics.get('load')}/{metrics.get('max_load')}")
+            print(f"   health:  {metrics.get('health', 0):.2f}")
 
     def update_service(self, *a):
         pass
@@ -116,38 +83,18 @@ class DiscoveryListener:
 
 
 def advertiser_thread():
-    """Advertise updated metrics every ~3 seconds."""
+    """Register once, then re-announce only on metric changes or the heartbeat."""
     zc = Zeroconf(ip_version=4)
-    ip = get_local_ip()
-
-    while True:
-        metrics = get_node_metrics()
-
-        props = {
-            "id": NODE_ID,
-            "skills": json.dumps(SKILLS),
-            "metrics": json.dumps(metrics),
-        }
-
-        info = ServiceInfo(
-            "_echotest._tcp.local.",
-            f"{NODE_ID}._echotest._tcp.local.",
-            addresses=[socket.inet_aton(ip)],
-            port=PORT,
-            properties=props,
-        )
-
-        zc.register_service(info)
-        time.sleep(3)
-        zc.unregister_service(info)
+    adv = Advertiser(zc, NODE_ID, get_local_ip(), PORT, SKILLS, get_node_metrics)
+    adv.run(ADVERTISE_CHECK, on_announce=lambda a: print(f"📡 announced → {a.stats}"))
 
 
 if __name__ == "__main__":
-    import threading
+    SAMPLER.start()
     threading.Thread(target=advertiser_thread, daemon=True).start()
 
     zc = Zeroconf(ip_version=4)
-    ServiceBrowser(zc, "_echotest._tcp.local.", DiscoveryListener())
+    ServiceBrowser(zc, SERVICE_TYPE, DiscoveryListener())
 
     print("\n🔥 Termux node running... discovering other devices...\n")
 
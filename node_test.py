@@ -1,9 +1,10 @@
 import time
-import json
 import socket
 import psutil
 import threading
-from zeroconf import Zeroconf, ServiceInfo, ServiceBrowser
+from zeroconf import Zeroconf, ServiceBrowser
+
+from echonet_discovery import ADVERTISE_CHECK, SERVICE_TYPE, Advertiser, decode_txt, get_local_ip
 
 # ----------------------------
 # CONFIG
@@ -17,18 +18,6 @@ current_load = 0
 # ----------------------------
 
 
-def get_local_ip():
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    try:
-        s.connect(("8.8.8.8", 80))
-        ip = s.getsockname()[0]
-    except:
-        ip = "127.0.0.1"
-    finally:
-        s.close()
-    return ip
-
-
 def get_battery():
     try:
         bat = psutil.sensors_battery()
@@ -73,53 +62,42 @@ class DiscoveryListener:
             return
 
         node_ip = socket.inet_ntoa(info.addresses[0])
-        node_id = info.properties[b"id"].decode()
+        try:
+            node = decode_txt(info.properties)
+        except ValueError as e:
+            print(f"⚠️  ignoring {name}: {e}")
+            return
 
-        if node_id == NODE_ID:
+        if node["id"] == NODE_ID:
             return
 
-        metrics = json.loads(info.properties[b"metrics"].decode())
-        skills = json.loads(info.properties[b"skills"].decode())
+        metrics = node["metrics"]
+        print(f"\n✨ FOUND NODE → {node['id']} @ {node_ip}:{info.port}")
+        print(f"   skills: {node['skills']}")
+        if metrics:
+            print(f"   cpu: {metrics.get('cpu')}%")
+            print(f"   battery: {metrics.get('battery')}")
+            print(f"   load: {metrics.get('load')} / {metrics.get('max_load')}")
+            print(f"   health: {metrics.get('health', 0):.2f}")
 
-        print(f"\n✨ FOUND NODE → {node_id} @ {node_ip}:{info.port}")
-        print(f"   skills: {skills}")
-        print(f"   cpu: {metrics['cpu']}%")
-        print(f"   battery: {metrics['battery']}")
-        print(f"   load: {metrics['load']} / {metrics['max_load']}")
-        print(f"   health: {metrics['health']:.2f}")
+    def update_service(self, zc, service_type, name):
+        # metric changes / heartbeats; nothing to print
+        pass
 
     def remove_service(self, zc, service_type, name):
         print(f"💦 Node disappeared: {name}")
 
 
 def advertiser():
-    """Correct Zeroconf advertisement loop (no unregister)."""
+    """Register once, then re-announce only on metric changes or the heartbeat."""
     zc = Zeroconf()
     ip = get_local_ip()
-
-    metrics = get_node_metrics()
-    props = {
-        "id": NODE_ID,
-        "skills": json.dumps(SKILLS),
-        "metrics": json.dumps(metrics),
-    }
-
-    info = ServiceInfo(
-        "_echotest._tcp.local.",
-        f"{NODE_ID}._echotest._tcp.local.",
-        addresses=[socket.inet_aton(ip)],
-        port=PORT,
-        properties=props,
-    )
-
-    zc.register_service(info)
+    adv = Advertiser(zc, NODE_ID, ip, PORT, SKILLS, get_node_metrics)
+    adv.tick()
     print(f"📡 Registered {NODE_ID} @ {ip}:{PORT}")
 
-    while True:
-        # Update metrics only — no unregister
-        info.properties[b"metrics"] = json.dumps(get_node_metrics()).encode()
-        zc.update_service(info)
-        time.sleep(3)
+    time.sleep(ADVERTISE_CHECK)
+    adv.run(ADVERTISE_CHECK, on_announce=lambda a: print(f"📡 announced → {a.stats}"))
 
 
 if __name__ == "__main__":
@@ -127,4 +105,12 @@ if __name__ == "__main__":
     adv_thread.start()
 
     zc = Zeroconf()
-    ServiceBrowser(zc, "_echotest._tcp.lo
+    ServiceBrowser(zc, SERVICE_TYPE, DiscoveryListener())
+
+    print("\n🔥 Node running... discovering other devices...\n")
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("🛑 Bye")
@@ -0,0 +1,94 @@
+"""
+生产环境入口：用多进程 / 多线程的 WSGI 服务器代替 Flask 自带的开发服务器（单进程，吞吐上限很低）。
+
+    python serve.py net:app --workers 4 --threads 16 --port 5000
+    cd instance2 && python ../serve.py echonet_node:app --port 5001   # 加载当前目录里的模块
+
+服务器（WEB_SERVER / --server）：
+- gunicorn：WEB_WORKERS 个进程，每个进程 WEB_THREADS 个线程（gthread worker），Linux / macOS / Termux
+- waitress：纯 Python，单进程多线程，Windows 也能用
+- auto（默认）：workers > 1 且装了 gunicorn 时用 gunicorn，否则用 waitress
+
+workers > 1 时 net.py 切换到进程间共享的状态：任务表固定用 SQLite 直写（TASK_STORE_PATH），
+负载计数放在 SHARED_STATE_PATH，用户表从 users.json 读取、文件变化时自动重新加载；
+/task/<id>/stream 落到没有执行该任务的 worker 时改为轮询任务表（只有步骤级事件，没有逐 token 事件）。
+缓存、熔断器、hedging 统计、trace 等仍然是每个 worker 各一份，准入上限默认按 worker 数平分 MAX_LOAD。
+"""
+
+import argparse
+import importlib
+import importlib.util
+import os
+import sys
+
+
+def _load_app(spec):
+    module_name, _, attr = spec.partition(":")
+    module = importlib.import_module(module_name)
+    return getattr(module, attr or "app")
+
+
+def run_gunicorn(spec, args):
+    from gunicorn.app.base import BaseApplication
+
+    class Application(BaseApplication):
+        def load_config(self):
+            options = {
+                "bind": f"{args.host}:{args.port}",
+                "workers": args.workers,
+                "worker_class": "gthread",
+                "threads": args.threads,
+                # gthread 的 timeout 是 worker 心跳超时，不限制单个请求（SSE 长连接不受影响）
+                "timeout": args.timeout,
+                "graceful_timeout": args.timeout,
+                "keepalive": 5,
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            # 不 preload：每个 worker fork 之后各自导入应用，后台线程和数据库连接都属于该 worker
+            return _load_app(spec)
+
+    Application().run()
+
+
+def run_waitress(spec, args):
+    from waitress import serve
+
+    serve(_load_app(spec), host=args.host, port=args.port, threads=args.threads, channel_timeout=args.timeout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run an Echonet node with a production WSGI server")
+    parser.add_argument("app", nargs="?", default=os.getenv("WEB_APP", "net:app"), help="module:attr，默认 net:app")
+    parser.add_argument("--host", default=os.getenv("WEB_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "5000")))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_WORKERS", "1")))
+    parser.add_argument("--threads", type=int, default=int(os.getenv("WEB_THREADS", "16")))
+    parser.add_argument("--server", choices=["auto", "gunicorn", "waitress"], default=os.getenv("WEB_SERVER", "auto"))
+    parser.add_argument("--timeout", type=int, default=int(os.getenv("WEB_TIMEOUT", "120")))
+    args = parser.parse_args()
+
+    # 应用模块（net.py 会读 nodes.json / users.json 等相对路径）从当前目录导入
+    sys.path.insert(0, os.getcwd())
+    server = args.server
+    if server == "auto":
+        has_gunicorn = importlib.util.find_spec("gunicorn") is not None
+        server = "gunicorn" if args.workers > 1 and has_gunicorn else "waitress"
+    if importlib.util.find_spec(server) is None:
+        raise SystemExit(f"{server} is not installed; pip install {server}")
+    if server == "waitress" and args.workers > 1:
+        print("waitress runs a single process; ignoring --workers (install gunicorn for multiple workers)")
+        args.workers = 1
+    # worker 进程里的 net.py 靠 WEB_WORKERS 决定是否使用共享状态
+    os.environ["WEB_WORKERS"] = str(args.workers)
+
+    if server == "gunicorn":
+        run_gunicorn(args.app, args)
+    else:
+        run_waitress(args.app, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import importlib
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TOKEN = "testtoken123"
+
+
+def _import_node_module(name):
+    # 节点程序在 import 时读取当前目录的 nodes.json / users.json 并要求 OPENAI_API_KEY，
+    # 所以先切到一个临时目录，放一份只有本节点的 nodes.json（没有 users.json 时使用默认测试用户）
+    workdir = tempfile.mkdtemp(prefix="echonet-test-")
+    with open(os.path.join(workdir, "nodes.json"), "w", encoding="utf-8") as f:
+        json.dump({"self_id": "node1", "self_url": "http://127.0.0.1:5000",
+                   "nodes": [{"id": "node1", "url": "http://127.0.0.1:5000",
+                              "skills": ["generate_poem_en", "translate_zh"]}]}, f)
+    os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+    os.environ["DISCOVERY"] = "0"
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        return importlib.import_module(name)
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture(scope="session")
+def net():
+    return _import_node_module("net")
+
+
+@pytest.fixture(scope="session")
+def echonet_node():
+    return _import_node_module("echonet_node")
+
+
+@pytest.fixture
+def client(net):
+    net.app.config["TESTING"] = True
+    with net.app.test_client() as c:
+        yield c
+
+
+@pytest.fixture
+def auth():
+    return {"X-User-Token": TOKEN}
+
+
+@pytest.fixture
+def make_task(net):
+    """Returns make(pipeline): stores a queued task owned by the test user and returns its id."""
+    def make(pipeline):
+        task_id = "t-%s" % uuid.uuid4()
+        net.TASK_STORE.create(task_id, {
+            "owner": TOKEN, "pipeline": pipeline,
+            "steps": [{"id": net._step_id(step, i), "op": step["op"], "status": "pending", "node": None}
+                      for i, step in enumerate(pipeline)],
+            "final_state": None, "status": "queued", "error": None, "created_at": time.time(),
+        })
+        net._open_events(task_id)
+        return task_id
+    return make
+
+
+@pytest.fixture
+def fake_openai(net, monkeypatch):
+    """Replace net._openai_create; every call's kwargs are recorded in the returned list."""
+    from types import SimpleNamespace
+
+    calls = []
+
+    def create(kind, **kwargs):
+        calls.append(kwargs)
+        text = "reply %d" % len(calls)
+        if kwargs.get("stream"):
+            return iter([SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])])
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))])
+
+    monkeypatch.setattr(net, "_openai_create", create)
+    return calls
@@ -0,0 +1,61 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+
+def test_full_queue_rejects(net):
+    limiter = net.AdmissionLimiter(max_active=1, max_queue=0, queue_timeout=1, retry_after=2)
+    limiter.acquire()
+    assert limiter.shed()
+    with pytest.raises(net.NodeOverloaded) as exc:
+        limiter.acquire()
+    assert exc.value.retry_after == 2
+    limiter.release()
+    assert not limiter.shed()
+    assert limiter.stats()["rejected"] == 2
+
+
+def test_queued_caller_is_admitted_on_release(net):
+    limiter = net.AdmissionLimiter(max_active=1, max_queue=1, queue_timeout=2, retry_after=1)
+    limiter.acquire()
+    admitted = threading.Event()
+
+    def waiter():
+        limiter.acquire()
+        admitted.set()
+
+    t = threading.Thread(target=waiter)
+    t.start()
+    while limiter.stats()["waiting"] == 0:
+        admitted.wait(0.01)
+    assert not limiter.try_acquire()       # queued callers go first
+    limiter.release()
+    assert admitted.wait(2)
+    t.join()
+    assert limiter.stats()["active"] == 1 and limiter.stats()["queued"] == 1
+
+
+def test_queue_wait_times_out(net):
+    limiter = net.AdmissionLimiter(max_active=1, max_queue=1, queue_timeout=0.05, retry_after=1)
+    limiter.acquire()
+    with pytest.raises(net.NodeOverloaded):
+        limiter.acquire()
+    assert limiter.stats()["timed_out"] == 1 and limiter.stats()["waiting"] == 0
+
+
+def test_execute_step_sheds_with_429(client, net, monkeypatch):
+    limiter = net.AdmissionLimiter(max_active=0, max_queue=0, queue_timeout=1, retry_after=3)
+    monkeypatch.setattr(net, "STEP_ADMISSION", limiter)
+    resp = client.post("/execute_step", json={"op": "translate_zh", "state": {}})
+    assert resp.status_code == 429
+    assert resp.headers["Retry-After"] == "3"
+
+
+def test_remote_429_becomes_node_overloaded(net, monkeypatch):
+    resp = SimpleNamespace(status_code=429, headers={"Retry-After": "4"}, close=lambda: None)
+    monkeypatch.setattr(net, "_post_to_peer", lambda *a, **kw: resp)
+    peer = {"id": "peer", "url": "http://10.0.0.2:5000", "skills": ["translate_zh"]}
+    with pytest.raises(net.NodeOverloaded) as exc:
+        net._execute_on_node(peer, "translate_zh", {}, {"english_poem": "roses"})
+    assert exc.value.retry_after == 4
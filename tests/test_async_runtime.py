@@ -0,0 +1,95 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+
+@pytest.fixture
+def runtime(net, monkeypatch):
+    rt = net.AsyncRuntime(max_concurrency=2, pool_size=4, timeout=5)
+    monkeypatch.setattr(net, "ASYNC_RUNTIME", rt)
+    yield rt
+    rt.loop.call_soon_threadsafe(rt.loop.stop)
+
+
+@pytest.fixture
+def upstream(runtime):
+    """Replace the runtime's AsyncOpenAI client; every call's kwargs are recorded in the returned list."""
+    calls = []
+
+    async def create(**kwargs):
+        calls.append(kwargs)
+        await asyncio.sleep(0.01)
+        text = "reply %d" % len(calls)
+        if kwargs.get("stream"):
+            async def chunks():
+                for piece in (text[:3], text[3:]):
+                    yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))], usage=None)
+            return SimpleNamespace(headers={}, parse=chunks)
+        completion = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))], usage=None)
+        return SimpleNamespace(headers={}, parse=lambda: completion)
+
+    runtime.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(
+        with_raw_response=SimpleNamespace(create=create))))
+    return calls
+
+
+def test_concurrency_cap(runtime):
+    peak = [0]
+
+    async def call():
+        await runtime.acquire()
+        try:
+            peak[0] = max(peak[0], runtime.stats()["in_flight"])
+            await asyncio.sleep(0.02)
+        finally:
+            runtime.release()
+
+    async def many():
+        await asyncio.gather(*(call() for _ in range(6)))
+
+    runtime.run(many())
+    assert peak[0] == 2
+    assert runtime.stats() == {"calls": 6, "in_flight": 0, "waiting": 0, "max_concurrency": 2}
+
+
+def test_run_refuses_the_loop_thread(runtime):
+    async def nested():
+        coro = asyncio.sleep(0)
+        try:
+            runtime.run(coro)
+        finally:
+            coro.close()
+
+    with pytest.raises(RuntimeError):
+        runtime.run(nested())
+
+
+def test_sync_chat_goes_through_the_loop(net, runtime, upstream):
+    assert net._chat("hello", {"cache": False}) == "reply 1"
+    assert "stream" not in upstream[0]
+    assert runtime.stats()["in_flight"] == 0
+
+
+def test_streamed_chat_releases_its_slot(net, runtime, upstream):
+    tokens = []
+    token = net._STEP_ON_TOKEN.set(tokens.append)
+    try:
+        assert net._chat("hello", {"cache": False}) == "reply 1"
+    finally:
+        net._STEP_ON_TOKEN.reset(token)
+    assert tokens == ["rep", "ly 1"] and upstream[0]["stream"] is True
+    assert runtime.stats()["in_flight"] == 0
+
+
+def test_async_single_flight_runs_once(net, runtime, upstream):
+    state = {"english_poem": "roses"}
+
+    async def both():
+        return await asyncio.gather(
+            net._arun_skill("translate_zh", net.askill_translate_zh, {"model": "async-sf"}, dict(state)),
+            net._arun_skill("translate_zh", net.askill_translate_zh, {"model": "async-sf"}, dict(state)))
+
+    first, second = runtime.run(both())
+    assert first["chinese_poem"] == second["chinese_poem"] == "reply 1"
+    assert len(upstream) == 1
@@ -0,0 +1,92 @@
+import json
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+
+def _submit_all(batcher, items, key="k"):
+    results = [None] * len(items)
+
+    def call(i):
+        try:
+            results[i] = batcher.submit(key, items[i])
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(len(items))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(5)
+    return results
+
+
+def test_requests_in_one_window_share_a_batch(net):
+    batches = []
+
+    def run_batch(key, items):
+        batches.append(list(items))
+        return [x * 10 for x in items]
+
+    batcher = net.MicroBatcher(window=0.5, max_items=3, run_batch=run_batch)
+    assert _submit_all(batcher, [1, 2, 3]) == [10, 20, 30]
+    assert len(batches) == 1 and sorted(batches[0]) == [1, 2, 3]
+    assert batcher.stats() == {"batches": 1, "items": 3, "max_batch": 3}
+
+
+def test_per_item_errors_reach_only_their_caller(net):
+    batcher = net.MicroBatcher(window=0.5, max_items=2,
+                               run_batch=lambda key, items: [ValueError(x) if x == "bad" else x for x in items])
+    results = _submit_all(batcher, ["ok", "bad"])
+    assert "ok" in results
+    assert any(isinstance(r, ValueError) for r in results)
+
+
+def test_batch_failure_reaches_every_caller(net):
+    def run_batch(key, items):
+        raise RuntimeError("upstream down")
+
+    batcher = net.MicroBatcher(window=0.01, max_items=4, run_batch=run_batch)
+    with pytest.raises(RuntimeError):
+        batcher.submit("k", "x")
+
+
+def _translate_upstream(net, monkeypatch, reply):
+    calls = []
+
+    def create(kind, **kwargs):
+        calls.append(kind)
+        content = reply(kwargs["messages"][0]["content"]) if kind == "translate_batch" else "单条"
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+    monkeypatch.setattr(net, "_openai_create", create)
+    monkeypatch.setattr(net, "LLM_CACHE", net.LLMCache(size=10, ttl=60))
+    return calls
+
+
+def test_translate_batch_uses_one_call(net, monkeypatch):
+    calls = _translate_upstream(net, monkeypatch, lambda prompt: json.dumps({"translations": ["一", "二"]}))
+    assert net._translate_batch("gpt-4o-mini", ["one", "two"]) == ["一", "二"]
+    assert calls == ["translate_batch"]
+    # the results were cached per text
+    assert net._translate_batch("gpt-4o-mini", ["two"]) == ["二"]
+    assert calls == ["translate_batch"]
+
+
+def test_translate_batch_falls_back_per_item(net, monkeypatch):
+    calls = _translate_upstream(net, monkeypatch, lambda prompt: "not json")
+    assert net._translate_batch("gpt-4o-mini", ["one", "two"]) == ["单条", "单条"]
+    assert calls == ["translate_batch", "chat", "chat"]
+
+
+def test_execute_steps_batches_translations(client, net, monkeypatch):
+    calls = _translate_upstream(net, monkeypatch, lambda prompt: json.dumps({"translations": ["一", "二"]}))
+    monkeypatch.setattr(net, "TRANSLATE_BATCH_WINDOW_MS", 2000)
+    monkeypatch.setattr(net, "_TRANSLATE_BATCHER", net.MicroBatcher(2.0, 2, net._translate_batch))
+    items = [{"op": "translate_zh", "state": {"english_poem": text}, "delta": True} for text in ("one", "two")]
+    items.append({"op": "unknown"})
+    results = client.post("/execute_steps", json={"items": items}).get_json()["results"]
+    assert sorted(r["delta"]["chinese_poem"] for r in results[:2]) == ["一", "二"]
+    assert results[2]["status"] == 400
+    assert calls == ["translate_batch"]
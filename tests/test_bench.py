@@ -0,0 +1,75 @@
+import json
+import os
+import sys
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench"))
+import run_bench  # noqa: E402
+from fake_openai import FakeOpenAI, LatencyModel  # noqa: E402
+
+
+@pytest.fixture
+def fake_server():
+    servers = []
+
+    def start(rpm=0):
+        fake = FakeOpenAI(LatencyModel(ttft_ms=0, token_rate=0, tokens=4), port=0, rpm=rpm).start()
+        servers.append(fake)
+        return fake
+    yield start
+    for fake in servers:
+        fake.stop()
+
+
+def _chat(fake, prompt, **body):
+    return requests.post(fake.url + "/chat/completions", timeout=5,
+                         json=dict(body, model="m", messages=[{"role": "user", "content": prompt}]))
+
+
+def test_percentile_and_summary():
+    assert run_bench.percentile([], 50) is None
+    assert run_bench.percentile([4, 1, 3, 2], 50) == pytest.approx(2.5)
+    assert run_bench.summarize([10, 20, 30])["p99"] == pytest.approx(29.8)
+
+
+def test_node_skills_by_topology():
+    assert run_bench.node_skills(1, 3, "replicated") == run_bench.SKILLS
+    assert [run_bench.node_skills(i, 3, "split") for i in range(3)] == [
+        ["generate_poem_en"], ["translate_zh"], ["generate_poem_en"]]
+    assert run_bench.node_skills(0, 1, "split") == run_bench.SKILLS
+
+
+def test_compare_reports_relative_change():
+    old = {"task": {"throughput_rps": 10, "latency_ms": {"p50": 100, "p95": 200, "p99": None}}}
+    new = {"task": {"throughput_rps": 12, "latency_ms": {"p50": 90, "p95": 200, "p99": 300}}}
+    assert run_bench.compare(new, old) == {"task": {"throughput_rps_pct": 20.0, "latency_p50_pct": -10.0,
+                                                    "latency_p95_pct": 0.0}}
+
+
+def test_fake_openai_replies_parseably(fake_server):
+    fake = fake_server()
+    body = _chat(fake, "把下面 2 首英文诗翻译").json()
+    assert json.loads(body["choices"][0]["message"]["content"])["translations"][1].startswith("译文2")
+    assert body["usage"]["completion_tokens"] > 0
+
+
+def test_fake_openai_streams_with_usage(fake_server):
+    fake = fake_server()
+    resp = _chat(fake, "write a poem", stream=True, stream_options={"include_usage": True})
+    events = [line[len("data: "):] for line in resp.text.splitlines() if line.startswith("data: ")]
+    assert events[-1] == "[DONE]"
+    chunks = [json.loads(e) for e in events[:-1]]
+    text = "".join(c["choices"][0]["delta"].get("content", "") for c in chunks if c["choices"])
+    assert text.startswith("poem") and chunks[-1]["usage"]["completion_tokens"] == fake.stats["completion_tokens"]
+
+
+def test_fake_openai_enforces_rpm(fake_server):
+    fake = fake_server(rpm=1)
+    assert _chat(fake, "a").status_code == 200
+    resp = _chat(fake, "b")
+    assert resp.status_code == 429
+    assert int(resp.headers["retry-after-ms"]) > 0
+    assert resp.headers["x-ratelimit-remaining-requests"] == "0"
+    assert fake.stats["rate_limited"] == 1
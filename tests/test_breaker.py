@@ -0,0 +1,71 @@
+from types import SimpleNamespace
+
+import pytest
+
+
+@pytest.fixture
+def clock(net, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(net.time, "time", lambda: now[0])
+    return now
+
+
+def _breaker(net):
+    return net.CircuitBreaker(window=4, min_requests=2, failure_rate=0.5, open_seconds=10, probe_timeout=3)
+
+
+def test_opens_on_failure_rate(net, clock):
+    b = _breaker(net)
+    b.record(False)                       # below min_requests
+    assert b.state == "closed"
+    b.record(True)
+    assert b.state == "open"
+    assert not b.available() and not b.allow()
+    assert b.stats()["opened"] == 1 and b.stats()["rejected"] == 1
+
+
+def test_half_open_admits_a_single_probe(net, clock):
+    b = _breaker(net)
+    b.record(False), b.record(False)
+    clock[0] += 10
+    assert b.available()
+    assert b.allow()                      # the probe
+    assert not b.available() and not b.allow()
+    clock[0] += 4                         # probe timed out, allow another
+    assert b.allow()
+
+
+def test_probe_outcome_closes_or_reopens(net, clock):
+    b = _breaker(net)
+    b.record(False), b.record(False)
+    clock[0] += 10
+    assert b.allow()
+    b.record(False)
+    assert b.state == "open" and b.stats()["opened"] == 2
+    clock[0] += 10
+    assert b.allow()
+    b.record(True)
+    assert b.stats()["state"] == "closed" and b.stats()["window_requests"] == 0
+
+
+def test_open_peer_is_skipped_and_not_contacted(net, monkeypatch, clock):
+    nodes = [
+        {"id": "node-a", "url": "http://10.0.0.2:5000", "skills": ["translate_zh"]},
+        {"id": "node-b", "url": "http://10.0.0.3:5000", "skills": ["translate_zh"]},
+    ]
+    monkeypatch.setattr(net, "REGISTRY", net.NodeRegistry(nodes, 75))
+    monkeypatch.setattr(net, "PEER_BREAKERS", {})
+    posted = []
+
+    def post(url, path, **kwargs):
+        posted.append(url)
+        return SimpleNamespace(status_code=503)
+
+    monkeypatch.setattr(net.PEER_POOL, "post", post)
+    for _ in range(net.BREAKER_MIN_REQUESTS):
+        net._post_to_peer(nodes[0], "/execute_step", json={})
+    assert net._breaker("node-a").state == "open"
+    assert net.find_node_for_op("translate_zh")["id"] == "node-b"
+    with pytest.raises(net.NodeUnavailable, match="circuit open"):
+        net._post_to_peer(nodes[0], "/execute_step", json={})
+    assert len(posted) == net.BREAKER_MIN_REQUESTS
@@ -0,0 +1,64 @@
+import threading
+
+import pytest
+
+GEN_A = {"op": "generate_poem_en", "params": {"output_var": "a"}}
+GEN_B = {"op": "generate_poem_en", "params": {"output_var": "b"}}
+TRANSLATE_A = {"op": "translate_zh", "params": {"text_var": "a"}}
+
+
+def test_independent_steps_have_no_dependencies(net):
+    assert net._build_dag([GEN_A, GEN_B, TRANSLATE_A]) == [set(), set(), {0}]
+
+
+def test_unknown_skill_is_a_barrier(net):
+    assert net._build_dag([GEN_A, {"op": "custom"}, GEN_B]) == [set(), {0}, {1}]
+
+
+def test_explicit_depends_on(net):
+    pipeline = [dict(GEN_A, id="first"), dict(GEN_B, id="second", depends_on=["first"])]
+    assert net._build_dag(pipeline) == [set(), {0}]
+
+
+@pytest.mark.parametrize("pipeline", [
+    [dict(GEN_A, id="x"), dict(GEN_B, id="x")],
+    [dict(GEN_A, id="x", depends_on=["y"]), dict(GEN_B, id="y", depends_on=["x"])],
+    [dict(GEN_A, depends_on=["missing"])],
+    [dict(GEN_A, depends_on="s0")],
+])
+def test_invalid_dags_are_rejected(net, pipeline):
+    with pytest.raises(ValueError):
+        net._build_dag(pipeline)
+
+
+def test_ready_steps_run_in_parallel_and_merge(net, make_task, monkeypatch):
+    # both generate steps must be running at the same time to get past the barrier
+    barrier = threading.Barrier(2, timeout=2)
+
+    def run_step(task_id, idx, step, state):
+        if step["op"] == "generate_poem_en":
+            barrier.wait()
+        out = step["params"]["output_var"] if step["op"] == "generate_poem_en" else "chinese_poem"
+        return dict(state, **{out: "%s-%d" % (step["op"], idx)})
+
+    monkeypatch.setattr(net, "_run_step", run_step)
+    pipeline = [GEN_A, GEN_B, TRANSLATE_A]
+    task_id = make_task(pipeline)
+    net._run_task_dag(task_id, pipeline, {"seed": 1})
+    t = net._task_snapshot(task_id)
+    assert t["status"] == "done"
+    assert t["final_state"] == {"seed": 1, "a": "generate_poem_en-0", "b": "generate_poem_en-1",
+                                "chinese_poem": "translate_zh-2"}
+
+
+def test_failed_step_skips_dependents(net, make_task, monkeypatch):
+    def run_step(task_id, idx, step, state):
+        raise net.StepError("no replica")
+
+    monkeypatch.setattr(net, "_run_step", run_step)
+    pipeline = [GEN_A, TRANSLATE_A]
+    task_id = make_task(pipeline)
+    net._run_task_dag(task_id, pipeline, {})
+    t = net._task_snapshot(task_id)
+    assert t["status"] == "error" and "no replica" in t["error"]
+    assert [st["status"] for st in t["steps"]] == ["error", "skipped"]
@@ -0,0 +1,177 @@
+import json
+import subprocess
+
+import pytest
+
+import echonet_discovery
+from echonet_discovery import Advertiser, MetricsSampler, decode_txt, encode_txt
+
+METRICS = {"cpu": 12.4, "battery": 80, "load": 1, "max_load": 5, "health": 0.85}
+
+
+def _wire(props):
+    # zeroconf hands listeners bytes keys and values
+    return {k.encode(): v.encode() for k, v in props.items()}
+
+
+def test_v2_round_trip():
+    rec = decode_txt(_wire(encode_txt("phone", ["b", "a"], METRICS, url="http://10.0.0.5:5000")))
+    assert rec == {"id": "phone", "skills": ["a", "b"], "url": "http://10.0.0.5:5000",
+                   "metrics": {"cpu": 12.0, "battery": 80, "load": 1, "max_load": 5, "health": 0.85}}
+
+
+def test_v2_without_metrics():
+    # echonet_node advertises id / v / url / s and no "m"
+    rec = decode_txt(_wire({"id": "n2", "v": "2", "url": "http://10.0.0.6:5001", "s": "translate_zh"}))
+    assert rec["skills"] == ["translate_zh"]
+    assert rec["metrics"] is None
+
+
+def test_v2_unknown_battery():
+    rec = decode_txt(_wire(encode_txt("desk", ["x"], dict(METRICS, battery=None))))
+    assert rec["metrics"]["battery"] is None
+
+
+def test_v1_json_record():
+    rec = decode_txt(_wire({"id": "old", "skills": json.dumps(["x", "y"]), "metrics": json.dumps(METRICS)}))
+    assert rec["skills"] == ["x", "y"]
+    assert rec["metrics"] == METRICS
+    assert rec["url"] is None
+
+
+@pytest.mark.parametrize("props", [
+    {"v": "2", "s": "x"},
+    {"id": "n", "skills": "not json"},
+    {"id": "n", "skills": json.dumps({"x": 1})},
+    {"id": "n", "s": "x", "m": "1,2,3"},
+    {"id": "n", "s": "x", "m": "a,b,c,d,e"},
+])
+def test_malformed_records_raise_value_error(props):
+    with pytest.raises(ValueError):
+        decode_txt(_wire(props))
+
+
+class FakeZeroconf:
+    def __init__(self):
+        self.calls = []
+
+    def register_service(self, info):
+        self.calls.append(("register", info))
+
+    def update_service(self, info):
+        self.calls.append(("update", info))
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(echonet_discovery.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(echonet_discovery.random, "uniform", lambda a, b: 1.0)
+    return now
+
+
+def test_advertiser_publishes_on_change_and_heartbeat(clock):
+    metrics = dict(METRICS)
+    zc = FakeZeroconf()
+    adv = Advertiser(zc, "phone", "10.0.0.5", 4321, ["x"], lambda: dict(metrics), heartbeat=30)
+
+    assert adv.tick()                      # first tick registers
+    clock[0] += 3
+    metrics["cpu"] += 5                    # below the 15% threshold
+    assert not adv.tick()
+    metrics["load"] += 1                   # crosses the load threshold
+    assert adv.tick()
+    clock[0] += 31                         # nothing changed, but the heartbeat is due
+    assert adv.tick()
+
+    assert [kind for kind, _ in zc.calls] == ["register", "update", "update"]
+    assert adv.stats["suppressed"] == 1 and adv.stats["heartbeats"] == 1
+    assert decode_txt(zc.calls[-1][1].properties)["metrics"]["load"] == 2
+
+
+def test_advertiser_without_metrics_heartbeats(clock):
+    zc = FakeZeroconf()
+    adv = Advertiser(zc, "n2", "10.0.0.6", 5001, ["translate_zh"], url="http://10.0.0.6:5001", heartbeat=30)
+    assert adv.tick()
+    clock[0] += 10
+    assert not adv.tick()
+    clock[0] += 25
+    assert adv.tick()
+    rec = decode_txt(zc.calls[-1][1].properties)
+    assert rec["url"] == "http://10.0.0.6:5001" and rec["metrics"] is None
+
+
+class _Stop(Exception):
+    pass
+
+
+def _stop_after(n):
+    calls = []
+
+    def sleep(seconds):
+        calls.append(seconds)
+        if len(calls) >= n:
+            raise _Stop
+    return sleep
+
+
+def test_net_advertise_self_keeps_announcing(net, clock, monkeypatch):
+    monkeypatch.setitem(net._DISCOVERY_STATE, "advertising", False)
+    monkeypatch.setitem(net._DISCOVERY_STATE, "advertiser", None)
+    monkeypatch.setattr(net.time, "sleep", _stop_after(3))
+    zc = FakeZeroconf()
+    with pytest.raises(_Stop):
+        net._advertise_self(zc)
+    adv = net._DISCOVERY_STATE["advertiser"]
+    assert net._DISCOVERY_STATE["advertising"] and adv.stats["announcements"] >= 1
+    rec = decode_txt(zc.calls[0][1].properties)
+    assert rec["id"] == net.SELF_ID and rec["metrics"] is not None
+
+
+def test_echonet_node_advertise_self_heartbeats(echonet_node, clock, monkeypatch):
+    monkeypatch.setattr(echonet_node, "ADVERTISER", {})
+    zc = FakeZeroconf()
+
+    def sleep(seconds):
+        clock[0] += 31
+        if len(zc.calls) >= 2:
+            raise _Stop
+    monkeypatch.setattr(echonet_node.time, "sleep", sleep)
+    with pytest.raises(_Stop):
+        echonet_node._advertise_self(zc)
+    assert [kind for kind, _ in zc.calls] == ["register", "update"]
+    assert echonet_node.ADVERTISER["advertiser"].stats["heartbeats"] == 1
+
+
+def test_advertise_self_skipped_when_name_taken(net, clock, monkeypatch):
+    class TakenZeroconf(FakeZeroconf):
+        def register_service(self, info):
+            raise RuntimeError("service name already registered")
+
+    monkeypatch.setitem(net._DISCOVERY_STATE, "advertising", False)
+    monkeypatch.setattr(net.time, "sleep", _stop_after(1))
+    net._advertise_self(TakenZeroconf())   # returns instead of looping
+    assert not net._DISCOVERY_STATE["advertising"]
+
+
+def test_metrics_sampler_falls_back_and_smooths(clock):
+    def missing():
+        raise FileNotFoundError("/proc/stat")
+
+    def slow():
+        raise subprocess.TimeoutExpired("termux-battery-status", 10)
+
+    readings = iter([40.0, 80.0])
+    sampler = MetricsSampler(battery_interval=60, alpha=0.5)
+    sampler.cpu_sources = [("proc", missing), ("fake", lambda: next(readings))]
+    sampler.battery_sources = [("termux", slow), ("fake", lambda: 77)]
+
+    sampler.sample()
+    assert sampler.cpu == 40.0 and sampler.battery == 77
+    # a missing source is dropped for good, a slow one is kept for next time
+    assert [name for name, _ in sampler.cpu_sources] == ["fake"]
+    assert [name for name, _ in sampler.battery_sources] == ["termux", "fake"]
+
+    sampler.sample()
+    assert sampler.cpu == 60.0
+    assert sampler.stats() == {"cpu_source": "fake", "battery_source": "termux", "samples": 2}
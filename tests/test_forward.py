@@ -0,0 +1,135 @@
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+
+def _forward_body(**overrides):
+    body = {"pipeline": [{"op": "translate_zh"}], "offset": 0, "state": {},
+            "task_id": "t-forward", "origin_id": "node1", "origin_url": "http://127.0.0.1:5000",
+            "callback_token": "cb"}
+    body.update(overrides)
+    return body
+
+
+NODE = {"X-Node-Token": "cluster-secret"}
+
+
+@pytest.fixture
+def node_token(net, monkeypatch):
+    monkeypatch.setattr(net, "NODE_TOKEN", "cluster-secret")
+
+
+def test_forward_disabled_without_node_token(client, auth):
+    assert client.post("/forward", json=_forward_body(), headers=auth).status_code == 403
+
+
+def test_forward_rejects_user_tokens(client, auth, node_token):
+    assert client.post("/forward", json=_forward_body()).status_code == 401
+    assert client.post("/forward", json=_forward_body(), headers=auth).status_code == 401
+    assert client.post("/forward", json=_forward_body(), headers={"X-Node-Token": "nope"}).status_code == 403
+
+
+def test_forward_rejects_unknown_origin(client, net, node_token, monkeypatch):
+    submitted = []
+    monkeypatch.setattr(net.TASK_EXECUTOR, "submit", lambda *a, **kw: submitted.append(a))
+    for body in (_forward_body(origin_url="http://169.254.169.254/latest"),
+                 _forward_body(origin_id="stranger", origin_url="http://10.0.0.9:5000")):
+        resp = client.post("/forward", json=body, headers=NODE)
+        assert resp.status_code == 403
+    assert not submitted
+
+    resp = client.post("/forward", json=_forward_body(owner_id="user1"), headers=NODE)
+    assert resp.status_code == 202
+    assert len(submitted) == 1
+    ctx = submitted[0][3]
+    assert ctx["owner_id"] == "user1" and "user_token" not in ctx
+
+
+def test_forward_to_peer_sends_node_token_not_user_token(net, node_token, monkeypatch):
+    sent = []
+    monkeypatch.setattr(net, "_post_to_peer",
+                        lambda node, path, json=None, headers=None: sent.append((json, headers))
+                        or SimpleNamespace(status_code=202))
+    ctx = {"task_id": "t1", "origin_id": "node1", "origin_url": "http://127.0.0.1:5000",
+           "callback_token": "cb", "owner_id": "user1"}
+    net._forward_to({"id": "node2", "url": "http://127.0.0.1:5001"}, ctx, [{"op": "translate_zh"}], 0, {}, [])
+    body, headers = sent[0]
+    assert headers == NODE
+    assert body["owner_id"] == "user1"
+    assert "testtoken123" not in json.dumps(body)
+
+
+def test_complete_requires_node_token(client, net, node_token):
+    net.TASK_STORE.create("t-complete", {
+        "owner": "testtoken123", "pipeline": [{"op": "translate_zh"}],
+        "steps": [{"id": "s0", "op": "translate_zh", "status": "forwarded", "node": None}],
+        "final_state": None, "status": "running", "error": None, "created_at": time.time(),
+        "callback_token": "cb",
+    })
+    net._open_events("t-complete")
+    body = {"status": "done", "final_state": {"x": 1}, "callback_token": "cb",
+            "steps": [{"index": 0, "node": "node2", "started_at": 0, "finished_at": 1}]}
+    assert client.post("/task/t-complete/complete", json=body).status_code == 401
+    assert client.post("/task/t-complete/complete", json=body, headers=NODE).status_code == 200
+    assert net._task_snapshot("t-complete")["status"] == "done"
+
+
+def test_task_is_not_forwarded_without_node_token(client, auth, net, monkeypatch):
+    monkeypatch.setattr(net, "NODE_TOKEN", None)
+    monkeypatch.setattr(net.TASK_EXECUTOR, "submit",
+                        lambda *a, **kw: SimpleNamespace(add_done_callback=lambda cb: cb(None)))
+    resp = client.post("/task", json={"pipeline": [{"op": "translate_zh"}], "forward": True}, headers=auth)
+    assert resp.get_json()["mode"] == "dag"
+
+
+def test_expired_forwarded_task_is_swept(net):
+    net.TASK_STORE.create("t-expired", {
+        "owner": "testtoken123", "pipeline": [{"op": "translate_zh"}],
+        "steps": [{"id": "s0", "op": "translate_zh", "status": "forwarded", "node": None}],
+        "final_state": None, "status": "running", "error": None, "created_at": time.time(),
+        "forward_deadline": time.time() - 1,
+    })
+    net._open_events("t-expired")
+    net._FORWARD_DEADLINES.put((time.time(), "t-expired"))
+    deadline = time.time() + 2
+    while net._task_snapshot("t-expired")["status"] == "running" and time.time() < deadline:
+        time.sleep(0.02)
+    t = net._task_snapshot("t-expired")
+    assert t["status"] == "error"
+    assert "timed out" in t["error"]
+
+
+def test_is_chain(net):
+    assert net._is_chain([set(), {0}, {1}])
+    assert not net._is_chain([set(), set(), {1}])
+
+
+def test_chain_runs_local_steps_then_forwards_the_rest(net, node_token, monkeypatch):
+    peer = {"id": "node2", "url": "http://127.0.0.1:5001", "skills": ["translate_zh"]}
+    monkeypatch.setattr(net, "REGISTRY", net.NodeRegistry(
+        [{"id": net.SELF_ID, "url": net.SELF_URL, "skills": ["generate_poem_en"]}, peer], 75))
+    monkeypatch.setattr(net, "_run_skill", lambda op, params, state: dict(state, english_poem="roses"))
+    forwarded = []
+    monkeypatch.setattr(net, "_forward_to", lambda node, ctx, pipeline, offset, state, records:
+                        forwarded.append((node["id"], offset, state, [r["index"] for r in records])))
+    completed = []
+    monkeypatch.setattr(net, "_complete_forwarded", lambda ctx, result: completed.append(result))
+
+    ctx = {"task_id": "t1", "origin_id": "node1", "origin_url": net.SELF_URL, "callback_token": "cb"}
+    pipeline = [{"op": "generate_poem_en"}, {"op": "translate_zh"}]
+    net._advance_chain(ctx, pipeline, 0, {}, [])
+    assert forwarded == [("node2", 1, {"english_poem": "roses"}, [0])]
+    assert completed == []
+
+
+def test_last_hop_reports_back(net, monkeypatch):
+    monkeypatch.setattr(net, "_run_skill", lambda op, params, state: dict(state, chinese_poem="玫瑰"))
+    completed = []
+    monkeypatch.setattr(net, "_complete_forwarded", lambda ctx, result: completed.append(result))
+    ctx = {"task_id": "t1", "origin_id": "node9", "origin_url": "http://10.0.0.9:5000", "callback_token": "cb"}
+    net._advance_chain(ctx, [{"op": "generate_poem_en"}, {"op": "translate_zh"}], 1, {"english_poem": "roses"}, [])
+    assert completed[0]["status"] == "done"
+    assert completed[0]["final_state"] == {"english_poem": "roses", "chinese_poem": "玫瑰"}
+    assert [r["index"] for r in completed[0]["steps"]] == [1]
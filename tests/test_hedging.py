@@ -0,0 +1,108 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+PRIMARY = {"id": "primary", "url": "http://10.0.0.2:5000", "skills": ["translate_zh"]}
+BACKUP = {"id": "backup", "url": "http://10.0.0.3:5000", "skills": ["translate_zh"]}
+
+
+@pytest.fixture
+def hedging(net, monkeypatch):
+    monkeypatch.setattr(net, "STEP_HEDGING", True)
+    monkeypatch.setattr(net, "HEDGE_DEFAULT_DELAY", 0.05)
+    monkeypatch.setattr(net, "STEP_LATENCY", net.LatencyTracker())
+    monkeypatch.setattr(net, "HEDGE_STATS", {"hedged": 0, "hedge_wins": 0})
+    monkeypatch.setattr(net, "find_node_for_op", lambda op, exclude=(): BACKUP)
+    release = threading.Event()
+    calls = []
+
+    def install(behaviour):
+        def fake(node, op, params, state, on_token=None):
+            calls.append(node["id"])
+            return behaviour[node["id"]](on_token)
+        monkeypatch.setattr(net, "_execute_on_node", fake)
+    yield SimpleNamespace(install=install, release=release, calls=calls)
+    release.set()
+
+
+def test_percentile_needs_enough_samples(net, monkeypatch):
+    monkeypatch.setattr(net, "HEDGE_MIN_SAMPLES", 5)
+    tracker = net.LatencyTracker(window=10)
+    for s in range(4):
+        tracker.record("op", s / 10)
+    assert tracker.percentile("op", 95) is None
+    for s in range(4, 20):
+        tracker.record("op", s / 10)
+    # only the last `window` samples are kept: 1.0 .. 1.9
+    assert tracker.percentile("op", 50) == pytest.approx(1.5)
+    assert tracker.percentile("op", 99) == pytest.approx(1.9)
+
+
+def test_hedge_delay_defaults_and_floor(net, monkeypatch):
+    monkeypatch.setattr(net, "STEP_LATENCY", net.LatencyTracker())
+    monkeypatch.setattr(net, "HEDGE_MIN_SAMPLES", 3)
+    assert net._hedge_delay("op") == net.HEDGE_DEFAULT_DELAY
+    for _ in range(3):
+        net.STEP_LATENCY.record("op", 0.001)
+    assert net._hedge_delay("op") == net.HEDGE_MIN_DELAY
+
+
+def test_fast_primary_is_not_hedged(net, hedging):
+    hedging.install({"primary": lambda on_token: {"who": "primary"}})
+    assert net._execute_hedged(PRIMARY, "translate_zh", {}, {}) == {"who": "primary"}
+    assert hedging.calls == ["primary"]
+    assert net.HEDGE_STATS == {"hedged": 0, "hedge_wins": 0}
+
+
+def test_slow_primary_loses_to_backup(net, hedging):
+    hedging.install({
+        "primary": lambda on_token: hedging.release.wait(5) and {"who": "primary"},
+        "backup": lambda on_token: {"who": "backup"},
+    })
+    winners = []
+    result = net._execute_hedged(PRIMARY, "translate_zh", {}, {}, on_backup_win=winners.append)
+    assert result == {"who": "backup"}
+    assert winners == [BACKUP]
+    assert net.HEDGE_STATS == {"hedged": 1, "hedge_wins": 1}
+
+
+def test_failed_backup_falls_back_to_primary(net, hedging):
+    def backup(on_token):
+        raise net.NodeUnavailable("backup down")
+
+    def primary(on_token):
+        time.sleep(0.2)
+        return {"who": "primary"}
+
+    hedging.install({"primary": primary, "backup": backup})
+    assert net._execute_hedged(PRIMARY, "translate_zh", {}, {}) == {"who": "primary"}
+    assert net.HEDGE_STATS == {"hedged": 1, "hedge_wins": 0}
+
+
+def test_both_failing_raises_primary_error(net, hedging):
+    def primary(on_token):
+        time.sleep(0.2)
+        raise net.NodeUnavailable("primary down")
+
+    def backup(on_token):
+        raise net.NodeUnavailable("backup down")
+
+    hedging.install({"primary": primary, "backup": backup})
+    with pytest.raises(net.NodeUnavailable, match="primary down"):
+        net._execute_hedged(PRIMARY, "translate_zh", {}, {})
+
+
+def test_streaming_primary_is_not_hedged(net, hedging):
+    def primary(on_token):
+        on_token("first")
+        time.sleep(0.2)
+        on_token("second")
+        return {"who": "primary"}
+
+    hedging.install({"primary": primary})
+    tokens = []
+    assert net._execute_hedged(PRIMARY, "translate_zh", {}, {}, on_token=tokens.append) == {"who": "primary"}
+    assert tokens == ["first", "second"]
+    assert hedging.calls == ["primary"]
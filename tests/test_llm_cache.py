@@ -0,0 +1,65 @@
+import pytest
+
+
+@pytest.fixture
+def clock(net, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(net.time, "time", lambda: now[0])
+    return now
+
+
+def test_memory_hit_miss_and_lru_eviction(net):
+    cache = net.LLMCache(size=2, ttl=60)
+    cache.put("a", "A")
+    cache.put("b", "B")
+    assert cache.get("a") == "A"          # a is now most recently used
+    cache.put("c", "C")                   # evicts b
+    assert cache.get("b") is None
+    assert cache.get("c") == "C"
+    stats = cache.stats()
+    assert (stats["memory_hits"], stats["misses"], stats["memory_evictions"]) == (2, 1, 1)
+    assert stats["hit_rate"] == pytest.approx(2 / 3)
+
+
+def test_entries_expire_after_ttl(net, clock):
+    cache = net.LLMCache(size=10, ttl=60)
+    cache.put("a", "A")
+    clock[0] += 61
+    assert cache.get("a") is None
+    assert cache.stats()["memory_entries"] == 0
+
+
+def test_disk_tier_survives_restart_and_is_bounded(net, tmp_path, clock):
+    path = str(tmp_path / "llm.db")
+    cache = net.LLMCache(size=1, ttl=600, path=path, disk_max_bytes=1000)
+    cache.put("a", "x" * 400)
+    clock[0] += 1
+    cache.put("b", "y" * 400)
+    clock[0] += 1
+
+    restarted = net.LLMCache(size=1, ttl=600, path=path, disk_max_bytes=1000)
+    assert restarted.get("a") == "x" * 400
+    assert restarted.stats()["disk_hits"] == 1
+
+    clock[0] += 1
+    restarted.put("c", "z" * 400)        # 1200 bytes > 1000: least recently accessed ("b") goes
+    assert restarted.stats()["disk_evictions"] == 1
+    assert restarted.stats()["disk_bytes"] == 800
+    restarted._mem.clear()
+    assert restarted.get("b") is None and restarted.get("a") is not None
+
+
+def test_key_covers_model_messages_and_sampling(net):
+    messages = [{"role": "user", "content": "hi"}]
+    key = net.LLMCache.make_key("m", messages, {"temperature": 0})
+    assert key == net.LLMCache.make_key("m", list(messages), {"temperature": 0})
+    assert key != net.LLMCache.make_key("m2", messages, {"temperature": 0})
+    assert key != net.LLMCache.make_key("m", messages, {"temperature": 1})
+
+
+def test_chat_calls_upstream_once_per_prompt(net, fake_openai, monkeypatch):
+    monkeypatch.setattr(net, "LLM_CACHE", net.LLMCache(size=10, ttl=60))
+    assert net._chat("same prompt", {}) == "reply 1"
+    assert net._chat("same prompt", {}) == "reply 1"
+    assert net._chat("same prompt", {"cache": False}) == "reply 2"
+    assert len(fake_openai) == 2
@@ -0,0 +1,48 @@
+import threading
+
+
+def test_counters_and_histograms_merge_across_threads(net):
+    m = net.Metrics((0.1, 1.0))
+    m.describe("req_total", "counter", "Requests.")
+    m.describe("lat_seconds", "histogram", "Latency.")
+
+    def work():
+        m.inc("req_total", (("route", "/a"),))
+        m.observe("lat_seconds", (), 0.5)
+
+    threads = [threading.Thread(target=work) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    m.observe("lat_seconds", (), 0.05)
+    m.observe("lat_seconds", (), 5)
+    # shards of exited threads are folded into the retired totals, so a second scrape agrees
+    for text in (m.render(), m.render()):
+        lines = text.splitlines()
+        assert "# TYPE req_total counter" in lines
+        assert 'req_total{route="/a"} 3' in lines
+        assert 'lat_seconds_bucket{le="0.1"} 1' in lines
+        assert 'lat_seconds_bucket{le="1.0"} 4' in lines
+        assert 'lat_seconds_bucket{le="+Inf"} 5' in lines
+        assert "lat_seconds_count 5" in lines
+
+
+def test_gauges_and_label_escaping(net):
+    m = net.Metrics((1.0,))
+    m.gauge("depth", "Queue depth.", lambda: [((("q", 'a"b\n'),), 2)])
+    m.gauge("broken", "Raises.", lambda: 1 / 0)
+    text = m.render()
+    assert "# TYPE depth gauge" in text
+    assert 'depth{q="a\\"b\\n"} 2' in text
+    assert "broken " not in text
+
+
+def test_metrics_endpoint_counts_requests(client, net):
+    client.get("/info")
+    resp = client.get("/metrics")
+    assert resp.status_code == 200
+    assert resp.mimetype == "text/plain"
+    text = resp.get_data(as_text=True)
+    assert 'echonet_http_requests_total{route="/info",method="GET",status="200"}' in text
+    assert "echonet_step_admission" in text
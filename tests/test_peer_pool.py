@@ -0,0 +1,45 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+class _Echo(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        out = json.dumps({"path": self.path, "body": json.loads(body or b"null")}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def peer():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Echo)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield "http://127.0.0.1:%d" % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def test_sequential_calls_reuse_one_connection(net, peer):
+    pool = net.PeerPool(pool_size=4, connect_timeout=1, read_timeout=5)
+    for i in range(3):
+        resp = pool.post(peer + "/", "/execute_step", json={"i": i})
+        assert resp.json() == {"path": "/execute_step", "body": {"i": i}}
+    assert pool.stats() == {peer: {"requests": 3, "connections_opened": 1, "connections_reused": 2}}
+
+
+def test_one_client_per_peer(net, peer):
+    pool = net.PeerPool(pool_size=4, connect_timeout=1, read_timeout=5)
+    assert pool._client(peer) is pool._client(peer)
+    pool.post(peer + "/", "/x", json={})
+    assert list(pool.stats()) == [peer]
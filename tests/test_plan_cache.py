@@ -0,0 +1,58 @@
+import json
+from types import SimpleNamespace
+
+TASKS = [{"id": "t1", "op": "generate_poem_en", "params": {}, "target_node": "node1", "depends_on": []}]
+
+
+def test_exact_hit_after_normalization(net):
+    cache = net.PlanCache(size=4)
+    cache.put("Write a poem.", "fp", TASKS)
+    tasks, match = cache.get("  write   A POEM ", "fp")
+    assert (tasks, match) == (TASKS, "exact")
+    tasks[0]["op"] = "changed"              # callers get a copy
+    assert cache.get("write a poem", "fp")[0] == TASKS
+
+
+def test_lru_eviction(net):
+    cache = net.PlanCache(size=2)
+    cache.put("a", "fp", TASKS)
+    cache.put("b", "fp", TASKS)
+    cache.get("a", "fp")
+    cache.put("c", "fp", TASKS)
+    assert cache.get("b", "fp") is None
+    assert cache.get("a", "fp") is not None
+    assert cache.stats()["entries"] == 2
+
+
+def test_topology_change_invalidates(net):
+    cache = net.PlanCache(size=4)
+    cache.put("a", "fp1", TASKS)
+    assert cache.get("a", "fp2") is None
+    assert cache.stats()["invalidations"] == 1
+
+
+def test_similar_commands_only_when_enabled(net):
+    exact_only = net.PlanCache(size=4)
+    fuzzy = net.PlanCache(size=4, similarity=0.6)
+    for cache in (exact_only, fuzzy):
+        cache.put("write a short poem about the sea", "fp", TASKS)
+    assert exact_only.get("write a short poem about the ocean", "fp") is None
+    assert fuzzy.get("write a short poem about the ocean", "fp")[1] == "similar"
+    assert fuzzy.get("translate this into chinese", "fp") is None
+
+
+def test_analyze_reuses_plan(client, net, monkeypatch):
+    calls = []
+
+    def create(kind, **kwargs):
+        calls.append(kind)
+        content = json.dumps({"tasks": TASKS})
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+    monkeypatch.setattr(net, "_openai_create", create)
+    monkeypatch.setattr(net, "PLAN_CACHE", net.PlanCache(size=4))
+    first = client.post("/analyze", json={"command": "Write a poem"}).get_json()
+    second = client.post("/analyze", json={"command": "write a poem."}).get_json()
+    assert (first["plan_cache"], second["plan_cache"]) == ("miss", "exact")
+    assert first["tasks"] == second["tasks"]
+    assert calls == ["analyze"]
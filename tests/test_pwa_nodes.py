@@ -0,0 +1,68 @@
+import importlib.util
+import json
+import os
+import socket
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from echonet_discovery import SERVICE_TYPE, encode_txt
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "PWA_echonet", "app.py")
+
+
+@pytest.fixture(scope="module")
+def pwa():
+    spec = importlib.util.spec_from_file_location("pwa_app", APP_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _wait_for(predicate, timeout=3.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_upsert_remove_and_snapshot(pwa):
+    table = pwa.NodeTable(ttl=60)
+    assert table.upsert("a._svc", {"id": "a"}) is True
+    assert table.upsert("a._svc", {"id": "a", "port": 1}) is False
+    before = table.snapshot()
+    table.upsert("b._svc", {"id": "b"})
+    assert before == ({"id": "a", "port": 1},)            # published snapshots never change
+    assert json.loads(table.snapshot_json()) == [{"id": "a", "port": 1}, {"id": "b"}]
+    assert table.remove("a._svc") == "a"
+    assert table.remove("a._svc") is None
+    assert [n["id"] for n in table.snapshot()] == ["b"]
+
+
+def test_expiry_skips_refreshed_nodes(pwa):
+    table = pwa.NodeTable(ttl=0.3)
+    threading.Thread(target=table.run_expiry, daemon=True).start()
+    table.upsert("a._svc", {"id": "a"})
+    table.upsert("b._svc", {"id": "b"})
+    time.sleep(0.15)
+    table.upsert("a._svc", {"id": "a"})                   # leaves a stale heap entry for a
+    _wait_for(lambda: [n["id"] for n in table.snapshot()] == ["a"])
+    _wait_for(lambda: table.snapshot() == ())
+    table.upsert("c._svc", {"id": "c"})                   # an idle expiry thread wakes up for new deadlines
+    _wait_for(lambda: table.snapshot() == ())
+
+
+def test_listener_fills_nodes_endpoint(pwa, monkeypatch):
+    monkeypatch.setattr(pwa, "DISCOVERED_NODES", pwa.NodeTable(ttl=60))
+    props = encode_txt("peer", ["translate_zh"], url="http://10.0.0.2:5000")
+    info = SimpleNamespace(properties={k.encode(): v.encode() for k, v in props.items()},
+                           addresses=[socket.inet_aton("10.0.0.2")], port=5000)
+    zc = SimpleNamespace(get_service_info=lambda service_type, name: info)
+    listener = pwa.DiscoveryListener()
+    listener.add_service(zc, SERVICE_TYPE, "peer._svc")
+    nodes = pwa.app.test_client().get("/nodes").get_json()
+    assert [(n["id"], n["ip"], n["skills"]) for n in nodes] == [("peer", "10.0.0.2", ["translate_zh"])]
+    listener.remove_service(zc, SERVICE_TYPE, "peer._svc")
+    assert pwa.app.test_client().get("/nodes").get_json() == []
@@ -0,0 +1,96 @@
+from types import SimpleNamespace
+
+import pytest
+from openai import APIConnectionError, APIStatusError, RateLimitError
+
+
+@pytest.fixture
+def clock(net, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(net.time, "monotonic", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def limiter(net, monkeypatch):
+    fresh = net.TokenBucketLimiter(0, 0, 0.9, 5)
+    monkeypatch.setattr(net, "OPENAI_LIMITER", fresh)
+    return fresh
+
+
+def _error(cls, status, headers=None):
+    response = SimpleNamespace(status_code=status, headers=headers or {}, request=SimpleNamespace())
+    return cls(f"status {status}", response=response, body=None)
+
+
+def test_requests_queue_behind_each_other(net, clock):
+    # 60 rpm at full headroom refills one request per second; the burst is two requests
+    bucket = net.TokenBucketLimiter(60, 0, 1.0, 2)
+    assert [bucket.reserve(0, 10) for _ in range(4)] == [0, 0, 1.0, 2.0]
+    with pytest.raises(net.UpstreamRateLimited) as exc:
+        bucket.reserve(0, 2.5)
+    assert exc.value.retry_after == pytest.approx(3.0)
+    clock[0] += 3                                          # the two queued callers have gone
+    assert bucket.reserve(0, 10) == 0
+    assert bucket.reserve(0, 10) == pytest.approx(1.0)
+    assert bucket.stats()["rejected"] == 1
+
+
+def test_token_estimates_are_settled(net, clock):
+    bucket = net.TokenBucketLimiter(0, 600, 1.0, 1)       # 10 tokens per second, capacity 10
+    assert bucket.reserve(10, 10) == 0
+    assert bucket.reserve(5, 10) == pytest.approx(0.5)
+    bucket.settle(10, 2)                                   # the first call used 2 of its 10
+    assert bucket.reserve(3, 10) == 0
+
+
+def test_limits_are_learned_from_headers(net, clock):
+    bucket = net.TokenBucketLimiter(0, 0, 0.5, 1)
+    assert bucket.reserve(100, 0) == 0                     # no limits known yet
+    bucket.observe({"x-ratelimit-limit-requests": "120", "x-ratelimit-remaining-requests": "61"})
+    assert bucket.stats()["requests"]["limit_per_minute"] == 120
+    # remaining is lowered by the half of the quota we leave as headroom: 61 - 60 = 1
+    assert bucket.reserve(0, 10) == 0
+    assert bucket.reserve(0, 10) == pytest.approx(1.0)
+
+
+def test_penalty_pauses_everyone(net, clock):
+    bucket = net.TokenBucketLimiter(0, 0, 0.9, 5)
+    bucket.penalize(2)
+    assert bucket.reserve(0, 10) == pytest.approx(2.0)
+    assert bucket.stats()["penalties"] == 1
+
+
+def test_retry_delay_classifies_errors(net, limiter, monkeypatch):
+    monkeypatch.setattr(net, "OPENAI_MAX_RETRIES", 2)
+    assert net._retry_delay(_error(APIStatusError, 400), 0) is None
+    assert net._retry_delay(ValueError("bug"), 0) is None
+    assert net._retry_delay(_error(APIStatusError, 502), 2) is None     # out of attempts
+    assert 0 <= net._retry_delay(APIConnectionError(request=SimpleNamespace()), 1) <= net.OPENAI_BACKOFF_BASE * 2
+    delay = net._retry_delay(_error(RateLimitError, 429, {"retry-after-ms": "1500"}), 0)
+    assert delay >= 1.5
+    assert limiter.stats()["penalties"] == 1 and limiter.stats()["paused_for"] > 0
+
+
+def test_upstream_call_backs_off_and_retries(net, limiter, monkeypatch):
+    monkeypatch.setattr(net, "OPENAI_BACKOFF_BASE", 0.001)
+    outcomes = [_error(APIStatusError, 503), APIConnectionError(request=SimpleNamespace())]
+
+    def call():
+        if outcomes:
+            raise outcomes.pop(0)
+        return SimpleNamespace(headers={}, parse=lambda: "parsed")
+
+    span = {"attrs": {}}
+    assert net._upstream_call("chat", span, 10, call) == "parsed"
+    assert span["attrs"]["retries"] == 2
+
+
+def test_analyze_sheds_when_rate_limited(client, auth, net, monkeypatch):
+    def create(kind, **kwargs):
+        raise net.UpstreamRateLimited("upstream rate limit: would wait 7.5s", 7.5)
+
+    monkeypatch.setattr(net, "_openai_create", create)
+    resp = client.post("/analyze", json={"command": "write a poem"}, headers=auth)
+    assert resp.status_code == 503
+    assert resp.headers["Retry-After"] == "7"
@@ -0,0 +1,62 @@
+import pytest
+
+PEER = {"id": "peer", "url": "http://10.0.0.2:5000", "skills": ["translate_zh"]}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("time.monotonic", lambda: now[0])
+    return now
+
+
+@pytest.mark.parametrize("module", ["net", "echonet_node"])
+def test_discovered_node_expires_after_ttl(module, clock, request):
+    mod = request.getfixturevalue(module)
+    registry = mod.NodeRegistry([], 75)
+    registry.upsert(dict(PEER))
+    clock[0] += 60
+    registry.upsert(dict(PEER))  # heartbeat refreshes last_seen without changing the view
+    clock[0] += 60
+    registry.expire()
+    assert "peer" in registry.view.by_id
+
+    clock[0] += 16
+    registry.expire()
+    assert "peer" not in registry.view.by_id
+    assert registry.stats()["expired"] == 1
+
+
+def test_echonet_node_prefers_less_loaded_replica(echonet_node, monkeypatch):
+    busy = dict(PEER, id="busy")
+    idle = dict(PEER, id="idle")
+    registry = echonet_node.NodeRegistry([busy, idle], 75)
+    monkeypatch.setattr(echonet_node, "REGISTRY", registry)
+    monkeypatch.setattr(echonet_node, "INFLIGHT", {"busy": 8})
+    picks = {echonet_node.find_node_for_op("translate_zh")["id"] for _ in range(50)}
+    assert picks == {"idle"}
+
+
+def test_discovery_starts_lazily_and_once(net, client, monkeypatch):
+    created = []
+
+    class FakeZeroconf:
+        def __init__(self, **kwargs):
+            created.append(self)
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(net, "DISCOVERY", True)
+    monkeypatch.setattr(net, "DISCOVERY_ADVERTISE", False)
+    monkeypatch.setattr(net, "Zeroconf", FakeZeroconf)
+    monkeypatch.setattr(net, "ServiceBrowser", lambda *a, **kw: None, raising=False)
+    monkeypatch.setattr(net, "_ensure_metrics_poller", lambda: None)
+    monkeypatch.setattr(net.atexit, "register", lambda fn: None)
+    monkeypatch.setattr(net, "_DISCOVERY_STATE", dict(net._DISCOVERY_STATE, started=False))
+    assert not created  # importing net did not start discovery
+
+    client.get("/metrics")
+    client.get("/metrics")
+    net._start_discovery()
+    assert len(created) == 1
@@ -0,0 +1,44 @@
+import time
+
+import pytest
+
+PEER = {"url": "http://10.0.0.2:5000", "skills": ["translate_zh"]}
+
+
+@pytest.fixture
+def replicas(net, monkeypatch):
+    nodes = [dict(PEER, id="busy"), dict(PEER, id="idle")]
+    monkeypatch.setattr(net, "REGISTRY", net.NodeRegistry(nodes, 75))
+    monkeypatch.setattr(net, "PEER_METRICS", {})
+    monkeypatch.setattr(net, "PEER_INFLIGHT", {})
+    monkeypatch.setattr(net, "_ensure_metrics_poller", lambda: None)
+    return net
+
+
+def _picks(net, **kwargs):
+    return {net.find_node_for_op("translate_zh", **kwargs)["id"] for _ in range(50)}
+
+
+def test_prefers_healthy_unloaded_replica(replicas):
+    now = time.time()
+    replicas.PEER_METRICS.update(busy={"health": 0.2, "load": 4, "max_load": 5, "ts": now},
+                                 idle={"health": 1.0, "load": 0, "max_load": 5, "ts": now})
+    assert _picks(replicas) == {"idle"}
+
+
+def test_counts_own_inflight_steps(replicas):
+    replicas.PEER_INFLIGHT["busy"] = 6
+    assert _picks(replicas) == {"idle"}
+
+
+def test_stale_metrics_are_ignored(replicas):
+    stale = time.time() - replicas.PEER_METRICS_INTERVAL * 10
+    replicas.PEER_METRICS.update(idle={"health": 0.1, "load": 5, "max_load": 5, "ts": stale})
+    replicas.PEER_INFLIGHT["busy"] = 1
+    assert _picks(replicas) == {"idle"}
+
+
+def test_exclude_and_missing_op(replicas):
+    assert _picks(replicas, exclude={"idle"}) == {"busy"}
+    assert replicas.find_node_for_op("translate_zh", exclude={"idle", "busy"}) is None
+    assert replicas.find_node_for_op("no_such_op") is None
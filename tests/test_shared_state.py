@@ -0,0 +1,83 @@
+import json
+import os
+import sqlite3
+import sys
+
+import pytest
+
+import serve
+
+
+@pytest.fixture
+def clock(net, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(net.time, "time", lambda: now[0])
+    return now
+
+
+def _write_users(path, users, mtime):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(users if isinstance(users, str) else json.dumps({"users": users}))
+    os.utime(path, (mtime, mtime))
+
+
+def test_user_store_reloads_changed_file(net, tmp_path, clock):
+    path = str(tmp_path / "users.json")
+    store = net.UserStore(path, check_interval=1.0)
+    assert store.get("testtoken123") == "user1"          # default test user without a file
+    _write_users(path, [{"token": "t1", "id": "alice"}], 100)
+    assert store.get("t1") is None                       # not checked again yet
+    clock[0] += 2
+    assert store.get("t1") == "alice" and "testtoken123" not in store
+    _write_users(path, "{not json", 200)                 # half-written file keeps the last table
+    clock[0] += 2
+    assert store.get("t1") == "alice"
+
+
+def test_user_store_rejects_all_on_first_bad_load(net, tmp_path):
+    path = str(tmp_path / "users.json")
+    _write_users(path, "{not json", 100)
+    assert len(net.UserStore(path)) == 0
+
+
+def test_counters_sum_live_workers_only(net, tmp_path, monkeypatch):
+    path = str(tmp_path / "state.db")
+    me, other, dead = os.getpid(), 4242, 4343
+    monkeypatch.setattr(net, "_pid_alive", lambda pid: pid in (me, other))
+    counters = net.SQLiteCounters(path)
+    counters.add("load", 2)
+    counters.add("load", -1)
+    db = sqlite3.connect(path)
+    db.executemany("INSERT INTO counters (name, pid, value) VALUES ('load', ?, ?)", [(other, 3), (dead, 5)])
+    db.commit()
+    assert counters.get("load") == 4
+    net.SQLiteCounters(path)                              # a restarting worker purges dead rows
+    assert sorted(db.execute("SELECT pid FROM counters").fetchall()) == [(other,)]
+    db.close()
+
+
+@pytest.mark.parametrize("workers, installed, expected", [
+    (4, {"gunicorn", "waitress"}, "gunicorn"),
+    (1, {"gunicorn", "waitress"}, "waitress"),
+    (4, {"waitress"}, "waitress"),
+])
+def test_serve_picks_server(monkeypatch, workers, installed, expected):
+    ran = []
+    monkeypatch.setattr(serve.importlib.util, "find_spec", lambda name: name if name in installed else None)
+    monkeypatch.setattr(serve, "run_gunicorn", lambda spec, args: ran.append(("gunicorn", args.workers)))
+    monkeypatch.setattr(serve, "run_waitress", lambda spec, args: ran.append(("waitress", args.workers)))
+    monkeypatch.setattr(sys, "argv", ["serve.py", "net:app", "--workers", str(workers)])
+    monkeypatch.setattr(sys, "path", list(sys.path))
+    monkeypatch.setenv("WEB_WORKERS", "1")
+    serve.main()
+    workers = workers if expected == "gunicorn" else 1
+    assert ran == [(expected, workers)]
+    assert os.environ["WEB_WORKERS"] == str(workers)
+
+
+def test_serve_requires_the_chosen_server(monkeypatch):
+    monkeypatch.setattr(serve.importlib.util, "find_spec", lambda name: None)
+    monkeypatch.setattr(sys, "argv", ["serve.py", "--server", "gunicorn"])
+    monkeypatch.setattr(sys, "path", list(sys.path))
+    with pytest.raises(SystemExit, match="pip install gunicorn"):
+        serve.main()
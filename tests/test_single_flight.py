@@ -0,0 +1,87 @@
+import threading
+import time
+import uuid
+
+
+def test_concurrent_calls_run_once(net):
+    flight = net.SingleFlight()
+    release = threading.Event()
+    runs = []
+
+    def fn(progress):
+        runs.append(1)
+        release.wait(2)
+        return "result"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flight.do("k", fn))) for _ in range(4)]
+    for t in threads:
+        t.start()
+    while flight.stats()["coalesced"] < 3:
+        time.sleep(0.01)
+    release.set()
+    for t in threads:
+        t.join()
+    assert runs == [1] and results == ["result"] * 4
+    assert flight.stats() == {"executions": 1, "coalesced": 3, "in_flight": 0}
+
+
+def test_errors_are_shared_and_not_cached(net):
+    flight = net.SingleFlight()
+
+    def fail(progress):
+        raise ValueError("bad")
+
+    for _ in range(2):
+        try:
+            flight.do("k", fail)
+        except ValueError as e:
+            assert str(e) == "bad"
+    assert flight.stats()["executions"] == 2
+
+
+def test_progress_is_falsy_without_listeners_and_replayed_to_joiners(net):
+    flight = net.SingleFlight()
+    seen = {}
+
+    def fn(progress):
+        seen["before"] = bool(progress)
+        joined = []
+        # a joiner that subscribes mid-flight first receives what it missed
+        flight._join("k", joined.append)
+        seen["after"] = bool(progress)
+        progress("a")
+        progress("b")
+        return joined
+
+    assert flight.do("k", fn) == ["a", "b"]
+    assert seen == {"before": False, "after": True}
+
+
+def test_slow_listener_does_not_block_other_flights(net):
+    flight = net.SingleFlight()
+    entered, release = threading.Event(), threading.Event()
+
+    def slow_listener(x):
+        entered.set()
+        release.wait(2)
+
+    t = threading.Thread(target=lambda: flight.do("slow", lambda progress: progress("x"), slow_listener))
+    t.start()
+    assert entered.wait(2)
+    try:
+        # the slow flight is stuck inside its listener; another key must still complete
+        done = []
+        other = threading.Thread(target=lambda: done.append(flight.do("fast", lambda progress: 1)))
+        other.start()
+        other.join(1)
+        assert done == [1]
+    finally:
+        release.set()
+        t.join()
+
+
+def test_run_skill_without_listener_does_not_stream(net, fake_openai):
+    state = net._run_skill("generate_poem_en", {"prompt": "poem %s" % uuid.uuid4()}, {})
+    assert state["english_poem"] == "reply 1"
+    assert [call.get("stream", False) for call in fake_openai] == [False]
@@ -0,0 +1,47 @@
+import json
+from types import SimpleNamespace
+
+PEER = {"id": "peer", "url": "http://10.0.0.2:5000", "skills": ["translate_zh"]}
+
+
+def test_only_read_keys_are_sent(net):
+    state = {"english_poem": "roses", "a": "x" * 1000, "other": 1}
+    assert net._transfer_state("translate_zh", {}, state) == {"english_poem": "roses"}
+    assert net._transfer_state("translate_zh", {"text_var": "a"}, state) == {"a": "x" * 1000}
+    assert net._transfer_state("generate_poem_en", {}, state) == {}
+    # a skill without declared reads needs the whole state
+    assert net._transfer_state("custom", {}, state) is state
+
+
+def test_merge_remote_delta_or_full_state(net):
+    state = {"english_poem": "roses", "keep": 1}
+    assert net._merge_remote(state, {"delta": {"chinese_poem": "玫瑰"}}) == dict(state, chinese_poem="玫瑰")
+    assert state == {"english_poem": "roses", "keep": 1}
+    assert net._merge_remote(state, {"state": {"only": 2}}) == {"only": 2}
+
+
+def test_execute_step_returns_only_written_keys(client, net, fake_openai, monkeypatch):
+    monkeypatch.setattr(net, "LLM_CACHE", net.LLMCache(size=10, ttl=60))
+    body = {"op": "translate_zh", "params": {"cache": False}, "state": {"english_poem": "roses"}, "delta": True}
+    assert client.post("/execute_step", json=body).get_json() == {"delta": {"chinese_poem": "reply 1"}}
+    body["delta"] = False
+    state = client.post("/execute_step", json=body).get_json()["state"]
+    assert state == {"english_poem": "roses", "chinese_poem": "reply 2"}
+
+
+def test_remote_step_sends_read_set_and_merges_delta(net, monkeypatch):
+    sent = []
+
+    def post(node, path, data=None, **kwargs):
+        sent.append((path, json.loads(data)))
+        return SimpleNamespace(status_code=200, headers={"Content-Type": "application/json"},
+                               text=json.dumps({"delta": {"chinese_poem": "玫瑰"}}),
+                               read=lambda: None, close=lambda: None)
+
+    monkeypatch.setattr(net, "_post_to_peer", post)
+    state = {"english_poem": "roses", "big": "x" * 1000}
+    merged = net._execute_on_node(PEER, "translate_zh", {}, state)
+    path, payload = sent[0]
+    assert path == "/execute_step"
+    assert payload["state"] == {"english_poem": "roses"} and payload["delta"] is True
+    assert merged == dict(state, chinese_poem="玫瑰")
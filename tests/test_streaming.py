@@ -0,0 +1,65 @@
+import json
+import uuid
+
+
+def _params():
+    # a fresh prompt so the LLM cache never answers
+    return {"prompt": "poem %s" % uuid.uuid4()}
+
+
+def test_local_step_without_listener_is_not_streamed(net, fake_openai):
+    state = net._execute_on_node({"id": net.SELF_ID}, "generate_poem_en", _params(), {})
+    assert state["english_poem"] == "reply 1"
+    assert "stream" not in fake_openai[0]
+
+
+def test_local_step_with_listener_streams_tokens(net, fake_openai):
+    tokens = []
+    net._execute_on_node({"id": net.SELF_ID}, "generate_poem_en", _params(), {}, on_token=tokens.append)
+    assert fake_openai[0]["stream"] is True
+    assert tokens == ["reply 1"]
+
+
+def test_token_listener_only_for_watched_tasks(net):
+    task_id = "t-%s" % uuid.uuid4()
+    net._open_events(task_id)
+    assert net._token_listener(task_id, "s0", "generate_poem_en") is None
+    net.TASK_EVENTS[task_id]["subscribers"] += 1
+    assert net._token_listener(task_id, "s0", "generate_poem_en") is not None
+
+    streamed = "t-%s" % uuid.uuid4()
+    net._open_events(streamed, stream=True)
+    assert net._token_listener(streamed, "s0", "generate_poem_en") is not None
+    for t in (task_id, streamed):
+        net.TASK_EVENTS.pop(t, None)
+
+
+def _sse_events(body):
+    events = []
+    for block in body.decode().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines() if not line.startswith(":"))
+        if lines:
+            events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+def test_stream_replays_events_until_finished(client, auth, net, make_task):
+    task_id = make_task([{"op": "generate_poem_en"}])
+    net.TASK_EVENTS[task_id]["stream"] = True
+    net._emit(task_id, "step_started", step="s0", op="generate_poem_en", node="node1")
+    net._token_listener(task_id, "s0", "generate_poem_en")("roses ")
+    net._finish_task(task_id, "done", {"english_poem": "roses"})
+
+    resp = client.get(f"/task/{task_id}/stream", headers=auth)
+    assert resp.mimetype == "text/event-stream"
+    events = _sse_events(resp.data)
+    assert [e for e, _ in events] == ["step_started", "token", "task_finished"]
+    assert events[1][1]["text"] == "roses "
+    assert all(data["task_id"] == task_id for _, data in events)
+    assert net.TASK_EVENTS[task_id]["subscribers"] == 0
+
+
+def test_stream_requires_owner_token(client, make_task):
+    task_id = make_task([{"op": "generate_poem_en"}])
+    assert client.get(f"/task/{task_id}/stream").status_code == 401
+    assert client.get("/task/missing/stream?token=testtoken123").status_code == 404
@@ -0,0 +1,124 @@
+import sqlite3
+import time
+
+import pytest
+
+
+def _record(status="queued"):
+    return {"owner": "u", "pipeline": [], "steps": [], "final_state": None,
+            "status": status, "error": None, "created_at": time.time()}
+
+
+def test_eviction_prefers_finished_tasks(net):
+    store = net.MemoryTaskStore(max_tasks=2, ttl=60)
+    store.create("running", _record("running"))
+    store.create("done", _record("done"))
+    store.create("new", _record())
+    assert store.get("running") is not None
+    assert store.get("done") is None
+    assert store.get("new") is not None
+    assert store.stats()["evicted"] == 1
+
+
+def test_full_store_rejects_instead_of_evicting_live_tasks(net):
+    store = net.MemoryTaskStore(max_tasks=2, ttl=60)
+    store.create("a", _record("queued"))
+    store.create("b", _record("running"))
+    with pytest.raises(net.TaskStoreFull):
+        store.create("c", _record())
+    assert store.get("a") is not None and store.get("b") is not None
+    assert store.get("c") is None
+    assert store.stats()["rejected"] == 1
+
+
+def test_task_returns_503_when_store_full(client, auth, net, monkeypatch):
+    store = net.MemoryTaskStore(max_tasks=1, ttl=60)
+    store.create("busy", _record("running"))
+    monkeypatch.setattr(net, "TASK_STORE", store)
+    slots = net._TASK_SLOTS._value
+    resp = client.post("/task", json={"pipeline": [{"op": "translate_zh"}]}, headers=auth)
+    assert resp.status_code == 503
+    assert resp.headers["Retry-After"] == "1"
+    assert net._TASK_SLOTS._value == slots
+
+
+class _LockedOnce:
+    """Wraps the store's sqlite connection; the first executemany fails like a locked database."""
+
+    def __init__(self, db):
+        self._db = db
+        self.failed = False
+
+    def executemany(self, *args):
+        if not self.failed:
+            self.failed = True
+            raise sqlite3.OperationalError("database is locked")
+        return self._db.executemany(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+
+def test_sqlite_failed_flush_is_retried(net, tmp_path):
+    store = net.SQLiteTaskStore(str(tmp_path / "tasks.db"), ttl=60, flush_interval=3600)
+    store.create("t1", _record("done"))
+    store._db = _LockedOnce(store._db)
+
+    with pytest.raises(sqlite3.OperationalError):
+        store.flush()
+    assert "t1" in store._active and "t1" in store._dirty
+    assert store.stats()["flush_errors"] == 1
+
+    store.flush()
+    assert "t1" not in store._active          # written, then dropped from memory
+    assert store.get("t1")["status"] == "done"
+
+
+@pytest.fixture
+def clock(net, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(net.time, "time", lambda: now[0])
+    return now
+
+
+def test_memory_compact_expires_only_finished_tasks(net, clock):
+    store = net.MemoryTaskStore(max_tasks=10, ttl=60)
+    store.create("done", _record("done"))
+    store.create("running", _record("running"))
+    clock[0] += 61
+    store.compact()
+    assert store.get("done") is None
+    assert store.get("running") is not None
+    assert store.stats()["expired"] == 1
+
+
+def test_sqlite_finished_tasks_expire_after_ttl(net, tmp_path, clock):
+    store = net.SQLiteTaskStore(str(tmp_path / "tasks.db"), ttl=60, flush_interval=0)
+    store.create("done", _record("running"))
+    store.update("done", status="done")
+    store.create("running", _record("running"))
+    clock[0] += 61
+    store.compact()
+    assert store.get("done") is None
+    assert store.get("running")["status"] == "running"
+
+
+def test_sqlite_write_through_is_shared_between_processes(net, tmp_path):
+    path = str(tmp_path / "tasks.db")
+    a = net.SQLiteTaskStore(path, ttl=60, flush_interval=0)
+    b = net.SQLiteTaskStore(path, ttl=60, flush_interval=0)
+    a.create("t1", _record("running"))
+    b.update("t1", status="done")
+    assert a.get("t1")["status"] == "done"
+    assert [t["task_id"] for t in b.for_owner("u")] == ["t1"]
+
+
+def test_sqlite_restart_fails_interrupted_tasks(net, tmp_path):
+    path = str(tmp_path / "tasks.db")
+    store = net.SQLiteTaskStore(path, ttl=60, flush_interval=0)
+    store.create("t1", _record("running"))
+    store.update("t1", pid=999999999)   # owned by a process that no longer exists
+
+    restarted = net.SQLiteTaskStore(path, ttl=60, flush_interval=0)
+    t = restarted.get("t1")
+    assert t["status"] == "error" and "restarted" in t["error"]
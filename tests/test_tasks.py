@@ -0,0 +1,83 @@
+import time
+
+import pytest
+
+
+def _wait_finished(client, auth, task_id, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        body = client.get(f"/result/{task_id}", headers=auth).get_json()
+        if body["status"] in ("done", "error"):
+            return body
+        time.sleep(0.02)
+    pytest.fail(f"task {task_id} still {body['status']} after {timeout}s")
+
+
+def test_worker_crash_marks_task_error(client, auth, net, monkeypatch):
+    def boom(*args, **kwargs):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(net, "_run_task_dag", boom)
+    monkeypatch.setattr(net, "_run_task_dag_async", boom)
+    resp = client.post("/task", json={"pipeline": [{"op": "translate_zh"}]}, headers=auth)
+    assert resp.status_code == 202
+    body = _wait_finished(client, auth, resp.get_json()["task_id"])
+    assert body["status"] == "error"
+    assert "boom" in body["error"]
+    assert all(st["status"] == "skipped" for st in body["steps"])
+
+
+@pytest.mark.parametrize("payload", [
+    {"pipeline": [{"op": "translate_zh"}], "state": "abc"},
+    {"pipeline": [{"op": "translate_zh"}], "state": [1, 2]},
+    {"pipeline": ["translate_zh"]},
+    {"pipeline": [{"op": "translate_zh", "params": "x"}]},
+    {"pipeline": "translate_zh"},
+])
+def test_task_rejects_malformed_body(client, auth, payload):
+    resp = client.post("/task", json=payload, headers=auth)
+    assert resp.status_code == 400
+    assert "error" in resp.get_json()
+
+
+def test_tokens_only_streamed_when_requested_or_subscribed(net):
+    net._open_events("quiet")
+    assert net._token_listener("quiet", "s0", "translate_zh") is None
+
+    net._open_events("asked", stream=True)
+    on_token = net._token_listener("asked", "s0", "translate_zh")
+    on_token("hi")
+    assert net.TASK_EVENTS["asked"]["events"][-1] == ("token", {"step": "s0", "op": "translate_zh", "text": "hi"})
+
+    net.TASK_EVENTS["quiet"]["subscribers"] += 1
+    assert net._token_listener("quiet", "s0", "translate_zh") is not None
+
+
+def test_stream_step_runs_on_bounded_pool(net, monkeypatch):
+    import json
+    import threading
+
+    seen = {}
+
+    def fake_skill_result(op, params, state, delta=False):
+        seen["thread"] = threading.current_thread().name
+        net._STEP_ON_TOKEN.get()("he")
+        return {"state": dict(state, out="hello")}
+
+    monkeypatch.setattr(net, "_skill_result", fake_skill_result)
+    lines = [json.loads(line) for line in net._stream_step("translate_zh", {}, {"x": 1})]
+    assert lines == [{"type": "token", "text": "he"}, {"type": "state", "state": {"x": 1, "out": "hello"}}]
+    assert seen["thread"].startswith("batch-item")
+
+
+@pytest.mark.parametrize("limit", ["abc", "1.5", ""])
+def test_list_tasks_rejects_bad_limit(client, auth, limit):
+    resp = client.get(f"/tasks?limit={limit}", headers=auth)
+    assert resp.status_code == 400
+
+
+@pytest.mark.parametrize("limit", ["0", "-3", "100000"])
+def test_list_tasks_clamps_limit(client, auth, limit):
+    resp = client.get(f"/tasks?limit={limit}", headers=auth)
+    assert resp.status_code == 200
+    assert isinstance(resp.get_json()["tasks"], list)
@@ -0,0 +1,67 @@
+import time
+
+import pytest
+
+
+def test_trace_store_bounds_traces_and_spans(net):
+    store = net.TraceStore(max_traces=2, max_spans=2)
+    for trace_id in ("t1", "t2", "t3"):
+        for i in range(3):
+            store.add({"trace_id": trace_id, "span_id": str(i)})
+    assert store.get("t1") == []
+    assert [sp["span_id"] for sp in store.get("t3")] == ["0", "1"]
+
+
+def test_spans_nest_and_record_errors(net, monkeypatch):
+    monkeypatch.setattr(net, "TRACE_STORE", net.TraceStore(10, 10))
+    with net._span("orphan") as span:
+        assert span is None                   # no trace in this context
+    with net._trace_scope(("a" * 32, "b" * 16)):
+        with net._span("outer", op="x") as outer:
+            with pytest.raises(ValueError):
+                with net._span("inner"):
+                    raise ValueError("boom")
+            assert net._traceparent() == f"00-{'a' * 32}-{outer['span_id']}-01"
+    assert net._trace_context() is None
+    inner, outer = net.TRACE_STORE.get("a" * 32)
+    assert outer["parent_span_id"] == "b" * 16 and inner["parent_span_id"] == outer["span_id"]
+    assert inner["status"] == "error" and inner["attrs"]["error"] == "boom"
+    assert outer["status"] == "ok" and outer["end"] >= outer["start"]
+
+
+@pytest.mark.parametrize("value", [None, "", "00-abc-def-01", "00-" + "a" * 32 + "-" + "b" * 15 + "-01"])
+def test_malformed_traceparent_is_ignored(net, value):
+    assert net._parse_traceparent(value) is None
+
+
+def test_otlp_groups_spans_by_node(net):
+    spans = [
+        {"trace_id": "t", "span_id": "1", "parent_span_id": None, "name": "task", "node": "a",
+         "start": 1.0, "end": 2.0, "attrs": {"ok": True, "n": 3, "ratio": 0.5, "op": "x"}, "status": "ok"},
+        {"trace_id": "t", "span_id": "2", "parent_span_id": "1", "name": "step", "node": "b",
+         "start": 1.5, "end": None, "attrs": {}, "status": "error"},
+    ]
+    out = net._trace_otlp(spans)["resourceSpans"]
+    assert [rs["resource"]["attributes"][1]["value"]["stringValue"] for rs in out] == ["a", "b"]
+    root = out[0]["scopeSpans"][0]["spans"][0]
+    assert root["parentSpanId"] == "" and root["endTimeUnixNano"] == "2000000000"
+    assert [a["value"] for a in root["attributes"]] == [
+        {"boolValue": True}, {"intValue": "3"}, {"doubleValue": 0.5}, {"stringValue": "x"}]
+    child = out[1]["scopeSpans"][0]["spans"][0]
+    assert child["status"] == {"code": 2} and child["endTimeUnixNano"] == child["startTimeUnixNano"]
+
+
+def test_task_trace_timeline(client, auth, net, fake_openai):
+    task_id = client.post("/task", json={"pipeline": [{"op": "translate_zh"}], "initial_state": {"english_poem": "hi"}},
+                          headers=auth).get_json()["task_id"]
+    deadline = time.time() + 5
+    while client.get(f"/result/{task_id}", headers=auth).get_json()["status"] not in ("done", "error"):
+        assert time.time() < deadline
+        time.sleep(0.02)
+    body = client.get(f"/trace/{task_id}", headers=auth).get_json()
+    names = [sp["name"] for sp in body["spans"]]
+    assert "skill" in names and all(sp["trace_id"] == body["trace_id"] for sp in body["spans"])
+    assert all(sp["offset_ms"] >= 0 for sp in body["spans"])
+    otlp = client.get(f"/trace/{task_id}?format=otlp", headers=auth).get_json()
+    assert len(otlp["resourceSpans"][0]["scopeSpans"][0]["spans"]) == len(names)
+    assert client.get(f"/trace/{task_id}").status_code == 401